@@ -0,0 +1,150 @@
+import os
+import threading
+
+from orchestrator import Orchestrator
+from manager import Manager
+from validator import Validator
+from readiness import ReadinessProber
+from model import Infrastructure
+from profiler import Profiler
+
+
+class Engagement:
+    """
+    A class driving one infrastructure from Python, without the command line.
+
+    Files of the infrastructure are kept in its own directory under root (named after the infrastructure),
+    the working directory of the process is never changed. Every engagement owns its Orchestrator and Manager,
+    so many engagements can be driven from threads of one process. Calls on one engagement are serialized.
+    Results are returned as dictionaries, nothing is printed unless verbose is set.
+    """
+    def __init__(self, description: dict, root: str = ".", verbose: bool = False, jobs: int = 1,
+                 shard_by: str = None, tf_workers: int = 4, plugin_cache: str = None, provider_mirror: str = None,
+                 force: bool = False, refresh: bool = True, key_type: str = "ed25519", boot_timeout: float = 300.0,
+                 probe: str = "banner", ssh_port: int = 22, profiler: Profiler = None) -> None:
+        """
+        Engagement constructor.
+
+        :param description: parsed infrastructure description
+        :param root: directory with providers and roles the infrastructure directory is created in
+        :param verbose: if True, Terraform and Ansible outputs get printed
+        :param jobs: maximum number of plays run at once
+        :param shard_by: "instance" or "provider" to use one Terraform state per shard, None for a single state
+        :param tf_workers: maximum number of shards applied at once
+        :param plugin_cache: provider plugin cache directory shared by all infrastructures
+        :param provider_mirror: local filesystem provider mirror, providers are downloaded if None
+        :param force: if True, hosts are configured even if they did not change
+        :param refresh: if False, the state is not refreshed before planning
+        :param key_type: type of generated SSH keys, "ed25519" or "rsa"
+        :param boot_timeout: number of seconds each host is given to accept SSH connections
+        :param probe: readiness probe mode, see ReadinessProber
+        :param ssh_port: SSH port probed for readiness
+        :param profiler: profiler recording the engagement, nothing is recorded if None
+        """
+        self.infrastructure = Infrastructure(description)
+        self.profiler = profiler or Profiler(enabled=False)
+        self.validator = Validator(self.infrastructure, self.profiler, os.path.join(root, "providers"),
+                                   os.path.join(root, "roles"))
+        # an unnamed description fails validation before anything is written
+        self.working_dir = os.path.join(root, self.infrastructure.name or "")
+        self.orchestrator = Orchestrator(self.infrastructure, verbose, shard_by, tf_workers, plugin_cache,
+                                         provider_mirror, self.profiler, refresh, key_type, self.working_dir,
+                                         os.path.join(root, "providers"))
+        self.manager = Manager(self.infrastructure, verbose, jobs, force, self.profiler, self.working_dir)
+        self.boot_timeout = boot_timeout
+        self.probe = probe
+        self.ssh_port = ssh_port
+        self.__lock = threading.RLock()
+
+    def validate(self) -> list:
+        """
+        Validates the infrastructure description.
+
+        :return: list of error messages, empty if the description is valid
+        """
+        with self.__lock:
+            return self.validator.errors()
+
+    def orchestrate(self) -> dict:
+        """
+        Runs configuration orchestration (Terraform) and creates the inventory.
+
+        :raises TerraformError: when Terraform error occurs
+        :return: dictionary with whether infrastructure changed, whether a saved plan was applied
+                 and the path of the inventory
+        """
+        with self.__lock:
+            os.makedirs(self.working_dir, exist_ok=True)
+            changed = self.orchestrator.orchestrate_infrastructure()
+            return {"changed": changed, "applied_plan": self.orchestrator.applied_plan,
+                    "inventory_path": self.orchestrator.inventory_path}
+
+    def wait_for_hosts(self, groups: list = None) -> dict:
+        """
+        Waits until hosts in the inventory accept SSH connections.
+
+        :param groups: names of inventory groups to wait for, all groups if None
+        :raises ReadinessError: when hosts do not accept SSH connections in time
+        :return: dictionary mapping host to the number of seconds it took to become ready
+        """
+        with self.__lock:
+            prober = ReadinessProber(self.manager.inventory_path, timeout=self.boot_timeout, mode=self.probe,
+                                     port=self.ssh_port)
+            with self.profiler.span("wait for hosts", "readiness", groups=groups):
+                return prober.wait(groups)
+
+    def manage(self, limit: list = None, force: bool = False) -> dict:
+        """
+        Runs configuration management (Ansible).
+
+        :param limit: names of inventory groups to configure, all groups if None
+        :param force: if True, hosts are configured even if they did not change
+        :raises AnsibleError: when Ansible error occurs
+        :return: dictionary with the configured hosts and the critical path of scheduled plays
+        """
+        with self.__lock:
+            return self.manager.manage(limit, force)
+
+    def run(self) -> dict:
+        """
+        Validates, orchestrates and configures the infrastructure, as "cli.py [description]" does.
+
+        :raises ValueError: when the description is not valid, nothing is orchestrated then
+        :raises TerraformError: when Terraform error occurs
+        :raises ReadinessError: when hosts do not accept SSH connections in time
+        :raises AnsibleError: when Ansible error occurs
+        :return: results of orchestrate, wait_for_hosts (empty if nothing changed) and manage merged together
+        """
+        with self.__lock:
+            errors = self.validate()
+            if errors:
+                raise ValueError("\n".join(errors))
+            result = self.orchestrate()
+            result.update({"ready": self.wait_for_hosts() if result.get("changed") else {}})
+            result.update(self.manage())
+            return result
+
+    def rebuild(self, instance: str) -> dict:
+        """
+        Rebuilds a single instance and configures it and the instances referencing it.
+
+        :param instance: name of the instance to rebuild
+        :raises TerraformError: when Terraform error occurs
+        :raises ReadinessError: when hosts of the instance do not accept SSH connections in time
+        :raises AnsibleError: when Ansible error occurs
+        :return: results of wait_for_hosts ("ready") and manage merged together
+        """
+        with self.__lock:
+            self.orchestrator.rebuild_instance(instance)
+            result = {"ready": self.wait_for_hosts([instance])}
+            result.update(self.manage([instance] + sorted(self.infrastructure.referencing(instance)), force=True))
+            return result
+
+    def destroy(self) -> None:
+        """
+        Destroys the infrastructure and removes its directory.
+
+        :raises TerraformError: when Terraform error occurs
+        """
+        with self.__lock:
+            self.orchestrator.destroy_infrastructure()
@@ -0,0 +1,238 @@
+import os
+import io
+import time
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+
+from cli import CLI
+from model import Infrastructure
+from readiness import ReadinessProber
+
+PHASES = ("validate", "orchestrate", "wait", "manage")
+
+
+def run_engagement(description_path: str, root: str, settings: dict, progress=None, apply_slots=None,
+                   ansible_slots=None) -> dict:
+    """
+    Validates, orchestrates and configures one infrastructure, as "cli.py [description]" does.
+
+    Runs in a worker process of Batch: files of the infrastructure are kept in its directory under root
+    and its output goes into "rtib.log" there. Orchestration holds one of apply_slots
+    and configuration one of ansible_slots, so the number of concurrent Terraform and Ansible runs of all
+    engagements is capped.
+
+    :param description_path: path of the infrastructure description, relative to root
+    :param root: directory with providers and roles the infrastructure directory is created in
+    :param settings: keyword arguments of CLI and "forks", the maximum number of Ansible forks
+    :param progress: queue receiving (description_path, phase, seconds) after every phase, nothing is sent if None
+    :param apply_slots: semaphore held while Terraform runs, not limited if None
+    :param ansible_slots: semaphore held while Ansible runs, not limited if None
+    :return: dictionary with the infrastructure name, "ok", "error", seconds of every phase, seconds spent
+             waiting for slots ("queued"), whether infrastructure changed and the configured hosts
+    """
+    settings = dict(settings)
+    forks = settings.pop("forks", None)
+    result = {"description": description_path, "name": None, "ok": False, "error": None, "seconds": {},
+              "queued": 0.0, "changed": None, "configured_hosts": None, "log": None}
+
+    def phase(name: str, start: float) -> None:
+        result.get("seconds").update({name: time.monotonic() - start})
+        if progress is not None:
+            progress.put((description_path, name, result.get("seconds").get(name)))
+
+    @contextlib.contextmanager
+    def held(slots) -> None:
+        start = time.monotonic()
+        with slots if slots is not None else contextlib.nullcontext():
+            result.update({"queued": result.get("queued") + time.monotonic() - start})
+            yield
+
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            start = time.monotonic()
+            cli_obj = CLI(os.path.join(root, description_path), root=root, **settings)
+            result.update({"name": cli_obj.infrastructure.name})
+            cli_obj.validator.validate()
+            phase("validate", start)
+
+            os.makedirs(cli_obj.working_dir, exist_ok=True)
+            if forks is not None:
+                cli_obj.manager.max_forks = forks
+
+            with held(apply_slots):
+                start = time.monotonic()
+                result.update({"changed": cli_obj.orchestrate()})
+                phase("orchestrate", start)
+
+            start = time.monotonic()
+            if result.get("changed"):
+                cli_obj.wait_for_hosts()
+            phase("wait", start)
+
+            with held(ansible_slots):
+                start = time.monotonic()
+                cli_obj.manage()
+                phase("manage", start)
+            result.update({"ok": True, "configured_hosts": cli_obj.manager.configured_hosts})
+    except Exception as error:  # reported in the summary, other engagements go on
+        result.update({"error": "{}: {}".format(type(error).__name__, error)})
+        if progress is not None:
+            progress.put((description_path, "failed", None))
+    finally:
+        if result.get("name") is not None and os.path.isdir(os.path.join(root, result.get("name"))):
+            result.update({"log": os.path.join(root, result.get("name"), "rtib.log")})
+            with open(result.get("log"), "w") as log_file:
+                log_file.write(log.getvalue())
+    return result
+
+
+class Batch:
+    """
+    A class building many infrastructures side by side.
+
+    Every description runs its own validate/orchestrate/manage pipeline in a worker process, in its own
+    working directory, see run_engagement. At most max_applies engagements run Terraform and at most
+    max_ansible engagements run Ansible at once, and the Ansible forks of all of them stay within max_forks.
+    """
+    def __init__(self, description_paths: list, max_workers: int = 4, max_applies: int = 2, max_ansible: int = 2,
+                 max_forks: int = 100, **settings) -> None:
+        """
+        Batch constructor.
+
+        :param description_paths: paths of the infrastructure descriptions, relative to the working directory
+        :param max_workers: maximum number of engagements built at once
+        :param max_applies: maximum number of engagements running Terraform at once
+        :param max_ansible: maximum number of engagements running Ansible at once
+        :param max_forks: maximum number of Ansible forks of all engagements together
+        :param settings: keyword arguments of CLI used for every engagement
+        :raises ValueError: when two descriptions have the same infrastructure name, they would share a directory
+        """
+        names = {}
+        for path in description_paths:
+            name = Infrastructure(CLI.read_infrastructure_description(path)).name
+            if name in names:
+                raise ValueError("{} and {} both describe infrastructure {}".format(names.get(name), path, name))
+            names.update({name: path})
+
+        self.description_paths = list(description_paths)
+        self.max_workers = max_workers
+        self.max_applies = max_applies
+        self.max_ansible = max_ansible
+        # every engagement running Ansible runs up to "jobs" plays at once, each with its own forks
+        self.settings = dict(settings, forks=max(1, max_forks // (max_ansible * settings.get("jobs", 1))))
+        self.results = {}
+        self.seconds = None
+
+    @staticmethod
+    def __print_progress(progress, start: float) -> None:
+        """
+        Prints progress messages of the engagements until None is received.
+
+        :param progress: queue of (description_path, phase, seconds) tuples
+        :param start: start of the batch, on the time.monotonic clock
+        """
+        for description_path, phase, seconds in iter(progress.get, None):
+            if seconds is None:
+                print("[{:7.1f}s] {}: FAILED".format(time.monotonic() - start, description_path))
+            else:
+                print("[{:7.1f}s] {}: {} DONE IN {:.1f} SECONDS".format(time.monotonic() - start, description_path,
+                                                                       phase.upper(), seconds))
+
+    def run(self) -> dict:
+        """
+        Builds all infrastructures and prints their progress as it happens.
+
+        :return: dictionary mapping description path to its result, see run_engagement
+        """
+        start = time.monotonic()
+        with multiprocessing.Manager() as sync_manager:
+            progress = sync_manager.Queue()
+            apply_slots = sync_manager.BoundedSemaphore(self.max_applies)
+            ansible_slots = sync_manager.BoundedSemaphore(self.max_ansible)
+            printer = threading.Thread(target=self.__print_progress, args=(progress, start))
+            printer.start()
+            try:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                    futures = {executor.submit(run_engagement, path, os.getcwd(), self.settings, progress,
+                                               apply_slots, ansible_slots): path
+                               for path in self.description_paths}
+                    for future in as_completed(futures):
+                        self.results.update({futures.get(future): future.result()})
+            finally:
+                progress.put(None)
+                printer.join()
+
+        self.results = {path: self.results.get(path) for path in self.description_paths}
+        self.seconds = time.monotonic() - start
+        return self.results
+
+    def summary(self) -> str:
+        """
+        Formats the phase timings of all engagements as a table.
+
+        :return: the table, with the wall time of the batch and the sum of times of the engagements without queueing
+        """
+        rows = [["DESCRIPTION", "STATUS", "QUEUED"] + [phase.upper() for phase in PHASES] + ["TOTAL"]]
+        for path, result in self.results.items():
+            seconds = result.get("seconds")
+            rows.append([path, "OK" if result.get("ok") else "FAILED", "{:.1f}".format(result.get("queued"))]
+                        + ["{:.1f}".format(seconds.get(phase)) if phase in seconds else "-" for phase in PHASES]
+                        + ["{:.1f}".format(sum(seconds.values()))])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+        lines.append("BATCH DONE IN {:.1f} SECONDS ({:.1f} SECONDS ONE AFTER ANOTHER)".format(
+            self.seconds, sum(sum(result.get("seconds").values()) for result in self.results.values())))
+        for path, result in self.results.items():
+            if result.get("error") is not None:
+                lines.append("{}: {}".format(path, result.get("error")))
+        return "\n".join(lines)
+
+
+@click.command()
+@click.option("-v", "--verbose", is_flag=True, help="Write terraform and ansible outputs into rtib.log of every engagement")
+@click.option("--workers", default=4, show_default=True, help="Maximum number of engagements built at once")
+@click.option("--max-applies", default=2, show_default=True,
+              help="Maximum number of engagements running Terraform at once")
+@click.option("--max-ansible", default=2, show_default=True,
+              help="Maximum number of engagements running Ansible at once")
+@click.option("--max-forks", default=100, show_default=True,
+              help="Maximum number of Ansible forks of all engagements together")
+@click.option("--boot-timeout", default=300, show_default=True,
+              help="Seconds each host is given to accept SSH connections after orchestration")
+@click.option("--probe", type=click.Choice(ReadinessProber.modes), default="banner", show_default=True,
+              help="How hosts are checked for SSH readiness")
+@click.option("--ssh-port", default=22, show_default=True, help="SSH port probed for readiness")
+@click.option("-j", "--jobs", default=1, show_default=True, help="Maximum number of plays run at once per engagement")
+@click.option("--plugin-cache", type=click.Path(file_okay=False, resolve_path=True),
+              help="Provider plugin cache directory shared by all infrastructures")
+@click.option("--provider-mirror", type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help="Local filesystem mirror to install providers from instead of downloading them")
+@click.option("--force", is_flag=True, help="Configure all hosts, even those that did not change since their last run")
+@click.argument("descriptions", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def main(descriptions, verbose, workers, max_applies, max_ansible, max_forks, boot_timeout, probe, ssh_port, jobs,
+         plugin_cache, provider_mirror, force):
+    """
+    Builds many infrastructures side by side.
+
+    Every one of DESCRIPTIONS is validated, orchestrated and configured as by "cli.py DESCRIPTION",
+    in its own working directory and worker process.
+    """
+    try:
+        batch = Batch(list(descriptions), workers, max_applies, max_ansible, max_forks, verbose=verbose,
+                      boot_timeout=boot_timeout, probe=probe, jobs=jobs, plugin_cache=plugin_cache,
+                      provider_mirror=provider_mirror, force=force, ssh_port=ssh_port)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    results = batch.run()
+    print(batch.summary())
+    if not all(result.get("ok") for result in results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Fake ansible-playbook binary of the simulator, see benchmarks.simulator.
+
+Runs the plays of the playbook on the hosts of the inventory (honouring --limit) and prints
+the JSON lines the "rtib_events" callback plugin would. Every role of a play has "tasks" tasks
+of the scenario, a task takes task_latency on every host and all hosts of a play run it in parallel.
+"""
+import sys
+import json
+import time
+import argparse
+
+import yaml
+
+from benchmarks.simulator import SimulationState
+
+
+class FakeAnsible:
+    """
+    A class simulating ansible-playbook with the "rtib_events" callback plugin.
+    """
+    def __init__(self, state: SimulationState) -> None:
+        """
+        FakeAnsible constructor.
+
+        :param state: state of the simulation
+        """
+        self.scenario = state.scenario()
+        self.modules = {host: module for module, hosts in state.read("addresses.json").items() for host in hosts}
+        self.stats = {}
+        self.play = None
+
+    def __emit(self, event: str, **fields) -> None:
+        """
+        Prints an event of the "rtib_events" callback plugin.
+
+        :param event: type of the event
+        :param fields: other fields of the event
+        """
+        fields.update({"event": event, "time": time.time(), "play": self.play})
+        print(json.dumps(fields, sort_keys=True), flush=True)
+
+    def __count(self, host: str, key: str) -> None:
+        counts = self.stats.setdefault(host, {"ok": 0, "changed": 0, "failures": 0, "unreachable": 0,
+                                              "skipped": 0, "rescued": 0, "ignored": 0})
+        counts.update({key: counts.get(key) + 1})
+
+    def __run_play(self, play: dict, hosts: list) -> None:
+        """
+        Runs the tasks of a play on its hosts.
+
+        :param play: the play
+        :param hosts: addresses of the hosts of the play
+        """
+        self.play = play.get("hosts")
+        self.__emit("play_start")
+        live = list(hosts)
+        tasks = ["{} : task {}".format(role, k) for role in play.get("roles", []) for k in range(self.scenario.tasks)]
+        for k, task in enumerate(tasks):
+            if not live:
+                break
+            self.__emit("task_start", task=task)
+            start = time.monotonic()
+            latencies = sorted((self.scenario.latency(self.__settings(host).get("task_latency"), host, self.play, k),
+                                host) for host in live)
+            for latency, host in latencies:
+                settings = self.__settings(host)
+                if settings.get("unreachable"):
+                    self.__emit("host_unreachable", host=host, task=task, duration=0.0,
+                                msg="Failed to connect to the host via ssh (simulated)")
+                    self.__count(host, "unreachable")
+                    live.remove(host)
+                    continue
+                time.sleep(max(0.0, start + latency - time.monotonic()))
+                if settings.get("fail_task") == k:
+                    self.__emit("task_failed", host=host, task=task, duration=latency,
+                                msg="Simulated failure of task {}".format(k))
+                    self.__count(host, "failures")
+                    live.remove(host)
+                    continue
+                # like in Ansible, changed tasks are counted as ok too
+                changed = k % 2 == 0
+                self.__emit("task_changed" if changed else "task_ok", host=host, task=task, duration=latency, msg=None)
+                self.__count(host, "ok")
+                if changed:
+                    self.__count(host, "changed")
+
+    def __settings(self, host: str) -> dict:
+        return self.scenario.module(self.modules.get(host, self.play))
+
+    def run(self, playbook_path: str, inventory_path: str, limit: list = None) -> int:
+        """
+        Runs the playbook.
+
+        :param playbook_path: path of the playbook
+        :param inventory_path: path of the YAML inventory
+        :param limit: group names or host addresses to run on, all hosts if None
+        :return: exit code of ansible-playbook, 2 if a task failed, 4 if a host was unreachable
+        """
+        with open(playbook_path) as playbook_file:
+            playbook = yaml.safe_load(playbook_file) or []
+        with open(inventory_path) as inventory_file:
+            groups = ((yaml.safe_load(inventory_file) or {}).get("all") or {}).get("children") or {}
+
+        for play in playbook:
+            hosts = list(((groups.get(play.get("hosts")) or {}).get("hosts") or {}).keys())
+            if limit is not None and play.get("hosts") not in limit:
+                hosts = [host for host in hosts if host in limit]
+            if hosts:
+                self.__run_play(play, hosts)
+
+        self.play = None
+        for host, counts in sorted(self.stats.items()):
+            self.__emit("host_stats", host=host, msg=counts)
+        if any(counts.get("unreachable") for counts in self.stats.values()):
+            return 4
+        if any(counts.get("failures") for counts in self.stats.values()):
+            return 2
+        return 0
+
+
+def main(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog="ansible-playbook")
+    parser.add_argument("playbook")
+    parser.add_argument("-i", "--inventory", required=True)
+    parser.add_argument("-l", "--limit")
+    args, _ = parser.parse_known_args(argv)
+    limit = args.limit.split(",") if args.limit else None
+    return FakeAnsible(SimulationState.from_environment()).run(args.playbook, args.inventory, limit)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
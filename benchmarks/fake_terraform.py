@@ -0,0 +1,305 @@
+"""
+Fake terraform binary of the simulator, see benchmarks.simulator.
+
+Supports the commands RTIB runs: init, plan (with -out), show -json of a saved plan,
+apply (with -json, -target or a saved plan), destroy and taint.
+Every host of a module is a resource created after the module's apply_latency, resources of all
+applied modules are created concurrently. Changes are announced as planned_change messages first and,
+as with Terraform's local backend, state and outputs are written into "terraform.tfstate" whenever
+a module is applied, in the format RTIB reads.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timezone
+
+from benchmarks.simulator import SimulationState
+
+STATE_PATH = "terraform.tfstate"
+RESOURCE_TYPES = {"aws": "aws_instance", "openstack": "openstack_compute_instance_v2"}
+
+
+class FakeTerraform:
+    """
+    A class simulating Terraform in the current working directory.
+    """
+    def __init__(self, state: SimulationState) -> None:
+        """
+        FakeTerraform constructor.
+
+        :param state: state of the simulation
+        """
+        self.simulation = state
+        self.scenario = state.scenario()
+        self.__print_lock = threading.Lock()
+
+    def __emit(self, message_type: str, message: str, level: str = "info", **fields) -> None:
+        """
+        Prints a message of the machine-readable UI.
+
+        :param message_type: type of the message
+        :param message: human-readable message
+        :param level: "info" or "error"
+        :param fields: other fields of the message
+        """
+        fields.update({"@level": level, "@message": message, "type": message_type,
+                       "@timestamp": datetime.now(timezone.utc).isoformat()})
+        with self.__print_lock:
+            print(json.dumps(fields), flush=True)
+
+    @staticmethod
+    def __read_state() -> dict:
+        try:
+            with open(STATE_PATH) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {"version": 4, "outputs": {}, "resources": []}
+
+    @staticmethod
+    def __write_state(state: dict) -> None:
+        with open(STATE_PATH + ".tmp", "w") as state_file:
+            json.dump(state, state_file, indent=2)
+        os.replace(STATE_PATH + ".tmp", STATE_PATH)
+
+    @staticmethod
+    def __modules() -> dict:
+        """
+        Reads the modules of the configuration.
+
+        :return: dictionary mapping module name to its arguments
+        """
+        with open("main.tf.json") as main_tf_json:
+            return json.load(main_tf_json).get("module", {})
+
+    @staticmethod
+    def __pending(total: int, previous: dict) -> dict:
+        """
+        Lists the hosts of a module an apply creates or replaces.
+
+        :param total: number of hosts of the module
+        :param previous: resource of the module in the state, None if it was not applied yet
+        :return: dictionary mapping host index to "create" or "replace"
+        """
+        instances = [] if previous is None else previous.get("instances")
+        return {i: "create" if i >= len(instances) else "replace" for i in range(total)
+                if i >= len(instances) or instances[i].get("status") == "tainted"}
+
+    def init(self) -> int:
+        time.sleep(self.scenario.init_latency)
+        os.makedirs(".terraform", exist_ok=True)
+        print("Terraform has been successfully initialized!")
+        return 0
+
+    @staticmethod
+    def __resource_type(module_dict: dict) -> str:
+        """
+        Returns the type of the host resources of a module.
+
+        :param module_dict: arguments of the module
+        :return: resource type, e.g. "aws_instance"
+        """
+        provider = os.path.basename(module_dict.get("source", ""))
+        return RESOURCE_TYPES.get(provider, "{}_instance".format(provider))
+
+    def __apply_module(self, name: str, module_dict: dict, previous: dict, results: dict,
+                       parallelism: int) -> None:
+        """
+        Creates the hosts of a module, or replaces the tainted ones.
+
+        :param name: name of the module
+        :param module_dict: arguments of the module
+        :param previous: resource of the module in the state, None if it was not applied yet
+        :param results: dictionary the resulting resource (None if the apply failed) is stored into by name
+        :param parallelism: parallelism of the apply, compared with the module's throttle_parallelism
+        """
+        settings = self.scenario.module(name)
+        addresses = self.simulation.read("addresses.json").get(name) or ["127.0.0.1"]
+        resource_type = self.__resource_type(module_dict)
+        total = module_dict.get("total", 1)
+        pending = self.__pending(total, previous)
+
+        start = time.monotonic()
+        for i, action in pending.items():
+            self.__emit("apply_start", "module.{}.{}.instance[{}]: Creating...".format(name, resource_type, i),
+                        hook={"resource": {"addr": "module.{}.{}.instance[{}]".format(name, resource_type, i),
+                                           "module": "module." + name}, "action": action})
+        for i, action in pending.items():
+            addr = "module.{}.{}.instance[{}]".format(name, resource_type, i)
+            time.sleep(max(0.0, start + self.scenario.latency(settings.get("apply_latency"), name, i)
+                           - time.monotonic()))
+            hook = {"resource": {"addr": addr, "module": "module." + name}, "action": action,
+                    "elapsed_seconds": round(time.monotonic() - start)}
+            throttled = settings.get("throttle_parallelism") is not None \
+                and parallelism > settings.get("throttle_parallelism")
+            if settings.get("apply_fail") or throttled:
+                detail = "RequestLimitExceeded: Request limit exceeded." if throttled \
+                    else "apply_fail is set in the scenario"
+                self.__emit("apply_errored", "{}: Creation errored".format(addr), "error", hook=hook)
+                self.__emit("diagnostic", "Error: simulated failure", "error",
+                            diagnostic={"severity": "error", "summary": "Simulated failure of " + addr,
+                                        "detail": detail, "address": addr})
+                results.update({name: None})
+                return
+            self.__emit("apply_complete", "{}: Creation complete".format(addr), hook=hook)
+
+        if pending:
+            self.simulation.update("applied.json", {name: time.time()})
+        results.update({name: {"module": "module." + name, "mode": "managed", "type": resource_type,
+                               "name": "instance", "instances": [
+                                   {"index_key": i, "attributes": {"address": addresses[i % len(addresses)]}}
+                                   for i in range(total)]},
+                        name + ".created": len(pending)})
+
+    def __changes(self) -> dict:
+        """
+        Plans the apply of the whole configuration.
+
+        :return: dictionary mapping module name to the dictionary of its changed hosts (see __pending),
+                 removed modules map to None
+        """
+        modules = self.__modules()
+        resources = {resource.get("module")[len("module."):]: resource
+                     for resource in self.__read_state().get("resources", [])}
+        changes = {name: self.__pending(module_dict.get("total", 1), resources.get(name))
+                   for name, module_dict in modules.items()}
+        changes.update({name: None for name in resources if name not in modules})
+        return {name: pending for name, pending in changes.items() if pending != {}}
+
+    def plan(self, out: str) -> int:
+        changes = self.__changes()
+        with open(out, "w") as plan_file:
+            json.dump({"changes": changes}, plan_file)
+        print("Plan: {} to add, 0 to change, {} to destroy.".format(
+            sum(len(pending) for pending in changes.values() if pending is not None),
+            sum(1 for pending in changes.values() if pending is None)))
+        return 2 if changes else 0  # -detailed-exitcode
+
+    @staticmethod
+    def show(plan_path: str) -> int:
+        with open(plan_path) as plan_file:
+            changes = json.load(plan_file).get("changes")
+        resource_changes = []
+        for name, pending in changes.items():
+            for i, action in (pending or {"0": "delete"}).items():
+                resource_changes.append({"address": "module.{}.instance[{}]".format(name, i),
+                                         "module_address": "module." + name,
+                                         "change": {"actions": ["delete", "create"] if action == "replace"
+                                                    else [action]}})
+        print(json.dumps({"format_version": "1.0", "resource_changes": resource_changes}))
+        return 0
+
+    @staticmethod
+    def __with_outputs(state: dict, resources: dict) -> dict:
+        """
+        Returns the state with the given resources and outputs of their modules.
+
+        :param state: state read before the apply
+        :param resources: dictionary mapping module name to its resource
+        :return: updated state
+        """
+        return dict(state, resources=list(resources.values()), outputs={
+            name: {"sensitive": False, "type": ["object", {"hosts": ["tuple", ["string"]]}],
+                   "value": {"hosts": [instance.get("attributes").get("address")
+                                       for instance in resource.get("instances")]}}
+            for name, resource in resources.items()})
+
+    def apply(self, targets: list, plan_path: str = None, parallelism: int = 10) -> int:
+        modules = self.__modules()
+        state = self.__read_state()
+        resources = {resource.get("module")[len("module."):]: resource for resource in state.get("resources", [])}
+        if plan_path is not None:
+            with open(plan_path) as plan_file:
+                targets = ["module." + name for name in json.load(plan_file).get("changes")]
+        names = [name for name in modules if not targets or "module." + name in targets]
+
+        for name in names:
+            resource_type = self.__resource_type(modules.get(name))
+            for i, action in self.__pending(modules.get(name).get("total", 1), resources.get(name)).items():
+                addr = "module.{}.{}.instance[{}]".format(name, resource_type, i)
+                self.__emit("planned_change", "{}: Plan to {}".format(addr, action),
+                            change={"resource": {"addr": addr, "module": "module." + name}, "action": action})
+
+        results = {}
+        applied = dict(resources)
+        state_lock = threading.Lock()
+
+        def apply_module(name: str) -> None:
+            self.__apply_module(name, modules.get(name), resources.get(name), results, parallelism)
+            if results.get(name) is not None:
+                with state_lock:
+                    applied.update({name: results.get(name)})
+                    self.__write_state(self.__with_outputs(state, applied))
+
+        threads = [threading.Thread(target=apply_module, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        deleted = [name for name in resources
+                   if name not in modules and (not targets or plan_path is not None and "module." + name in targets)]
+        for name in deleted:
+            for i in range(len(resources.get(name).get("instances"))):
+                addr = "module.{}.{}.instance[{}]".format(name, resources.get(name).get("type"), i)
+                self.__emit("apply_complete", "{}: Destruction complete".format(addr),
+                            hook={"resource": {"addr": addr, "module": "module." + name}, "action": "delete",
+                                  "elapsed_seconds": 0})
+            resources.pop(name)
+
+        failed = [name for name in names if results.get(name) is None]
+        resources.update({name: results.get(name) for name in names if results.get(name) is not None})
+        self.__write_state(self.__with_outputs(state, resources))
+
+        created = sum(results.get(name + ".created", 0) for name in names)
+        self.__emit("change_summary", "Apply complete! Resources: {} added, 0 changed, {} destroyed.".format(
+            created, len(deleted)), changes={"add": created, "change": 0, "remove": len(deleted),
+                                              "operation": "apply"})
+        return 1 if failed else 0
+
+    def destroy(self) -> int:
+        state = self.__read_state()
+        time.sleep(self.scenario.init_latency)
+        self.__write_state({"version": 4, "outputs": {}, "resources": []})
+        print("Destroy complete! Resources: {} destroyed.".format(
+            sum(len(resource.get("instances")) for resource in state.get("resources", []))))
+        return 0
+
+    def taint(self, address: str) -> int:
+        state = self.__read_state()
+        for resource in state.get("resources", []):
+            for instance in resource.get("instances", []):
+                if "{}.{}.{}[{}]".format(resource.get("module"), resource.get("type"), resource.get("name"),
+                                         instance.get("index_key")) == address:
+                    instance.update({"status": "tainted"})
+        self.__write_state(state)
+        print("Resource instance {} has been marked as tainted.".format(address))
+        return 0
+
+
+def main(argv: list) -> int:
+    terraform = FakeTerraform(SimulationState.from_environment())
+    command = argv[0] if argv else None
+    arguments = [argument for argument in argv[1:] if not argument.startswith("-")]
+    if command == "init":
+        return terraform.init()
+    if command == "plan":
+        return terraform.plan([argument[len("-out="):] for argument in argv if argument.startswith("-out=")][0])
+    if command == "show":
+        return terraform.show(arguments[0])
+    if command == "apply":
+        parallelism = [int(argument[len("-parallelism="):]) for argument in argv
+                       if argument.startswith("-parallelism=")]
+        return terraform.apply([argument[len("-target="):] for argument in argv if argument.startswith("-target=")],
+                               arguments[0] if arguments else None, parallelism[0] if parallelism else 10)
+    if command == "destroy":
+        return terraform.destroy()
+    if command == "taint":
+        return terraform.taint(arguments[0])
+    print("Simulated terraform does not support {}".format(command), file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,434 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import platform
+import tempfile
+import subprocess
+from typing import List, Optional
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENGINES = ("rtib", "rtib-copy", "socat", "apache")
+PROTOCOLS = ("tcp", "http")
+HTTP_URI = "articles/how-to-wash-your-hands"
+HTTP_USER_AGENT = "RTIB-benchmark"
+
+
+def free_port() -> int:
+    """
+    Finds a free TCP port on localhost.
+
+    :return: port number
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, fraction: float) -> Optional[float]:
+    """
+    Computes a percentile by the nearest-rank method.
+
+    :param values: measured values
+    :param fraction: percentile as a fraction, e.g. 0.99
+    :return: the percentile, None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def process_rss(pid: int) -> Optional[int]:
+    """
+    Sums resident memory of a process and its children (socat forks a child per connection).
+
+    :param pid: id of the process
+    :return: resident memory in kB, None if /proc is not available
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as status_file:
+            rss = next((int(line.split()[1]) for line in status_file if line.startswith("VmRSS:")), 0)
+        with open("/proc/{}/task/{}/children".format(pid, pid)) as children_file:
+            children = [int(child) for child in children_file.read().split()]
+    except OSError:
+        return None
+    return rss + sum(process_rss(child) or 0 for child in children)
+
+
+class DummyC2:
+    """
+    A class simulating a C2 backend on localhost.
+
+    Raw TCP beacons are echoed back, HTTP beacons get a small response and the connection is closed.
+    """
+    response = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"
+
+    def __init__(self) -> None:
+        """
+        DummyC2 constructor.
+        """
+        self.tcp_port = None
+        self.http_port = None
+        self.__servers = []
+        self.__handlers = {}
+
+    async def start(self) -> None:
+        """
+        Starts the TCP and HTTP servers on free ports, stored in tcp_port and http_port.
+        """
+        tcp = await asyncio.start_server(self.__echo, "127.0.0.1", 0)
+        http = await asyncio.start_server(self.__http, "127.0.0.1", 0)
+        self.__servers = [tcp, http]
+        self.tcp_port = tcp.sockets[0].getsockname()[1]
+        self.http_port = http.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """
+        Stops the servers and closes connections still open.
+        """
+        for server in self.__servers:
+            server.close()
+            await server.wait_closed()
+        for writer in list(self.__handlers.values()):
+            writer.close()
+        await asyncio.gather(*self.__handlers, return_exceptions=True)
+
+    def __track(self, writer: asyncio.StreamWriter) -> None:
+        """
+        Registers the connection handled by the current task, so stop() can close it.
+
+        :param writer: writer of the connection
+        """
+        task = asyncio.current_task()
+        self.__handlers.update({task: writer})
+        task.add_done_callback(self.__handlers.pop)
+
+    async def __echo(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.__track(writer)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def __http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.__track(writer)
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(self.response)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class RedirectorProcess:
+    """
+    A class running a redirector configuration on localhost.
+
+    The configurations are derived from the roles: the socat address options of pipe_redirector,
+    the rendered htaccess and apache.conf of rewrite_redirector, and redirector.py of pipe_redirector's
+    "rtib" engine.
+    """
+    def __init__(self, engine: str, backend_port: int) -> None:
+        """
+        RedirectorProcess constructor.
+
+        :param engine: one of ENGINES
+        :param backend_port: port of the dummy C2 backend
+        """
+        self.engine = engine
+        self.backend_port = backend_port
+        self.port = free_port()
+        self.process = None
+        self.__tmp_dir = None
+
+    def available(self) -> bool:
+        """
+        Checks whether the engine can run here.
+
+        :return: True if the binaries of the engine are installed
+        """
+        if self.engine == "socat":
+            return shutil.which("socat") is not None
+        if self.engine == "apache":
+            return shutil.which("apache2") is not None
+        return True
+
+    def command(self) -> List[str]:
+        """
+        Builds the command line of the engine.
+
+        :return: command line
+        """
+        if self.engine == "socat":
+            return ["socat", "TCP4-LISTEN:{},fork,reuseaddr,bind=127.0.0.1".format(self.port),
+                    "TCP4:127.0.0.1:{}".format(self.backend_port)]
+        if self.engine == "apache":
+            return [shutil.which("apache2"), "-f", self.__apache_config(), "-DFOREGROUND"]
+        command = [sys.executable, os.path.join(ROOT, "redirector.py"), "--bind", "127.0.0.1",
+                   "--listen", "{}:{}".format(self.port, self.backend_port), "--backend", "127.0.0.1",
+                   "--health-interval", "0"]
+        return command + (["--no-splice"] if self.engine == "rtib-copy" else [])
+
+    def __apache_config(self) -> str:
+        """
+        Renders the htaccess and apache.conf of rewrite_redirector into a temporary server root.
+
+        :return: path of the configuration file
+        """
+        import jinja2  # installed with Ansible, only needed for this engine
+
+        www = os.path.join(self.__tmp_dir, "www")
+        os.makedirs(www)
+        with open(os.path.join(ROOT, "roles", "rewrite_redirector", "templates", "htaccess")) as template_file:
+            htaccess = jinja2.Template(template_file.read()).render(
+                uri=HTTP_URI, user_agent=HTTP_USER_AGENT, invalid_traffic="example.com",
+                redirect_to_host="127.0.0.1:{}".format(self.backend_port))
+        with open(os.path.join(www, ".htaccess"), "w") as htaccess_file:
+            htaccess_file.write(htaccess)
+        with open(os.path.join(ROOT, "roles", "rewrite_redirector", "files", "apache.conf")) as conf_file:
+            conf = conf_file.read()
+
+        modules = "\n".join("<IfModule !{0}_module>\nLoadModule {0}_module /usr/lib/apache2/modules/mod_{0}.so\n"
+                            "</IfModule>".format(module) for module in ("rewrite", "proxy", "proxy_http"))
+        conf = conf.replace("Include ports.conf", "{}\nListen 127.0.0.1:{}\nDocumentRoot {}".format(
+            modules, self.port, www))
+        conf = conf.replace("<Directory /var/www/>", "<Directory {}/>".format(www))
+        conf = conf.replace("IncludeOptional sites-enabled/*.conf", "")
+        path = os.path.join(self.__tmp_dir, "apache.conf")
+        with open(path, "w") as conf_file:
+            conf_file.write("ServerRoot /etc/apache2\n" + conf)
+        return path
+
+    def __env(self) -> dict:
+        """
+        Builds the environment of the engine, Debian's apache.conf expects its paths in variables.
+
+        :return: environment variables
+        """
+        env = os.environ.copy()
+        if self.engine == "apache":
+            env.update({"APACHE_RUN_DIR": self.__tmp_dir, "APACHE_PID_FILE": os.path.join(self.__tmp_dir, "pid"),
+                        "APACHE_LOCK_DIR": self.__tmp_dir, "APACHE_LOG_DIR": self.__tmp_dir,
+                        "APACHE_RUN_USER": env.get("USER", "root"), "APACHE_RUN_GROUP": env.get("USER", "root")})
+        return env
+
+    def __enter__(self) -> "RedirectorProcess":
+        self.__tmp_dir = tempfile.mkdtemp(prefix="rtib-bench-")
+        self.process = subprocess.Popen(self.command(), env=self.__env(), stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                return self
+            except OSError:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.05)
+        self.__exit__(None, None, None)
+        raise RuntimeError("{} redirector did not start".format(self.engine))
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.__tmp_dir, ignore_errors=True)
+
+
+async def beacon(port: int, protocol: str, payload: bytes) -> None:
+    """
+    Sends a single beacon through the redirector and waits for the whole reply.
+
+    :param port: port of the redirector
+    :param protocol: "tcp" (echoed payload) or "http" (GET request matching the rewrite rules)
+    :param payload: payload of a TCP beacon
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        if protocol == "http":
+            writer.write("GET /{} HTTP/1.1\r\nHost: 127.0.0.1\r\nUser-Agent: {}\r\nConnection: close\r\n\r\n".format(
+                HTTP_URI, HTTP_USER_AGENT).encode())
+            reply = await reader.read()
+            if not reply.startswith(b"HTTP/1.1 200"):
+                raise ConnectionError("unexpected reply")
+        else:
+            writer.write(payload)
+            await reader.readexactly(len(payload))
+    finally:
+        writer.close()
+
+
+async def drive(port: int, protocol: str, concurrency: int, duration: float, payload: bytes) -> dict:
+    """
+    Drives beacons through the redirector from concurrent clients for a given time.
+
+    :param port: port of the redirector
+    :param protocol: "tcp" or "http"
+    :param concurrency: number of concurrent clients
+    :param duration: number of seconds to send beacons for
+    :param payload: payload of a TCP beacon
+    :return: dictionary with request count, errors, requests per second and latency percentiles
+    """
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client() -> None:
+        nonlocal errors
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                await beacon(port, protocol, payload)
+                latencies.append(time.perf_counter() - start)
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"requests": len(latencies), "errors": errors, "requests_per_second": len(latencies) / elapsed,
+            "latency_ms": {"p50": (percentile(latencies, 0.5) or 0) * 1000,
+                           "p99": (percentile(latencies, 0.99) or 0) * 1000}}
+
+
+async def connection_memory(redirector: RedirectorProcess, connections: int) -> Optional[float]:
+    """
+    Measures resident memory the redirector needs per idle open connection.
+
+    :param redirector: running redirector
+    :param connections: number of connections to hold open
+    :return: kB per connection, None if memory cannot be measured
+    """
+    idle = process_rss(redirector.process.pid)
+    if idle is None:
+        return None
+    writers = []
+    try:
+        for _ in range(connections):
+            _, writer = await asyncio.open_connection("127.0.0.1", redirector.port)
+            writers.append(writer)
+        await asyncio.sleep(0.5)  # let socat fork and Apache spawn workers
+        loaded = process_rss(redirector.process.pid)
+    finally:
+        for writer in writers:
+            writer.close()
+    return max(0, (loaded or idle) - idle) / connections
+
+
+async def benchmark(engines: List[str], protocols: List[str], concurrency: int, duration: float,
+                    payload_size: int, connections: int) -> list:
+    """
+    Benchmarks redirector engines against a dummy C2 backend.
+
+    Combinations that cannot run here (missing binaries, raw TCP through Apache) are skipped.
+
+    :param engines: engines to benchmark, see ENGINES
+    :param protocols: protocols to drive, see PROTOCOLS
+    :param concurrency: number of concurrent clients
+    :param duration: number of seconds every combination is driven for
+    :param payload_size: size of a TCP beacon in bytes
+    :param connections: number of idle connections held open for the memory measurement
+    :return: list of results
+    """
+    backend = DummyC2()
+    await backend.start()
+    results = []
+    try:
+        for engine in engines:
+            for protocol in protocols:
+                if engine == "apache" and protocol == "tcp":
+                    continue
+                port = backend.http_port if protocol == "http" else backend.tcp_port
+                redirector = RedirectorProcess(engine, port)
+                if not redirector.available():
+                    results.append({"engine": engine, "protocol": protocol, "skipped": "not installed"})
+                    continue
+                with redirector:
+                    result = await drive(redirector.port, protocol, concurrency, duration, b"b" * payload_size)
+                    result.update({"memory_per_connection_kb": await connection_memory(redirector, connections)})
+                result.update({"engine": engine, "protocol": protocol, "concurrency": concurrency})
+                results.append(result)
+    finally:
+        await backend.stop()
+    return results
+
+
+def compare(results: list, baseline: list) -> List[str]:
+    """
+    Compares results with a baseline run.
+
+    :param results: current results
+    :param baseline: results of the baseline run
+    :return: lines describing the change of throughput and p99 latency of every combination
+    """
+    previous = {(result.get("engine"), result.get("protocol")): result for result in baseline}
+    lines = []
+    for result in results:
+        old = previous.get((result.get("engine"), result.get("protocol")))
+        if "skipped" in result or old is None or "skipped" in old:
+            continue
+        lines.append("{} {}: {:+.1%} requests/s, {:+.1%} p99 latency".format(
+            result.get("engine"), result.get("protocol"),
+            result.get("requests_per_second") / old.get("requests_per_second") - 1,
+            result.get("latency_ms").get("p99") / (old.get("latency_ms").get("p99") or 1e-9) - 1))
+    return lines
+
+
+@click.command()
+@click.option("--engine", "engines", multiple=True, type=click.Choice(ENGINES), default=ENGINES,
+              help="Redirector engine to benchmark, all by default")
+@click.option("--protocol", "protocols", multiple=True, type=click.Choice(PROTOCOLS), default=PROTOCOLS,
+              help="Beacon protocol, all by default")
+@click.option("-c", "--concurrency", default=50, show_default=True, help="Number of concurrent clients")
+@click.option("-d", "--duration", default=5.0, show_default=True, help="Seconds to drive every combination for")
+@click.option("--payload", "payload_size", default=512, show_default=True, help="Size of a TCP beacon in bytes")
+@click.option("--connections", default=200, show_default=True,
+              help="Idle connections held open to measure memory per connection")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), default="redirectors.json", show_default=True,
+              help="Where to write the JSON results")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="Results to compare with")
+def main(engines, protocols, concurrency, duration, payload_size, connections, output, baseline):
+    """
+    Benchmarks throughput, latency and memory of the redirector roles on localhost.
+    """
+    results = asyncio.run(benchmark(list(engines), list(protocols), concurrency, duration, payload_size,
+                                    connections))
+    for result in results:
+        if "skipped" in result:
+            print("{engine} {protocol}: skipped, {skipped}".format(**result))
+        else:
+            print("{} {}: {:.0f} requests/s, p50 {:.2f} ms, p99 {:.2f} ms, {} errors".format(
+                result.get("engine"), result.get("protocol"), result.get("requests_per_second"),
+                result.get("latency_ms").get("p50"), result.get("latency_ms").get("p99"), result.get("errors")))
+
+    with open(output, "w") as output_file:
+        json.dump({"time": time.time(), "python": platform.python_version(), "platform": platform.platform(),
+                   "cpus": os.cpu_count(), "results": results}, output_file, indent=2)
+    print("RESULTS WRITTEN TO {}".format(output))
+
+    if baseline:
+        with open(baseline) as baseline_file:
+            for line in compare(results, json.load(baseline_file).get("results")):
+                print(line)
+
+
+if __name__ == '__main__':
+    main()
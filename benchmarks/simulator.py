@@ -0,0 +1,389 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import shutil
+import asyncio
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, List
+
+import click
+import yaml
+
+from model import Infrastructure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIM_DIR_VARIABLE = "RTIB_SIM_DIR"
+
+
+class Scenario:
+    """
+    A class describing a simulated engagement.
+
+    The scenario file names the infrastructure description and sets latencies and injected failures
+    of the fake terraform and ansible-playbook binaries, per module or for all modules ("default"):
+
+        description: example_infrastructure.yaml  # relative to the scenario file
+        init_latency: 1.0     # seconds "terraform init" takes
+        tasks: 3              # tasks of every play
+        jitter: 0.2           # latencies vary randomly by up to 20 %, seeded by seed
+        seed: 0
+        modules:
+          default:
+            apply_latency: 2.0   # seconds to create a host
+            apply_fail: false    # the apply of the module fails
+            throttle_parallelism: null  # applies with a higher -parallelism fail with a throttling error
+            boot_latency: 1.0    # seconds after the apply until SSH accepts connections
+            task_latency: 0.1    # seconds of every task on every host
+            fail_task: null      # index of the task failing on the module's hosts
+            unreachable: false   # hosts of the module are unreachable for Ansible
+          interactive_c2:
+            apply_latency: 30
+    """
+    module_defaults = {"apply_latency": 1.0, "apply_fail": False, "throttle_parallelism": None, "boot_latency": 0.0,
+                       "task_latency": 0.1, "fail_task": None, "unreachable": False}
+
+    def __init__(self, scenario: dict, base_dir: str = ".") -> None:
+        """
+        Scenario constructor.
+
+        :param scenario: parsed scenario file
+        :param base_dir: directory the description path is relative to
+        """
+        self.scenario = scenario
+        self.description_path = os.path.join(base_dir, scenario.get("description", "example_infrastructure.yaml"))
+        self.init_latency = scenario.get("init_latency", 0.0)
+        self.tasks = scenario.get("tasks", 3)
+        self.jitter = scenario.get("jitter", 0.0)
+        self.seed = scenario.get("seed", 0)
+        self.modules = scenario.get("modules") or {}
+
+    @classmethod
+    def load(cls, path: str) -> "Scenario":
+        """
+        Reads a scenario file.
+
+        :param path: path of the YAML scenario file
+        :return: the scenario
+        """
+        with open(path) as scenario_file:
+            return cls(yaml.safe_load(scenario_file) or {}, os.path.dirname(os.path.abspath(path)))
+
+    def module(self, name: str) -> dict:
+        """
+        Returns the settings of a module.
+
+        :param name: name of the module
+        :return: module settings merged with the defaults
+        """
+        return {**self.module_defaults, **(self.modules.get("default") or {}), **(self.modules.get(name) or {})}
+
+    def latency(self, seconds: float, *key) -> float:
+        """
+        Applies the jitter to a latency, the same key always gets the same latency.
+
+        :param seconds: latency without jitter
+        :param key: identification of the delayed operation, e.g. the host and the task
+        :return: latency in seconds
+        """
+        if not self.jitter:
+            return seconds
+        generator = random.Random("{}:{}".format(self.seed, ":".join(str(part) for part in key)))
+        return max(0.0, seconds * (1 + generator.uniform(-self.jitter, self.jitter)))
+
+
+class SimulationState:
+    """
+    A class sharing state between the harness and the fake binaries through files in the simulation directory.
+
+    addresses.json maps every module to the loopback addresses of its hosts, applied.json maps
+    every module to the time its hosts were (re)created.
+    """
+    def __init__(self, sim_dir: str) -> None:
+        """
+        SimulationState constructor.
+
+        :param sim_dir: simulation directory
+        """
+        self.sim_dir = sim_dir
+
+    @classmethod
+    def from_environment(cls) -> "SimulationState":
+        """
+        Returns the state of the simulation the fake binary runs in.
+
+        :return: the simulation state
+        """
+        return cls(os.environ[SIM_DIR_VARIABLE])
+
+    def scenario(self) -> Scenario:
+        """
+        Reads the scenario of the simulation.
+
+        :return: the scenario
+        """
+        return Scenario.load(os.path.join(self.sim_dir, "scenario.yaml"))
+
+    @contextmanager
+    def __locked(self) -> Iterator[None]:
+        """
+        Serialises access of concurrently running fake binaries (shards) to the shared files.
+        """
+        with open(os.path.join(self.sim_dir, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self, name: str) -> dict:
+        """
+        Reads a shared file.
+
+        :param name: name of the file
+        :return: its content, empty if it does not exist
+        """
+        try:
+            with open(os.path.join(self.sim_dir, name)) as shared_file:
+                return json.load(shared_file)
+        except (OSError, ValueError):
+            return {}
+
+    def update(self, name: str, values: dict) -> None:
+        """
+        Updates a shared file.
+
+        :param name: name of the file
+        :param values: values to set
+        """
+        with self.__locked():
+            content = self.read(name)
+            content.update(values)
+            with open(os.path.join(self.sim_dir, name + ".tmp"), "w") as shared_file:
+                json.dump(content, shared_file)
+            os.replace(os.path.join(self.sim_dir, name + ".tmp"), os.path.join(self.sim_dir, name))
+
+
+def allocate_addresses(infrastructure: Infrastructure) -> dict:
+    """
+    Allocates a loopback address to every host of every instance.
+
+    :param infrastructure: parsed infrastructure description
+    :return: dictionary mapping instance name to the list of its host addresses
+    """
+    addresses = {}
+    for i, instance in enumerate(infrastructure):
+        total = instance.resolved_provider_arguments.get("total", 1)
+        total = total if isinstance(total, int) else 1
+        addresses.update({instance.name: ["127.{}.{}.{}".format(1 + (i >> 8), i & 255, host + 1)
+                                          for host in range(total)]})
+    return addresses
+
+
+class SSHSimulator:
+    """
+    A class answering SSH readiness probes of the simulated hosts.
+
+    A host accepts connections and sends an SSH banner once boot_latency passed since its module was applied,
+    until then connections are closed immediately.
+    """
+    def __init__(self, state: SimulationState, scenario: Scenario, addresses: dict, port: int) -> None:
+        """
+        SSHSimulator constructor.
+
+        :param state: simulation state, the apply times are read from it
+        :param scenario: the scenario
+        :param addresses: dictionary mapping module name to the list of its host addresses
+        :param port: SSH port of the hosts
+        """
+        self.state = state
+        self.scenario = scenario
+        self.addresses = addresses
+        self.port = port
+        self.__loop = None
+        self.__task = None
+        self.__thread = None
+        self.__started = threading.Event()
+
+    async def __handle(self, module: str, host: str, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter) -> None:
+        """
+        Answers a connection to the SSH port of a host.
+
+        :param module: module of the host
+        :param host: address of the host
+        :param reader: reader of the connection
+        :param writer: writer of the connection
+        """
+        applied = self.state.read("applied.json").get(module)
+        boot = self.scenario.latency(self.scenario.module(module).get("boot_latency"), host, "boot")
+        if applied is not None and time.time() >= applied + boot:
+            writer.write(b"SSH-2.0-RTIB_simulator\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def __serve(self) -> None:
+        """
+        Listens on the SSH port of every host until cancelled.
+        """
+        servers = []
+        for module, hosts in self.addresses.items():
+            for host in hosts:
+                servers.append(await asyncio.start_server(
+                    lambda reader, writer, module=module, host=host: self.__handle(module, host, reader, writer),
+                    host, self.port))
+        self.__started.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            for server in servers:
+                server.close()
+
+    def __run(self) -> None:
+        """
+        Runs the event loop of the simulated hosts in the simulator thread.
+        """
+        self.__loop = asyncio.new_event_loop()
+        self.__task = self.__loop.create_task(self.__serve())
+        try:
+            self.__loop.run_until_complete(self.__task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.__started.set()
+            self.__loop.close()
+
+    def __enter__(self) -> "SSHSimulator":
+        self.__thread = threading.Thread(target=self.__run, name="ssh-simulator", daemon=True)
+        self.__thread.start()
+        self.__started.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.__loop.call_soon_threadsafe(self.__task.cancel)
+        self.__thread.join()
+
+
+class Simulation:
+    """
+    A class running the real RTIB CLI against fake terraform and ansible-playbook binaries.
+
+    The CLI runs in a temporary directory laid out like the repository (providers, roles and callback
+    plugins are linked), with the fake binaries first on PATH. Hosts get loopback addresses and their
+    SSH readiness is simulated, see SSHSimulator.
+    """
+    fakes = {"terraform": "benchmarks.fake_terraform", "ansible-playbook": "benchmarks.fake_ansible"}
+
+    def __init__(self, scenario_path: str, cli_args: List[str] = None, command: List[str] = None,
+                 ssh_port: int = 2222) -> None:
+        """
+        Simulation constructor.
+
+        :param scenario_path: path of the scenario file
+        :param cli_args: options of the CLI, e.g. ["-j", "4"]
+        :param command: subcommand of the CLI and its arguments, e.g. ["rebuild", "interactive_c2"]
+        :param ssh_port: port the simulated hosts accept SSH connections on
+        """
+        self.scenario_path = os.path.abspath(scenario_path)
+        self.scenario = Scenario.load(scenario_path)
+        self.cli_args = list(cli_args or [])
+        self.command = list(command or [])
+        self.ssh_port = ssh_port
+        self.root = None
+        self.state = None
+        self.infrastructure = None
+
+    def __enter__(self) -> "Simulation":
+        self.root = tempfile.mkdtemp(prefix="rtib-sim-")
+        for directory in ("providers", "roles", "callback_plugins"):
+            os.symlink(os.path.join(ROOT, directory), os.path.join(self.root, directory))
+
+        sim_dir = os.path.join(self.root, ".simulator")
+        bin_dir = os.path.join(sim_dir, "bin")
+        os.makedirs(bin_dir)
+        shutil.copy(self.scenario.description_path, os.path.join(self.root, "description.yaml"))
+        with open(os.path.join(sim_dir, "scenario.yaml"), "w") as scenario_file:
+            yaml.safe_dump({**self.scenario.scenario, "description": os.path.join(self.root, "description.yaml")},
+                           scenario_file)
+        for binary, module in self.fakes.items():
+            with open(os.path.join(bin_dir, binary), "w") as fake_file:
+                fake_file.write('#!/bin/sh\nexec "{}" -m {} "$@"\n'.format(sys.executable, module))
+            os.chmod(os.path.join(bin_dir, binary), 0o755)
+
+        with open(os.path.join(self.root, "description.yaml")) as description_file:
+            self.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        self.state = SimulationState(sim_dir)
+        self.state.update("addresses.json", allocate_addresses(self.infrastructure))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def run(self, profile: str = None, verbose: bool = False) -> dict:
+        """
+        Runs the CLI once and measures its wall time.
+
+        :param profile: where the CLI writes its Chrome trace, no trace if None
+        :param verbose: if True, the CLI output is printed as it arrives
+        :return: dictionary with the exit code, wall time and last lines of the output
+        """
+        env = os.environ.copy()
+        env.update({"PATH": os.path.join(self.state.sim_dir, "bin") + os.pathsep + env.get("PATH", ""),
+                    "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+                    SIM_DIR_VARIABLE: self.state.sim_dir})
+        cmd = [sys.executable, os.path.join(ROOT, "cli.py"), "--ssh-port", str(self.ssh_port)] + self.cli_args
+        if profile is not None:
+            cmd += ["--profile", os.path.abspath(profile)]
+        cmd += ["description.yaml"] + self.command
+
+        tail = deque(maxlen=50)
+        with SSHSimulator(self.state, self.scenario, self.state.read("addresses.json"), self.ssh_port):
+            start = time.perf_counter()
+            with subprocess.Popen(cmd, cwd=self.root, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                  universal_newlines=True, bufsize=1) as process:
+                for line in process.stdout:
+                    tail.append(line.rstrip("\n"))
+                    if verbose:
+                        print(line, end="")
+            seconds = time.perf_counter() - start
+        return {"returncode": process.returncode, "seconds": seconds, "output": list(tail)}
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.argument("scenario", type=click.Path(exists=True, dir_okay=False))
+@click.argument("cli_args", nargs=-1, type=click.UNPROCESSED)
+@click.option("--command", help='Subcommand of the CLI with its arguments, e.g. "rebuild interactive_c2"')
+@click.option("--runs", default=1, show_default=True, help="Number of consecutive runs in the same directory")
+@click.option("--ssh-port", default=2222, show_default=True, help="Port the simulated hosts accept SSH on")
+@click.option("--profile", type=click.Path(dir_okay=False), help="Chrome trace of the last run")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), default="simulation.json", show_default=True,
+              help="Where to write the JSON results")
+@click.option("-v", "--verbose", is_flag=True, help="Print the CLI output")
+def main(scenario, cli_args, command, runs, ssh_port, profile, output, verbose):
+    """
+    Runs the RTIB CLI end to end against simulated Terraform, Ansible and hosts.
+
+    SCENARIO is the scenario file, CLI_ARGS are passed to the CLI before the description.
+    """
+    results = []
+    with Simulation(scenario, list(cli_args), command.split() if command else None, ssh_port) as simulation:
+        for run in range(runs):
+            result = simulation.run(profile if run == runs - 1 else None, verbose)
+            results.append(result)
+            print("RUN {}: EXIT CODE {} AFTER {:.2f} SECONDS".format(run + 1, result.get("returncode"),
+                                                                     result.get("seconds")))
+
+    with open(output, "w") as output_file:
+        json.dump({"time": time.time(), "scenario": os.path.abspath(scenario), "cli_args": list(cli_args),
+                   "command": command, "runs": results}, output_file, indent=2)
+    print("RESULTS WRITTEN TO {}".format(output))
+
+
+if __name__ == '__main__':
+    main()
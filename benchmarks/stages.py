@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import statistics
+import tracemalloc
+from typing import Callable, List
+
+import click
+
+from model import Infrastructure
+from validator import Validator
+from orchestrator import Orchestrator
+from manager import Manager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = (10, 100, 1000, 10000)
+PROVIDERS = ("aws", "openstack")
+ROLES = ("c2_server", "pipe_redirector", "rewrite_redirector")
+
+
+def generate_description(instances: int, providers: tuple = PROVIDERS, roles: tuple = ROLES,
+                         argument_size: int = 4, total: int = 1) -> dict:
+    """
+    Generates a synthetic infrastructure description.
+
+    Instances cycle through the roles and providers. Every redirector redirects to the C2 server
+    before it and every C2 server accepts connections from the redirector after it, so references
+    between instances are resolved like in a real engagement.
+
+    :param instances: number of instances
+    :param providers: providers the instances cycle through
+    :param roles: roles the instances cycle through
+    :param argument_size: number of additional role and provider arguments of every instance
+    :param total: number of hosts of every instance ("total" provider argument)
+    :return: infrastructure description
+    """
+    names = ["instance_{}".format(i) for i in range(instances)]
+    instance_list = []
+    for i, name in enumerate(names):
+        role = roles[i % len(roles)]
+        role_args = {"ansible_user": "debian", "accept_from": ["147.251.0.0/16"]}
+        role_args.update({"argument_{}".format(j): "value_{}".format(j) for j in range(argument_size)})
+        if role == "c2_server" and i + 1 < instances:
+            role_args.get("accept_from").append(names[i + 1])
+        elif role != "c2_server" and i > 0:
+            role_args.update({"redirect_to": names[i - 1], "redirect_ports": [80, 443]})
+        provider_args = {"total": total}
+        provider_args.update({"argument_{}".format(j): j for j in range(argument_size)})
+        instance_list.append({"name": name, "role": role, "provider": providers[i % len(providers)],
+                              "arguments": {"role": role_args, "provider": provider_args}})
+
+    return {"infrastructure": {"name": "benchmark_{}".format(instances),
+                               "global_arguments": {"role": {"attacker": "147.251.0.0/16"},
+                                                    "provider": {"network": "benchmark"}},
+                               "instances": instance_list}}
+
+
+def generate_outputs(description: dict) -> dict:
+    """
+    Generates canned "terraform output -json" of a synthetic description.
+
+    :param description: description generated by generate_description
+    :return: Terraform outputs keyed by module name, with unique addresses of all hosts
+    """
+    outputs = {}
+    address = 0
+    for instance in description.get("infrastructure").get("instances"):
+        hosts = []
+        for _ in range(instance.get("arguments").get("provider").get("total")):
+            address += 1
+            hosts.append("10.{}.{}.{}".format(address >> 16 & 255, address >> 8 & 255, address & 255))
+        outputs.update({instance.get("name"): {"sensitive": False,
+                                               "type": ["object", {"hosts": ["tuple", ["string"] * len(hosts)]}],
+                                               "value": {"hosts": hosts}}})
+    return outputs
+
+
+class StageBenchmark:
+    """
+    A class measuring the stages of the description -> Terraform -> inventory -> playbook path.
+
+    The stages run in an engagement directory laid out like the real one (roles and providers next to it),
+    with canned Terraform outputs instead of Terraform. Every stage is timed repeat times and its median
+    is reported, its peak memory is measured by tracemalloc in a separate run.
+    """
+    def __init__(self, description: dict, repeat: int = 3) -> None:
+        """
+        StageBenchmark constructor.
+
+        :param description: infrastructure description
+        :param repeat: number of timed runs of every stage
+        """
+        self.description = description
+        self.outputs = generate_outputs(description)
+        self.repeat = repeat
+
+    def stages(self, working_dir: str = ".") -> List[tuple]:
+        """
+        Builds the stages in the order they run in RTIB.
+
+        :param working_dir: infrastructure directory the stages write their files into
+        :return: list of tuples of a stage name and a function running it
+        """
+        infrastructure = Infrastructure(self.description)
+        validator = Validator(infrastructure, providers_dir=os.path.join(working_dir, "..", "providers"),
+                              roles_dir=os.path.join(working_dir, "..", "roles"))
+        orchestrator = Orchestrator(infrastructure, working_dir=working_dir)
+        manager = Manager(infrastructure, working_dir=working_dir)
+        inventory = {}
+
+        def add_variables() -> None:
+            inventory.update(manager._Manager__add_variables_to_inventory())
+
+        return [("model", lambda: Infrastructure(self.description)),
+                ("validate", validator.errors),
+                ("parse description", orchestrator._Orchestrator__parse_description),
+                ("create inventory", lambda: orchestrator._Orchestrator__create_inventory(self.outputs)),
+                ("add variables to inventory", add_variables),
+                ("compile firewall rulesets", lambda: manager._Manager__generate_rulesets(inventory)),
+                ("generate playbook", manager._Manager__generate_playbook),
+                ("host hashes", manager._Manager__host_hashes)]
+
+    def __measure(self, stage: Callable[[], object]) -> dict:
+        """
+        Measures a single stage.
+
+        :param stage: function running the stage
+        :return: dictionary with the median duration in seconds and the peak memory in kB
+        """
+        durations = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            stage()
+            durations.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            stage()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {"seconds": statistics.median(durations), "peak_kb": peak / 1024}
+
+    def run(self) -> dict:
+        """
+        Measures all stages.
+
+        :return: dictionary mapping stage name to its measurement
+        """
+        tmp_dir = tempfile.mkdtemp(prefix="rtib-bench-")
+        try:
+            for directory in ("roles", "providers"):
+                os.symlink(os.path.join(ROOT, directory), os.path.join(tmp_dir, directory))
+            os.makedirs(os.path.join(tmp_dir, "engagement"))
+            return {name: self.__measure(stage) for name, stage in self.stages(os.path.join(tmp_dir, "engagement"))}
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def benchmark(sizes: List[int], repeat: int = 3, argument_size: int = 4, total: int = 1) -> dict:
+    """
+    Measures all stages at every description size.
+
+    :param sizes: numbers of instances
+    :param repeat: number of timed runs of every stage
+    :param argument_size: number of additional role and provider arguments of every instance
+    :param total: number of hosts of every instance
+    :return: dictionary mapping stage name to a dictionary mapping size (a string, as in JSON) to the measurement
+    """
+    results = {}
+    for size in sizes:
+        description = generate_description(size, argument_size=argument_size, total=total)
+        for stage, measurement in StageBenchmark(description, repeat).run().items():
+            results.setdefault(stage, {}).update({str(size): measurement})
+    return results
+
+
+def regressions(results: dict, baseline: dict, threshold: float, min_seconds: float = 0.005) -> List[str]:
+    """
+    Compares results with a baseline run.
+
+    Durations shorter than min_seconds in both runs are noise and are not compared.
+
+    :param results: current results
+    :param baseline: results of the baseline run
+    :param threshold: allowed relative growth, e.g. 0.2 for 20 %
+    :param min_seconds: durations compared at least
+    :return: descriptions of regressions, empty if there are none
+    """
+    problems = []
+    for stage, sizes in results.items():
+        for size, measurement in sizes.items():
+            old = (baseline.get(stage) or {}).get(size)
+            if old is None:
+                continue
+            for metric, floor in (("seconds", min_seconds), ("peak_kb", 0)):
+                if max(measurement.get(metric), old.get(metric)) < floor:
+                    continue
+                if measurement.get(metric) > old.get(metric) * (1 + threshold):
+                    problems.append("{} at {} instances: {} {:.4g} -> {:.4g} ({:+.0%})".format(
+                        stage, size, metric, old.get(metric), measurement.get(metric),
+                        measurement.get(metric) / (old.get(metric) or 1e-9) - 1))
+    return problems
+
+
+@click.command()
+@click.option("-n", "--instances", "sizes", multiple=True, type=int, default=SIZES,
+              help="Number of instances of a synthetic description, 10, 100, 1000 and 10000 by default")
+@click.option("--repeat", default=3, show_default=True, help="Timed runs of every stage, the median is reported")
+@click.option("--argument-size", default=4, show_default=True, help="Additional arguments of every instance")
+@click.option("--total", default=1, show_default=True, help="Hosts of every instance")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), default="stages.json", show_default=True,
+              help="Where to write the JSON results")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="Results to compare with")
+@click.option("--threshold", default=0.2, show_default=True,
+              help="Allowed relative growth of a duration or peak memory over the baseline")
+def main(sizes, repeat, argument_size, total, output, baseline, threshold):
+    """
+    Measures duration and peak memory of the validation, orchestration and management stages.
+
+    Exits with status 1 if a stage regressed beyond the threshold compared to the baseline.
+    """
+    results = benchmark(list(sizes), repeat, argument_size, total)
+    for stage, measurements in results.items():
+        print("{:<28}".format(stage) + "".join("{:>8}: {:8.4f} s {:9.0f} kB".format(size, m.get("seconds"),
+                                                                                  m.get("peak_kb"))
+                                               for size, m in measurements.items()))
+
+    with open(output, "w") as output_file:
+        json.dump({"time": time.time(), "python": platform.python_version(), "platform": platform.platform(),
+                   "results": results}, output_file, indent=2)
+    print("RESULTS WRITTEN TO {}".format(output))
+
+    if baseline:
+        with open(baseline) as baseline_file:
+            problems = regressions(results, json.load(baseline_file).get("results"), threshold)
+        for problem in problems:
+            print("REGRESSION: {}".format(problem))
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    callback: rtib_events
+    short_description: Ansible screen output as a stream of JSON events
+    description:
+        - Writes one JSON object per line for every play, task start and task result per host,
+          so the output can be parsed while the playbook runs (see events.py)
+    type: stdout
+    requirements:
+      - Set as stdout in config
+'''
+
+import json
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'stdout'
+    CALLBACK_NAME = 'rtib_events'
+
+    def __init__(self, display=None):
+        super(CallbackModule, self).__init__(display)
+        self.play = None
+        self.started = {}  # (host, task uuid) -> start time
+
+    def _emit(self, event, **fields):
+        fields.update({'event': event, 'time': time.time(), 'play': self.play})
+        self._display.display(json.dumps(fields, sort_keys=True, default=str))
+
+    def _result(self, event, result):
+        host = result._host.get_name()
+        started = self.started.pop((host, result._task._uuid), None)
+        duration = time.time() - started if started is not None else None
+        message = result._result.get('msg') or result._result.get('stderr') or None
+        self._emit(event, host=host, task=result._task.get_name(), duration=duration,
+                   msg=message if event in ('task_failed', 'host_unreachable') else None)
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name()
+        self._emit('play_start')
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._emit('task_start', task=task.get_name())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._emit('task_start', task=task.get_name())
+
+    def v2_runner_on_start(self, host, task):
+        self.started[(host.get_name(), task._uuid)] = time.time()
+
+    def v2_runner_on_ok(self, result):
+        self._result('task_changed' if result._result.get('changed') else 'task_ok', result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._result('task_ignored' if ignore_errors else 'task_failed', result)
+
+    def v2_runner_on_skipped(self, result):
+        self._result('task_skipped', result)
+
+    def v2_runner_on_unreachable(self, result):
+        self._result('host_unreachable', result)
+
+    def v2_playbook_on_stats(self, stats):
+        for host in sorted(stats.processed):
+            self._emit('host_stats', host=host, msg=stats.summarize(host))
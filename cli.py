@@ -1,5 +1,4 @@
 import os
-import time
 import yaml
 from pathlib import Path
 
@@ -8,26 +7,156 @@ import click
 from orchestrator import Orchestrator
 from manager import Manager
 from validator import Validator
+from readiness import ReadinessProber
+from pipeline import Pipeline
+from model import Infrastructure
+from profiler import Profiler
+from keys import KEY_TYPES
+from daemon import Daemon
 
 
 class CLI:
-    def __init__(self, infrastructure_description_file, verbose):
-        self.infrastructure_description = self.read_infrastructure_description(infrastructure_description_file)
-        self.validator = Validator(self.infrastructure_description)
-        self.orchestrator = Orchestrator(self.infrastructure_description, verbose)
-        self.manager = Manager(self.infrastructure_description, verbose)
+    def __init__(self, infrastructure_description_file, verbose, boot_timeout=300, probe="banner", jobs=1,
+                 shard_by=None, tf_workers=4, plugin_cache=None, provider_mirror=None, force=False, profile=None,
+                 ssh_port=22, refresh=True, key_type="ed25519", root="."):
+        self.profiler = Profiler(enabled=profile is not None)
+        self.profile = profile
+        self.description_path = os.path.abspath(infrastructure_description_file)
+        with self.profiler.span("read description", "cli"):
+            self.infrastructure = Infrastructure(self.read_infrastructure_description(infrastructure_description_file))
+        self.root = root
+        self.validator = Validator(self.infrastructure, self.profiler, os.path.join(root, "providers"),
+                                   os.path.join(root, "roles"))
+        # an unnamed description fails validation before anything is written
+        self.working_dir = os.path.join(root, self.infrastructure.name or "")
+        self.orchestrator = Orchestrator(self.infrastructure, verbose, shard_by, tf_workers, plugin_cache,
+                                         provider_mirror, self.profiler, refresh, key_type, self.working_dir)
+        self.manager = Manager(self.infrastructure, verbose, jobs, force, self.profiler, self.working_dir)
+        self.boot_timeout = boot_timeout
+        self.probe = probe
+        self.ssh_port = ssh_port
 
     @staticmethod
     def read_infrastructure_description(infrastructure_description):
         with open(infrastructure_description) as description:
             return yaml.safe_load(description)
 
+    def run_pipeline(self, workers):
+        """
+        Runs orchestration and management as a pipeline and prints per-module timings.
+
+        :param workers: maximum number of modules configured at once
+        """
+        pipeline = Pipeline(self.orchestrator, self.manager, workers, self.boot_timeout, self.probe, self.ssh_port)
+        for module, timing in pipeline.run().items():
+            print("{} APPLIED AFTER {:.1f}, READY AFTER {:.1f}, CONFIGURED AFTER {:.1f} SECONDS".format(
+                module, timing.get("applied"), timing.get("ready"), timing.get("configured")))
+
+    def plan(self):
+        """
+        Saves a Terraform plan of the infrastructure and prints the modules it changes.
+        """
+        changes = self.orchestrator.plan_infrastructure()
+        for module, actions in changes.items():
+            print("{} WILL BE CHANGED: {}".format(module, ", ".join(actions)))
+        if not changes:
+            print("NO CHANGES PLANNED")
+
+    def orchestrate(self):
+        """
+        Runs configuration orchestration and notes whether a saved plan was used.
+
+        :return: True if infrastructure changed, False otherwise
+        """
+        changed = self.orchestrator.orchestrate_infrastructure()
+        if self.orchestrator.applied_plan:
+            print("SAVED PLAN USED")
+        return changed
+
+    def manage(self, limit=None, force=False):
+        """
+        Runs configuration management and prints the critical path of scheduled plays.
+
+        :param limit: names of inventory groups to configure, all groups if None
+        :param force: if True, hosts are configured even if they did not change
+        """
+        self.manager.manage(limit, force)
+        if not self.manager.configured_hosts:
+            print("ALL HOSTS UP TO DATE, NOTHING TO CONFIGURE")
+        if self.manager.critical_path is not None:
+            path, seconds = self.manager.critical_path
+            print("CRITICAL PATH: {} ({:.1f} SECONDS)".format(" -> ".join(path), seconds))
+
+    def wait_for_hosts(self, groups=None):
+        """
+        Waits until hosts in the inventory accept SSH connections and prints their time-to-ready.
+
+        :param groups: names of inventory groups to wait for, all groups if None
+        """
+        prober = ReadinessProber(self.manager.inventory_path, timeout=self.boot_timeout, mode=self.probe,
+                                 port=self.ssh_port)
+        with self.profiler.span("wait for hosts", "readiness", groups=groups):
+            ready = prober.wait(groups)
+        for host, seconds in sorted(ready.items(), key=lambda item: item[1]):
+            print("{} READY AFTER {:.1f} SECONDS".format(host, seconds))
+
+    def watch(self, debounce, interval, reconcile=True):
+        """
+        Keeps the infrastructure reconciled with its description until interrupted, see Daemon.
+
+        :param debounce: seconds the description must stay unchanged before it is reconciled
+        :param interval: seconds between two checks of the description
+        :param reconcile: if True, the whole description is reconciled first
+        """
+        daemon = Daemon(self.orchestrator, self.manager, self.description_path, self.boot_timeout, self.probe,
+                        self.ssh_port, debounce, interval, os.path.join(self.root, "providers"),
+                        os.path.join(self.root, "roles"))
+        print("WATCHING {}, COMMANDS ON {}".format(self.description_path, os.path.abspath(daemon.socket_path)))
+        try:
+            daemon.serve(reconcile)
+        except KeyboardInterrupt:
+            pass
+        print("WATCH STOPPED")
+
+    def write_profile(self):
+        """
+        Writes the recorded timing spans into the profile file, if profiling is on.
+        """
+        if self.profile is not None:
+            self.profiler.write(self.profile)
+            print("PROFILE WRITTEN TO {}".format(self.profile))
+
 
 @click.group(invoke_without_command=True)
 @click.option("-v", "--verbose", is_flag=True, help="Print terraform and ansible outputs")
+@click.option("--boot-timeout", default=300, show_default=True,
+              help="Seconds each host is given to accept SSH connections after orchestration")
+@click.option("--probe", type=click.Choice(ReadinessProber.modes), default="banner", show_default=True,
+              help="How hosts are checked for SSH readiness")
+@click.option("--ssh-port", default=22, show_default=True, help="SSH port probed for readiness")
+@click.option("--no-refresh", is_flag=True,
+              help="Do not refresh the Terraform state before planning, faster but misses out-of-band changes")
+@click.option("--key-type", type=click.Choice(KEY_TYPES), default="ed25519", show_default=True,
+              help="Type of SSH keys generated for new hosts, existing keys are kept")
+@click.option("-j", "--jobs", default=1, show_default=True,
+              help="Maximum number of plays run at once, independent plays run concurrently if greater than 1")
+@click.option("--shard-by", type=click.Choice(Orchestrator.shard_modes),
+              help="Keep a separate Terraform state per instance or per provider and apply them concurrently")
+@click.option("--tf-workers", default=4, show_default=True, help="Maximum number of shards applied at once")
+@click.option("--plugin-cache", type=click.Path(file_okay=False, resolve_path=True),
+              help="Provider plugin cache directory shared by all infrastructures")
+@click.option("--provider-mirror", type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help="Local filesystem mirror to install providers from instead of downloading them")
+@click.option("--force", is_flag=True, help="Configure all hosts, even those that did not change since their last run")
+@click.option("--pipeline", is_flag=True, help="Configure every module as soon as it is applied")
+@click.option("--workers", default=4, show_default=True,
+              help="Maximum number of modules configured at once in pipeline mode")
+@click.option("--profile", type=click.Path(dir_okay=False, resolve_path=True),
+              help="Record timings of all phases and write them into this Chrome trace JSON file")
 @click.argument("infrastructure", type=click.Path(exists=True))
 @click.pass_context
-def main(ctx, infrastructure, verbose):
+def main(ctx, infrastructure, verbose, boot_timeout, probe, jobs, shard_by, tf_workers, plugin_cache, provider_mirror,
+         force, pipeline, workers, profile, ssh_port, no_refresh, key_type):
     """
     Tool for configuration orchestration (terraform) and management (ansible).
 
@@ -35,25 +164,27 @@ def main(ctx, infrastructure, verbose):
 
     INFRASTRUCTURE is the name of the file that contains infrastructure description.
     """
-    ctx.obj = CLI(infrastructure, verbose)
+    ctx.obj = CLI(infrastructure, verbose, boot_timeout, probe, jobs, shard_by, tf_workers, plugin_cache,
+                  provider_mirror, force, profile, ssh_port, not no_refresh, key_type)
+    ctx.call_on_close(ctx.obj.write_profile)  # also written when a phase fails
     if ctx.invoked_subcommand != "validate":
 
         ctx.obj.validator.validate()
         print("VALIDATION OK")
 
-        working_dir = ctx.obj.infrastructure_description.get("infrastructure").get("name")
-        Path(working_dir).mkdir(exist_ok=True)
-        Path(working_dir + "/ssh_keys").mkdir(exist_ok=True, mode=0o700)
-        os.chdir(working_dir)
-        ctx.obj.manager.inventory_path = os.getcwd() + "/hosts.yaml"
+        Path(ctx.obj.working_dir).mkdir(exist_ok=True)
+
+    if ctx.invoked_subcommand is None and pipeline:
+        ctx.obj.run_pipeline(workers)
+        print("CONFIGURATION ORCHESTRATION AND MANAGEMENT DONE")
 
-    if ctx.invoked_subcommand is None:
-        if ctx.obj.orchestrator.orchestrate_infrastructure():
-            print("WAITING 60 SECONDS FOR MACHINES TO BOOT...")
-            time.sleep(60)
+    elif ctx.invoked_subcommand is None:
+        if ctx.obj.orchestrate():
+            print("WAITING FOR MACHINES TO BOOT...")
+            ctx.obj.wait_for_hosts()
         print("CONFIGURATION ORCHESTRATION DONE")
 
-        ctx.obj.manager.manage()
+        ctx.obj.manage()
         print("CONFIGURATION MANAGEMENT DONE")
 
 
@@ -73,10 +204,42 @@ def orchestrate(cli_obj):
     """
     Runs configuration orchestration (terraform)
     """
-    cli_obj.orchestrator.orchestrate_infrastructure()
+    cli_obj.orchestrate()
     print("CONFIGURATION ORCHESTRATION DONE")
 
 
+@main.command()
+@click.pass_obj
+def plan(cli_obj):
+    """
+    Saves a Terraform plan and shows the modules it changes
+
+    The next orchestration applies the saved plan without planning again,
+    as long as the description and Terraform state did not change since.
+    """
+    if cli_obj.orchestrator.shard_by is not None:
+        raise click.UsageError("plan cannot be used with --shard-by, unchanged shards are not planned at all")
+    cli_obj.plan()
+    print("PLAN SAVED")
+
+
+@main.command()
+@click.option("--debounce", default=1.0, show_default=True,
+              help="Seconds the description must stay unchanged before it is reconciled")
+@click.option("--interval", default=0.5, show_default=True, help="Seconds between two checks of the description")
+@click.option("--no-reconcile", is_flag=True, help="Do not reconcile the whole infrastructure on start")
+@click.pass_obj
+def watch(cli_obj, debounce, interval, no_reconcile):
+    """
+    Keeps the infrastructure reconciled with its description
+
+    Every edit of the description is diffed against the last reconciled one, only modules of changed
+    instances are applied and only affected hosts are configured. Commands (status, validate, reconcile,
+    rebuild, stop) are served on ".rtib.sock" in the infrastructure directory, see "python daemon.py --help".
+    """
+    cli_obj.watch(debounce, interval, not no_reconcile)
+
+
 @main.command()
 @click.argument("inventory_file")
 @click.pass_obj
@@ -84,8 +247,8 @@ def manage(cli_obj, inventory_file):
     """
     Runs configuration management (ansible)
     """
-    cli_obj.manager.inventory_path = "../" + inventory_file
-    cli_obj.manager.manage()
+    cli_obj.manager.inventory_path = inventory_file
+    cli_obj.manage()
     print("CONFIGURATION MANAGEMENT DONE")
 
 
@@ -105,12 +268,14 @@ def destroy(cli_obj):
 def rebuild(cli_obj, instance):
     """
     Rebuilds a single instance in the infrastructure
+
+    Only the instance and instances referencing it via "redirect_to" or "accept_from" are configured.
     """
     cli_obj.orchestrator.rebuild_instance(instance)
     print("REBUILD DONE")
-    print("WAITING 60 SECONDS FOR MACHINES TO BOOT...")
-    time.sleep(60)
-    cli_obj.manager.manage()
+    print("WAITING FOR MACHINES TO BOOT...")
+    cli_obj.wait_for_hosts([instance])
+    cli_obj.manage([instance] + sorted(cli_obj.infrastructure.referencing(instance)), force=True)
     print("CONFIGURATION MANAGEMENT DONE")
 
 
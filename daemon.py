@@ -0,0 +1,358 @@
+import os
+import json
+import time
+import socket
+import threading
+import socketserver
+
+import click
+import yaml
+
+from orchestrator import Orchestrator
+from manager import Manager
+from validator import Validator
+from readiness import ReadinessProber
+from model import Infrastructure, diff
+
+
+def request(socket_path: str, command: str, **arguments) -> dict:
+    """
+    Sends a command to a running Daemon and waits for its reply.
+
+    :param socket_path: path to the Unix socket of the daemon
+    :param command: "status", "validate", "reconcile", "rebuild" (with instance) or "stop"
+    :param arguments: arguments of the command
+    :return: reply of the daemon, with "ok" set to False and "error" set on failure
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(dict(arguments, command=command)).encode() + b"\n")
+        with client.makefile("rb") as reply_file:
+            return json.loads(reply_file.readline())
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handler of a connection to the daemon socket, every line is a JSON command answered by a JSON line.
+    """
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                arguments = json.loads(line)
+                reply = self.server.daemon.handle(arguments.pop("command", None), **arguments)
+            except Exception as error:  # the daemon outlives failed commands
+                reply = {"ok": False, "error": "{}: {}".format(type(error).__name__, error)}
+            self.wfile.write(json.dumps(reply, default=str).encode() + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """
+    A class keeping an infrastructure reconciled with its description.
+
+    The parsed description, the Orchestrator (with its cached Terraform state view and init hash) and
+    the Manager (with its ledger) stay in memory. Edits of the description are debounced and diffed
+    against the last reconciled description instance by instance, see model.diff, so only the affected
+    modules are applied and only the affected hosts are configured.
+
+    Commands are served over a Unix socket in the infrastructure directory, see request.
+    Terraform and Ansible runs are serialized, status is answered while they run.
+    """
+    socket_path = ".rtib.sock"
+    commands = ("status", "validate", "reconcile", "rebuild", "stop")
+
+    def __init__(self, orchestrator: Orchestrator, manager: Manager, description_path: str,
+                 boot_timeout: float = 300.0, probe: str = "banner", ssh_port: int = 22, debounce: float = 1.0,
+                 interval: float = 0.5, providers_dir: str = None, roles_dir: str = None) -> None:
+        """
+        Daemon constructor.
+
+        :param orchestrator: Orchestrator of the infrastructure, its description is the reconciled one
+        :param manager: Manager of the infrastructure, its inventory_path must be set
+        :param description_path: path to the watched infrastructure description file
+        :param boot_timeout: number of seconds each host is given to accept SSH connections
+        :param probe: readiness probe mode, see ReadinessProber
+        :param ssh_port: SSH port probed for readiness
+        :param debounce: number of seconds the description must stay unchanged before it is reconciled
+        :param interval: number of seconds between two checks of the description file
+        :param providers_dir: directory with provider modules used in validation, not checked if None
+        :param roles_dir: directory with Ansible roles used in validation, not checked if None
+        """
+        self.orchestrator = orchestrator
+        self.manager = manager
+        self.description_path = os.path.abspath(description_path)
+        self.boot_timeout = boot_timeout
+        self.probe = probe
+        self.ssh_port = ssh_port
+        self.debounce = debounce
+        self.interval = interval
+        self.providers_dir = providers_dir
+        self.roles_dir = roles_dir
+        self.socket_path = os.path.join(manager.working_dir, self.socket_path)
+        self.infrastructure = orchestrator.infrastructure
+        self.status = {"state": "starting", "reconciles": 0, "last_reconcile": None, "changes": None,
+                       "configured_hosts": None, "errors": []}
+        self.__lock = threading.Lock()  # serializes Terraform and Ansible runs
+        self.__status_lock = threading.Lock()
+        self.__stop = threading.Event()
+
+    def __signature(self) -> tuple:
+        """
+        Returns the modification time and size of the description file.
+
+        :return: tuple of mtime and size, None if the file does not exist
+        """
+        try:
+            stat = os.stat(self.description_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def __update_status(self, **fields) -> None:
+        with self.__status_lock:
+            self.status.update(fields)
+
+    def load(self) -> tuple:
+        """
+        Reads and validates the description file.
+
+        :return: tuple of the parsed description and the list of its problems, the description is None
+                 if the file cannot be read
+        """
+        try:
+            with open(self.description_path) as description_file:
+                infrastructure = Infrastructure(yaml.safe_load(description_file))
+        except (OSError, yaml.YAMLError) as error:
+            return None, [str(error)]
+        return infrastructure, Validator(infrastructure, self.orchestrator.profiler, self.providers_dir,
+                                         self.roles_dir).errors()
+
+    def __wait_for_hosts(self, groups: list = None) -> None:
+        """
+        Waits until hosts of the groups accept SSH connections.
+
+        :param groups: names of inventory groups to wait for, all groups if None
+        """
+        prober = ReadinessProber(self.manager.inventory_path, timeout=self.boot_timeout, mode=self.probe,
+                                 port=self.ssh_port)
+        with self.orchestrator.profiler.span("wait for hosts", "readiness", groups=groups):
+            prober.wait(groups)
+
+    def reconcile(self, infrastructure: Infrastructure = None) -> dict:
+        """
+        Applies and configures the changes of a description against the last reconciled one.
+
+        The description becomes the reconciled one only if both steps succeed, so a failed reconcile
+        is retried with the next one.
+
+        :param infrastructure: the new description, the whole reconciled description is applied and configured if None
+        :raises TerraformError: when Terraform error occurs
+        :raises ReadinessError: when applied hosts do not accept SSH connections in time
+        :raises AnsibleError: when Ansible error occurs
+        :return: the changes, see model.diff, None if the whole description was reconciled
+        """
+        with self.__lock:
+            start = time.monotonic()
+            self.__update_status(state="reconciling")
+            try:
+                if infrastructure is None:
+                    infrastructure = self.infrastructure
+                    changes = None
+                else:
+                    changes = diff(self.infrastructure, infrastructure)
+                self.orchestrator.infrastructure = self.manager.infrastructure = infrastructure
+
+                if changes is None:
+                    if self.orchestrator.orchestrate_infrastructure():
+                        self.__wait_for_hosts()
+                    self.manager.manage()
+                else:
+                    applied = sorted(changes.get("apply"))
+                    if self.orchestrator.orchestrate_instances(applied, sorted(changes.get("removed"))) and applied:
+                        self.__wait_for_hosts(applied)
+                    if changes.get("configure"):
+                        self.manager.manage(sorted(changes.get("configure")))
+                    else:
+                        self.manager.configured_hosts = []
+            except Exception as error:
+                self.orchestrator.infrastructure = self.manager.infrastructure = self.infrastructure
+                self.__update_status(state="failed", errors=["{}: {}".format(type(error).__name__, error)])
+                raise
+
+            self.infrastructure = infrastructure
+            self.__update_status(state="idle", reconciles=self.status.get("reconciles") + 1, errors=[],
+                                 last_reconcile={"time": time.time(), "seconds": round(time.monotonic() - start, 3)},
+                                 changes={key: sorted(names) for key, names in changes.items()}
+                                 if changes is not None else None,
+                                 configured_hosts=self.manager.configured_hosts)
+            return changes
+
+    def reload(self) -> dict:
+        """
+        Reads the description file and reconciles its changes, an invalid description is not applied.
+
+        :return: the changes, see model.diff, None if the description is invalid or nothing changed
+        """
+        infrastructure, errors = self.load()
+        if errors:
+            self.__update_status(errors=errors)
+            return None
+        changes = diff(self.infrastructure, infrastructure)
+        if not any(changes.values()):
+            self.infrastructure = infrastructure  # e.g. only comments changed
+            self.__update_status(errors=[])
+            return None
+        return self.reconcile(infrastructure)
+
+    def rebuild(self, instance: str) -> list:
+        """
+        Rebuilds an instance and configures it and the instances referencing it.
+
+        :param instance: name of the instance
+        :raises ValueError: when there is no such instance in the reconciled description
+        :return: list of configured hosts
+        """
+        if instance not in self.infrastructure:
+            raise ValueError("Unknown instance: {}".format(instance))
+        with self.__lock:
+            self.orchestrator.rebuild_instance(instance)
+            self.__wait_for_hosts([instance])
+            self.manager.manage([instance] + sorted(self.infrastructure.referencing(instance)), force=True)
+            return self.manager.configured_hosts
+
+    def __inventory(self) -> dict:
+        """
+        Reads the hosts of the inventory file.
+
+        :return: dictionary mapping group name to the list of its hosts
+        """
+        try:
+            with open(self.manager.inventory_path) as inventory_file:
+                children = yaml.safe_load(inventory_file).get("all").get("children")
+        except (OSError, TypeError, AttributeError, yaml.YAMLError):
+            return {}
+        return {group: list(group_dict.get("hosts") or {}) for group, group_dict in children.items()}
+
+    def handle(self, command: str, **arguments) -> dict:
+        """
+        Runs a command received over the socket.
+
+        :param command: "status", "validate", "reconcile", "rebuild" (with instance) or "stop"
+        :param arguments: arguments of the command
+        :return: reply, "ok" is False and "error" is set when the command failed
+        """
+        if command == "status":
+            with self.__status_lock:
+                status = dict(self.status)
+            status.update({"infrastructure": self.infrastructure.name, "description": self.description_path,
+                           "instances": list(self.infrastructure.names), "hosts": self.__inventory()})
+            return dict(status, ok=True)
+        if command == "validate":
+            infrastructure, errors = self.load()
+            return {"ok": not errors, "errors": errors,
+                    "changes": {key: sorted(names) for key, names in diff(self.infrastructure, infrastructure).items()}
+                    if infrastructure is not None else None}
+        if command == "reconcile":
+            changes = self.reload()
+            with self.__status_lock:
+                errors = list(self.status.get("errors"))
+            return {"ok": not errors, "errors": errors,
+                    "changes": {key: sorted(names) for key, names in changes.items()} if changes else None}
+        if command == "rebuild":
+            return {"ok": True, "configured_hosts": self.rebuild(arguments.get("instance"))}
+        if command == "stop":
+            self.stop()
+            return {"ok": True}
+        return {"ok": False, "error": "Unknown command: {}, use one of {}".format(command, ", ".join(self.commands))}
+
+    def watch(self) -> None:
+        """
+        Reconciles the description every time it changes, until stop is called.
+
+        A change is reconciled once the file stayed unchanged for debounce seconds, so editors writing
+        the file in several steps trigger a single reconcile. Failed reconciles are kept in status.
+        """
+        signature = self.__signature()
+        while not self.__stop.wait(self.interval):
+            current = self.__signature()
+            if current == signature:
+                continue
+            while not self.__stop.wait(self.debounce):
+                settled = self.__signature()
+                if settled == current:
+                    break
+                current = settled
+            signature = current
+            if self.__stop.is_set():
+                break
+            try:
+                changes = self.reload()
+            except Exception as error:  # the next edit is diffed against the last reconciled description
+                print("RECONCILE FAILED: {}: {}".format(type(error).__name__, error))
+                continue
+            if changes is not None:
+                print("RECONCILED: {} APPLIED, {} REMOVED, {} CONFIGURED".format(
+                    *(", ".join(sorted(changes.get(key))) or "NOTHING" for key in ("apply", "removed", "configure"))))
+            elif self.status.get("errors"):
+                print("INVALID DESCRIPTION, NOT RECONCILED:\n{}".format("\n".join(self.status.get("errors"))))
+
+    def stop(self) -> None:
+        """
+        Stops watching, the socket is closed once watch returns.
+        """
+        self.__stop.set()
+
+    def serve(self, reconcile: bool = True) -> None:
+        """
+        Serves commands over the Unix socket and watches the description until stopped.
+
+        :param reconcile: if True, the whole description is reconciled first
+        """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left behind by a daemon that did not stop cleanly
+        server = _Server(self.socket_path, _RequestHandler)
+        server.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            if reconcile:
+                try:
+                    self.reconcile()
+                except Exception as error:  # kept in status, the next edit reconciles the changes only
+                    print("RECONCILE FAILED: {}: {}".format(type(error).__name__, error))
+            else:
+                self.__update_status(state="idle")
+            self.watch()
+        finally:
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+@click.command()
+@click.argument("socket_path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("command", type=click.Choice(Daemon.commands))
+@click.argument("instance", required=False)
+def main(socket_path, command, instance):
+    """
+    Sends COMMAND to the daemon started by "cli.py INFRASTRUCTURE watch".
+
+    SOCKET_PATH is the ".rtib.sock" file in the infrastructure directory.
+    INSTANCE is the instance to rebuild.
+    """
+    if command == "rebuild" and instance is None:
+        raise click.UsageError("rebuild requires INSTANCE")
+    arguments = {"instance": instance} if instance is not None else {}
+    reply = request(socket_path, command, **arguments)
+    print(yaml.safe_dump(reply, default_flow_style=False, sort_keys=False), end="")
+    if not reply.get("ok"):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
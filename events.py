@@ -0,0 +1,152 @@
+import json
+import subprocess
+from datetime import datetime
+from collections import deque, Counter
+from typing import Callable, Iterator, NamedTuple, Optional
+
+
+class TerraformEvent(NamedTuple):
+    """
+    Event parsed from Terraform machine-readable UI ("-json").
+    """
+    type: str  # e.g. "planned_change", "apply_start", "apply_complete", "apply_errored", "diagnostic"
+    timestamp: str = None
+    level: str = None  # "info", "warn" or "error"
+    resource: str = None
+    module: str = None
+    action: str = None  # "create", "update", "delete", "replace", "read", "noop"
+    elapsed: float = None
+    message: str = None
+
+    def seconds(self) -> Optional[float]:
+        """
+        Converts the timestamp of the event to seconds since the epoch.
+
+        :return: seconds since the epoch, None if the event has no timestamp
+        """
+        if not self.timestamp:
+            return None
+        return datetime.fromisoformat(self.timestamp.replace("Z", "+00:00")).timestamp()
+
+
+class AnsibleEvent(NamedTuple):
+    """
+    Event emitted by the "rtib_events" Ansible callback plugin.
+    """
+    type: str  # "play_start", "task_start", "task_ok", "task_changed", "task_failed", "host_unreachable", ...
+    time: float = None
+    host: str = None
+    play: str = None
+    task: str = None
+    duration: float = None
+    message: object = None  # error message of failures, recap counts of "host_stats"
+
+
+def parse_terraform_event(line: str) -> Optional[TerraformEvent]:
+    """
+    Parses a line of Terraform machine-readable UI.
+
+    :param line: line of "terraform apply -json" output
+    :return: parsed event, None if the line is not a JSON message
+    """
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(message, dict) or "type" not in message:
+        return None
+
+    hook = message.get("hook") or message.get("change") or {}  # "change" of planned_change messages
+    resource = hook.get("resource") or {}
+    diagnostic = message.get("diagnostic") or {}
+    text = message.get("@message")
+    if diagnostic:
+        text = "{}: {}".format(diagnostic.get("summary"), diagnostic.get("detail") or "").rstrip(": ")
+
+    return TerraformEvent(type=message.get("type"),
+                          timestamp=message.get("@timestamp"),
+                          level=message.get("@level"),
+                          resource=resource.get("addr") or diagnostic.get("address"),
+                          module=resource.get("module") or None,
+                          action=hook.get("action"),
+                          elapsed=hook.get("elapsed_seconds"),
+                          message=text)
+
+
+def parse_ansible_event(line: str) -> Optional[AnsibleEvent]:
+    """
+    Parses a line written by the "rtib_events" Ansible callback plugin.
+
+    :param line: line of ansible-playbook output
+    :return: parsed event, None if the line was not written by the plugin
+    """
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(message, dict) or "event" not in message:
+        return None
+
+    return AnsibleEvent(type=message.get("event"),
+                        time=message.get("time"),
+                        host=message.get("host"),
+                        play=message.get("play"),
+                        task=message.get("task"),
+                        duration=message.get("duration"),
+                        message=message.get("msg"))
+
+
+class EventStream:
+    """
+    A class running a command and parsing its output into events line by line.
+
+    Only the last lines that are not events are kept, so memory stays flat on long runs.
+    """
+    def __init__(self, cmd, parser: Callable[[str], object], env: dict = None, cwd: str = None,
+                 shell: bool = False, tail: int = 50) -> None:
+        """
+        EventStream constructor.
+
+        :param cmd: command to run, a string if shell is True, a list otherwise
+        :param parser: function parsing a line into an event, returning None for other lines
+        :param env: environment of the command
+        :param cwd: working directory of the command
+        :param shell: if True, the command is run by the shell
+        :param tail: number of last non-event lines to keep
+        """
+        self.cmd = cmd
+        self.parser = parser
+        self.env = env
+        self.cwd = cwd
+        self.shell = shell
+        self.tail = deque(maxlen=tail)
+        self.counts = Counter()
+        self.returncode = None
+
+    def __iter__(self) -> Iterator:
+        """
+        Runs the command and yields events as its output arrives.
+
+        After the iteration ends, returncode holds the exit status of the command.
+
+        :return: iterator over parsed events
+        """
+        with subprocess.Popen(self.cmd, shell=self.shell, env=self.env, cwd=self.cwd, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1) as process:
+            for line in process.stdout:
+                event = self.parser(line)
+                if event is None:
+                    if line.strip():
+                        self.tail.append(line.rstrip("\n"))
+                    continue
+                self.counts.update([event.type])
+                yield event
+        self.returncode = process.returncode
+
+    def output(self) -> str:
+        """
+        Returns the last lines of the output that were not events.
+
+        :return: joined lines
+        """
+        return "\n".join(self.tail)
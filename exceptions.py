@@ -4,3 +4,15 @@ class AnsibleError(Exception):
 
 class TerraformError(Exception):
     """Exception raised for error in configuration orchestration."""
+
+
+class ReadinessError(Exception):
+    """Exception raised when hosts do not become reachable in time."""
+
+
+class DependencyCycleError(Exception):
+    """Exception raised when instances reference each other in a cycle."""
+
+
+class UnresolvedReferenceError(Exception):
+    """Exception raised when an instance references an instance without hosts in the inventory."""
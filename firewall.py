@@ -0,0 +1,91 @@
+import ipaddress
+
+
+def is_network(source: str) -> bool:
+    """
+    Checks whether a source is an IPv4 address or network, these can be stored in an ipset.
+
+    :param source: source address, network or DNS name
+    :return: True for IPv4 addresses and networks, False otherwise
+    """
+    try:
+        return ipaddress.ip_network(source, strict=False).version == 4
+    except ValueError:
+        return False
+
+
+class Ruleset:
+    """
+    A class compiling the firewall of a host into iptables-restore and ipset restore input.
+
+    The ruleset replaces the whole filter table at once. Connections are accepted from localhost,
+    SSH from the attacker, any TCP from the allowed sources and related/established connections,
+    everything else is rejected. When there are at least ipset_threshold IPv4 sources, they are matched
+    by a single rule against an ipset instead of a rule per source.
+
+    The attacker is required, without the SSH rule the ruleset would lock Ansible out of the host.
+    """
+    ipset_threshold = 16
+    set_name = "rtib_allow"
+
+    def __init__(self, sources: list, attacker: str) -> None:
+        """
+        Ruleset constructor.
+
+        :param sources: addresses, networks or DNS names to accept connections from
+        :param attacker: address of the attacker, SSH is accepted from it
+        :raises ValueError: when attacker is empty
+        """
+        if not attacker:
+            raise ValueError("attacker address is missing, the firewall would reject SSH from it")
+        self.sources = list(sources)
+        self.attacker = attacker
+        networks = [source for source in self.sources if is_network(source)]
+        self.set_members = networks if len(networks) >= self.ipset_threshold else []
+
+    @property
+    def uses_ipset(self) -> bool:
+        """
+        True if the sources are matched against an ipset.
+        """
+        return bool(self.set_members)
+
+    def iptables(self) -> str:
+        """
+        Renders the ruleset in the iptables-restore format.
+
+        :return: content of the rules file
+        """
+        rules = ["*filter", ":INPUT ACCEPT [0:0]", ":FORWARD ACCEPT [0:0]", ":OUTPUT ACCEPT [0:0]",
+                 "-A INPUT -s 127.0.0.1/32 -j ACCEPT",
+                 "-A INPUT -s {} -p tcp -m conntrack --ctstate NEW -m tcp --dport 22 -j ACCEPT".format(self.attacker)]
+        if self.uses_ipset:
+            rules.append("-A INPUT -p tcp -m conntrack --ctstate NEW -m set --match-set {} src -j ACCEPT".format(
+                self.set_name))
+        members = set(self.set_members)
+        for source in self.sources:
+            if source not in members:
+                rules.append("-A INPUT -s {} -p tcp -m conntrack --ctstate NEW -j ACCEPT".format(source))
+        rules.extend(["-A INPUT -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+                      "-A INPUT -j REJECT --reject-with icmp-port-unreachable",
+                      "COMMIT"])
+        return "\n".join(rules) + "\n"
+
+    def ipset(self) -> str:
+        """
+        Renders the ipset in the "ipset restore" format.
+
+        The members are loaded into a temporary set that is swapped with the live one,
+        so the set is replaced atomically even while iptables references it.
+
+        :return: content of the ipset file, empty if no ipset is used
+        """
+        if not self.uses_ipset:
+            return ""
+        temporary = self.set_name + "_new"
+        lines = ["create {} hash:net family inet -exist".format(self.set_name),
+                 "create {} hash:net family inet -exist".format(temporary),
+                 "flush {}".format(temporary)]
+        lines.extend("add {} {}".format(temporary, member) for member in self.set_members)
+        lines.extend(["swap {} {}".format(temporary, self.set_name), "destroy {}".format(temporary)])
+        return "\n".join(lines) + "\n"
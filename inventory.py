@@ -0,0 +1,24 @@
+import yaml
+
+
+class InventoryDumper(yaml.SafeDumper):
+    """
+    A YAML dumper of Ansible inventories, None is written as an empty value.
+
+    The representer is registered on this subclass once, yaml.SafeDumper used by other code
+    (possibly from other threads) is left untouched.
+    """
+
+
+InventoryDumper.add_representer(type(None),
+                                lambda dumper, value: dumper.represent_scalar(u'tag:yaml.org,2002:null', ''))
+
+
+def dump_inventory(inventory: dict) -> str:
+    """
+    Serializes an inventory into YAML.
+
+    :param inventory: the inventory
+    :return: YAML document
+    """
+    return yaml.dump(inventory, Dumper=InventoryDumper)
@@ -0,0 +1,191 @@
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+KEY_TYPES = ("ed25519", "rsa")
+
+
+def _write(path: str, content: bytes, mode: int) -> None:
+    """
+    Writes a file atomically with the given permissions, the content is never readable by others.
+
+    :param path: path of the file
+    :param content: content of the file
+    :param mode: permissions of the file
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(descriptor, "wb") as key_file:
+        key_file.write(content)
+    os.chmod(tmp_path, mode)  # umask may have cleared bits of mode
+    os.replace(tmp_path, path)
+
+
+def _generate_with_cryptography(key_type: str, comment: str) -> tuple:
+    """
+    Generates a key pair with the cryptography library (a dependency of Ansible).
+
+    :param key_type: "ed25519" or "rsa"
+    :param comment: comment of the public key
+    :return: tuple of the OpenSSH private key and the OpenSSH public key line
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    if key_type == "ed25519":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    private = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+                                        serialization.NoEncryption())
+    public = private_key.public_key().public_bytes(serialization.Encoding.OpenSSH,
+                                                   serialization.PublicFormat.OpenSSH)
+    return private, public + " {}\n".format(comment).encode()
+
+
+def _generate_with_ssh_keygen(key_type: str, comment: str, path: str) -> tuple:
+    """
+    Generates a key pair with ssh-keygen.
+
+    :param key_type: "ed25519" or "rsa"
+    :param comment: comment of the public key
+    :param path: path of the private key, a temporary key pair is generated next to it
+    :return: tuple of the OpenSSH private key and the OpenSSH public key line
+    """
+    tmp_path = "{}.{}.keygen".format(path, os.getpid())
+    cmd = ["ssh-keygen", "-q", "-t", key_type, "-N", "", "-C", comment, "-f", tmp_path]
+    if key_type == "rsa":
+        cmd += ["-b", "4096"]
+    try:
+        subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+        with open(tmp_path, "rb") as private_file, open(tmp_path + ".pub", "rb") as public_file:
+            return private_file.read(), public_file.read()
+    finally:
+        for tmp_file in (tmp_path, tmp_path + ".pub"):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def generate_key(path: str, key_type: str = "ed25519") -> str:
+    """
+    Generates an SSH key pair, the private key is written into path and the public key into path + ".pub".
+
+    The cryptography library is used if it is installed, ssh-keygen otherwise.
+    Defined at module level, so it can be run in a worker process.
+
+    :param path: path of the private key
+    :param key_type: "ed25519" or "rsa" (4096 bits)
+    :return: the OpenSSH public key
+    """
+    if key_type not in KEY_TYPES:
+        raise ValueError("Unknown key type: {}".format(key_type))
+    comment = os.path.basename(path)
+    try:
+        private, public = _generate_with_cryptography(key_type, comment)
+    except ImportError:
+        private, public = _generate_with_ssh_keygen(key_type, comment, path)
+
+    _write(path, private, 0o600)
+    _write(path + ".pub", public, 0o644)
+    return public.decode().strip()
+
+
+def public_key(path: str) -> str:
+    """
+    Derives the OpenSSH public key of an existing private key, e.g. of a key written by an older version of RTIB.
+
+    :param path: path of the private key
+    :raises subprocess.CalledProcessError: when the private key cannot be read
+    :return: the OpenSSH public key
+    """
+    try:
+        from cryptography.hazmat.primitives import serialization
+    except ImportError:
+        return subprocess.run(["ssh-keygen", "-y", "-f", path], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, check=True, universal_newlines=True).stdout.strip()
+
+    with open(path, "rb") as private_file:
+        content = private_file.read().strip() + b"\n"
+    if b"OPENSSH PRIVATE KEY" in content:
+        private_key = serialization.load_ssh_private_key(content, password=None)
+    else:
+        private_key = serialization.load_pem_private_key(content, password=None)
+    return private_key.public_key().public_bytes(serialization.Encoding.OpenSSH,
+                                                 serialization.PublicFormat.OpenSSH).decode()
+
+
+class KeyStore:
+    """
+    A class provisioning SSH keys of all hosts before Terraform runs.
+
+    Private key of host i of an instance is kept in "ssh_keys/<instance>_<i>" (where the inventory points),
+    its public key next to it with the ".pub" suffix. Existing keys are reused, so applying again does not
+    replace key pairs, and missing keys are generated in a process pool.
+    """
+    def __init__(self, directory: str = "ssh_keys", key_type: str = "ed25519", max_workers: int = None) -> None:
+        """
+        KeyStore constructor.
+
+        :param directory: directory of the keys, relative to the infrastructure directory
+        :param key_type: type of generated keys, "ed25519" or "rsa"
+        :param max_workers: maximum number of keys generated at once, number of CPUs if None
+        """
+        if key_type not in KEY_TYPES:
+            raise ValueError("Unknown key type: {}".format(key_type))
+        self.directory = directory
+        self.key_type = key_type
+        self.max_workers = max_workers
+
+    def path(self, instance: str, index: int) -> str:
+        """
+        Returns the path of the private key of a host.
+
+        :param instance: name of the instance
+        :param index: index of the host within the instance
+        :return: path of the private key
+        """
+        return os.path.join(self.directory, "{}_{}".format(instance, index))
+
+    def __cached(self, path: str) -> str:
+        """
+        Returns the public key of an existing private key, writing it next to the private key if it is missing.
+
+        :param path: path of the private key
+        :return: the OpenSSH public key, None if there is no private key
+        """
+        if not os.path.isfile(path):
+            return None
+        if os.path.isfile(path + ".pub"):
+            with open(path + ".pub") as public_file:
+                return public_file.read().strip()
+
+        public = public_key(path)
+        with open(path + ".pub", "w") as public_file:
+            public_file.write(public + "\n")
+        return public
+
+    def ensure(self, totals: dict) -> dict:
+        """
+        Makes sure every host has a key pair, generating the missing ones concurrently.
+
+        :param totals: dictionary mapping instance name to its number of hosts
+        :return: dictionary mapping instance name to the list of public keys of its hosts
+        """
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        keys = {instance: [self.__cached(self.path(instance, i)) for i in range(total)]
+                for instance, total in totals.items()}
+        missing = [self.path(instance, i) for instance, public_keys in keys.items()
+                   for i, public in enumerate(public_keys) if public is None]
+
+        if len(missing) == 1:
+            generated = [generate_key(missing[0], self.key_type)]
+        elif missing:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                generated = list(executor.map(generate_key, missing, [self.key_type] * len(missing)))
+        else:
+            generated = []
+
+        generated = dict(zip(missing, generated))
+        return {instance: [public if public is not None else generated.get(self.path(instance, i))
+                           for i, public in enumerate(public_keys)]
+                for instance, public_keys in keys.items()}
@@ -1,41 +1,92 @@
 import yaml
 import os
-import subprocess
+import io
+import configparser
+import json
+import hashlib
+import threading
 
-from exceptions import AnsibleError
+from exceptions import AnsibleError, UnresolvedReferenceError
+from scheduler import Scheduler
+from events import AnsibleEvent, EventStream, parse_ansible_event
+from profiler import Profiler
+from model import Infrastructure, resolve_references
+from firewall import Ruleset
+from inventory import dump_inventory
 
 
 class Manager:
     """
     A class providing configuration management via Ansible.
+
+    Hosts whose address, variables and role contents did not change since their last successful
+    configuration are skipped, see ledger_path.
+
+    Ansible is run with an engagement-local configuration sized to the inventory, see config_path.
+
+    Firewall of every host is compiled into an iptables-restore ruleset, see firewall_dir.
+
+    All files are kept in the working directory given to the constructor, roles and callback plugins
+    are read from the directories next to it. Ansible runs in the working directory, the working directory
+    of the process is never changed.
     """
-    def __init__(self, infrastructure_description: dict, verbose: bool = False) -> None:
+    ledger_path = ".ledger.json"
+    config_path = "ansible.cfg"
+    firewall_dir = "firewall"
+    fact_cache_dir = ".facts"
+    max_forks = 50
+
+    def __init__(self, infrastructure: Infrastructure, verbose: bool = False, max_concurrency: int = 1,
+                 force: bool = False, profiler: Profiler = None, working_dir: str = ".") -> None:
         """
         Manager constructor.
 
-        :param infrastructure_description: dictionary containing infrastructure description
+        :param infrastructure: parsed infrastructure description
         :param verbose: if True, Ansible output gets printed.
+        :param max_concurrency: maximum number of plays run at once, plays are run by a single
+                                ansible-playbook process if 1
+        :param force: if True, all hosts are configured even if they did not change
+        :param profiler: profiler recording the management, nothing is recorded if None
+        :param working_dir: directory of the infrastructure's playbook, inventory, ledger and Ansible configuration
         """
-        self.infrastructure_description = infrastructure_description.get("infrastructure")
+        self.infrastructure = infrastructure
+        self.working_dir = working_dir
         self.verbose = verbose
-        self.inventory_path = None
+        self.max_concurrency = max_concurrency
+        self.force = force
+        self.profiler = profiler or Profiler(enabled=False)
+        self.inventory_path = self.__path("hosts.yaml")
+        self.critical_path = None
+        self.configured_hosts = None
+        self.unresolved = {}
+        self.__ledger_lock = threading.Lock()
+
+    def __path(self, *parts: str) -> str:
+        """
+        Returns the path of a file of the infrastructure.
+
+        :param parts: path of the file relative to the working directory
+        :return: path of the file
+        """
+        return os.path.normpath(os.path.join(self.working_dir, *parts))
 
     def __generate_playbook(self) -> None:
         """
         Generates Ansible playbook from infrastructure description.
 
-        The playbook is written into "playbook.yaml".
+        The playbook is written into "playbook.yaml" in the working directory.
         """
-        instances = self.infrastructure_description.get("instances")
-
         hosts_list = []
-        for instance_dict in instances:
-            name = instance_dict.get("name")
-            role = instance_dict.get("role")
-            hosts_list.append({"hosts": name, "roles": [role, "network"]})  # network role is applied to all instances
+        for instance in self.infrastructure:
+            hosts_list.append({"hosts": instance.name, "roles": [instance.role, "network"]})  # network role is applied to all instances
 
         playbook = yaml.safe_dump(hosts_list)
-        with open("playbook.yaml", "w") as playbook_yaml:
+        if os.path.exists(self.__path("playbook.yaml")):
+            with open(self.__path("playbook.yaml")) as playbook_yaml:
+                if playbook_yaml.read() == playbook:
+                    return  # rewriting could race with a running ansible-playbook
+
+        with open(self.__path("playbook.yaml"), "w") as playbook_yaml:
             playbook_yaml.write(playbook)
 
     def __get_role_variables(self, name: str) -> dict:
@@ -45,56 +96,407 @@ class Manager:
         :param name: name of the desired role
         :return: variables for given role
         """
-        for instance_dict in self.infrastructure_description.get("instances"):
-            if instance_dict.get("name") == name:
-                return instance_dict.get("arguments").get("role")
+        instance = self.infrastructure.get(name)
+        return instance.role_arguments if instance is not None else {}
 
-    def __add_variables_to_inventory(self) -> None:
+    def __add_variables_to_inventory(self, output_path: str = None) -> dict:
         """
         Adds variables from infrastructure description to inventory file.
-        """
-        # None as empty string
-        yaml.SafeDumper.add_representer(
-            type(None),
-            lambda dumper, value: dumper.represent_scalar(u'tag:yaml.org,2002:null', ''))
 
+        References to other instances ("redirect_to", "accept_from") are resolved to the addresses
+        of their hosts here, once, see model.resolve_references. Referenced instances without hosts
+        in the inventory are stored in unresolved.
+
+        :param output_path: where to write the updated inventory, inventory_path if None
+        :return: the updated inventory
+        """
         with open(self.inventory_path) as inventory_file:
             inventory = yaml.safe_load(inventory_file)
 
+        children = inventory.get("all").get("children")
+        groups = {group: list(group_dict.get("hosts") or {}) for group, group_dict in children.items()}
+        self.unresolved = {}
+
         # Add vars from infrastructure description to existing vars in inventory
-        for module, module_dict in inventory.get("all").get("children").items():
+        for module, module_dict in children.items():
             module_vars = module_dict.get("vars")
             module_vars.update(self.__get_role_variables(module))
 
+            instance = self.infrastructure.get(module)
+            role_args = instance.resolved_role_arguments if instance is not None \
+                else self.infrastructure.global_role_arguments
+            resolved, unresolved = resolve_references(role_args, groups, self.infrastructure.names)
+            module_vars.update(resolved)
+            if unresolved:
+                self.unresolved.update({module: unresolved})
+
         # Add global vars from infrastructure description
-        global_vars = {var: value for var, value in self.infrastructure_description.get("global_arguments", {}).get("role", {}).items()}
-        inventory.get("all").update({"vars": global_vars})
+        inventory.get("all").update({"vars": dict(self.infrastructure.global_role_arguments)})
 
-        updated_inventory = yaml.safe_dump(inventory)
-        with open(self.inventory_path, "w") as inventory_file:
+        updated_inventory = dump_inventory(inventory)
+        with open(output_path or self.inventory_path, "w") as inventory_file:
             inventory_file.write(updated_inventory)
 
-    def __run_ansible(self) -> None:
+        return inventory
+
+    def __rulesets(self, inventory: dict) -> dict:
+        """
+        Compiles firewall rulesets of inventory groups from their resolved "allow_from" variable.
+
+        All hosts of a group share the ruleset.
+
+        :param inventory: inventory with variables
+        :raises ValueError: when a group has no "attacker" variable, no ruleset is written then
+        :return: dictionary mapping group name to its ruleset
+        """
+        global_vars = inventory.get("all").get("vars") or {}
+        rulesets = {}
+        for group, group_dict in inventory.get("all").get("children").items():
+            group_vars = {**global_vars, **(group_dict.get("vars") or {})}
+            try:
+                rulesets.update({group: Ruleset(group_vars.get("allow_from") or [], group_vars.get("attacker"))})
+            except ValueError as error:
+                raise ValueError("{}: {}".format(group, error))
+        return rulesets
+
+    def __check_references(self, groups: list = None) -> None:
+        """
+        Checks that instances referenced by the given inventory groups have hosts.
+
+        :param groups: names of inventory groups to check, all groups if None
+        :raises UnresolvedReferenceError: when a referenced instance has no hosts in the inventory
+        """
+        problems = ["{} references {} without hosts in the inventory".format(group, ", ".join(names))
+                    for group, names in sorted(self.unresolved.items()) if groups is None or group in groups]
+        if problems:
+            raise UnresolvedReferenceError("\n".join(problems))
+
+    @staticmethod
+    def __write_if_changed(path: str, content: str) -> None:
+        """
+        Replaces a file atomically, only if its content changed.
+
+        Running ansible-playbook processes never read a partially written file.
+
+        :param path: path of the file
+        :param content: new content of the file
+        """
+        if os.path.exists(path):
+            with open(path) as existing_file:
+                if existing_file.read() == content:
+                    return
+
+        with open(path + ".tmp", "w") as new_file:
+            new_file.write(content)
+        os.replace(path + ".tmp", path)
+
+    def __generate_rulesets(self, inventory: dict) -> None:
+        """
+        Writes the firewall ruleset of every host in the inventory into firewall_dir.
+
+        "<host>.rules" is the iptables-restore input, "<host>.ipset" the "ipset restore" input
+        (empty when the ruleset does not use an ipset). Files of hosts no longer in the inventory are removed.
+
+        :param inventory: inventory with variables
+        """
+        firewall_dir = self.__path(self.firewall_dir)
+        os.makedirs(firewall_dir, exist_ok=True)
+        files = set()
+        for group, ruleset in self.__rulesets(inventory).items():
+            rules, ipset = ruleset.iptables(), ruleset.ipset()
+            for host in inventory.get("all").get("children").get(group).get("hosts") or {}:
+                self.__write_if_changed(os.path.join(firewall_dir, "{}.rules".format(host)), rules)
+                self.__write_if_changed(os.path.join(firewall_dir, "{}.ipset".format(host)), ipset)
+                files.update({"{}.rules".format(host), "{}.ipset".format(host)})
+
+        for file in set(os.listdir(firewall_dir)) - files:
+            if file.endswith((".rules", ".ipset")):
+                os.remove(os.path.join(firewall_dir, file))
+
+    def __ansible_config(self, host_count: int) -> configparser.ConfigParser:
+        """
+        Builds the Ansible configuration of the engagement.
+
+        Forks are sized to the number of hosts, SSH connections are kept open between tasks
+        (pipelining, ControlPersist) and facts are cached, so they are gathered only once per TTL.
+        Sections under "ansible" in global arguments of the description override the defaults.
+
+        :param host_count: number of hosts in the inventory
+        :return: Ansible configuration
+        """
+        config = configparser.ConfigParser(interpolation=None)
+        config.read_dict({
+            "defaults": {"forks": max(1, min(host_count, self.max_forks)),
+                         "host_key_checking": False,
+                         "gathering": "smart",
+                         "fact_caching": "jsonfile",
+                         "fact_caching_connection": os.path.join(os.path.abspath(self.working_dir),
+                                                                 self.fact_cache_dir),
+                         "fact_caching_timeout": 86400},
+            "ssh_connection": {"pipelining": True,
+                               "ssh_args": "-o ControlMaster=auto -o ControlPersist=60s -o ServerAliveInterval=60",
+                               # short socket names, paths of Unix sockets are limited to ~100 characters
+                               "control_path_dir": "~/.ansible/cp/{}".format(self.infrastructure.name),
+                               "control_path": "%(directory)s/%%C"}})
+        config.read_dict(self.infrastructure.global_ansible_arguments)
+        return config
+
+    def __generate_config(self, host_count: int) -> None:
+        """
+        Writes the Ansible configuration of the engagement into config_path.
+
+        The file is replaced atomically and only if its content changed, so running ansible-playbook
+        processes never read a partially written file.
+
+        :param host_count: number of hosts in the inventory
+        """
+        config = self.__ansible_config(host_count)
+        with io.StringIO() as config_buffer:
+            config.write(config_buffer)
+            self.__write_if_changed(self.__path(self.config_path), config_buffer.getvalue())
+
+    def __run_ansible(self, limit: list = None, inventory_path: str = None) -> None:
         """
         Sets environment variables and runs Ansible.
 
-        If verbosity is set to True, also prints the Ansible output.
+        Ansible output is streamed as events of the "rtib_events" callback plugin.
+        If verbosity is set to True, also prints the Ansible progress.
 
+        :param limit: names of inventory groups to configure, all groups if None
+        :param inventory_path: inventory to use, inventory_path if None
         :raises AnsibleError: when Ansible error occurs
         """
-        cmd = 'ansible-playbook playbook.yaml -i "{}"'.format(self.inventory_path)
+        cmd = 'ansible-playbook playbook.yaml -i "{}"'.format(
+            os.path.relpath(inventory_path or self.inventory_path, self.working_dir))  # run in the working directory
+        if limit is not None:
+            cmd += ' --limit "{}"'.format(",".join(limit))
+        working_dir = os.path.abspath(self.working_dir)
         env = os.environ.copy()
         env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
-        env["ANSIBLE_ROLES_PATH"] = os.getcwd() + "/../roles"
+        env["ANSIBLE_ROLES_PATH"] = working_dir + "/../roles"
         env["ANSIBLE_PYTHON_INTERPRETER"] = "/usr/bin/python3"
-        p = subprocess.run(cmd, shell=True, env=env, capture_output=not self.verbose)
-        if p.returncode != 0:
-            raise AnsibleError(p.stdout.decode("utf-8"), p.stderr.decode("utf-8"))
+        env["ANSIBLE_CONFIG"] = os.path.join(working_dir, self.config_path)
+        env["ANSIBLE_CALLBACK_PLUGINS"] = working_dir + "/../callback_plugins"
+        env["ANSIBLE_STDOUT_CALLBACK"] = "rtib_events"
+
+        stream = EventStream(cmd, parse_ansible_event, env=env, cwd=self.working_dir, shell=True)
+        failures = []
+        with self.profiler.span("ansible-playbook", "ansible", limit=limit):
+            for event in stream:
+                if event.type in ("task_failed", "host_unreachable"):
+                    failures.append("{} | {} | {}".format(event.host, event.task, event.message))
+                if event.host is not None and event.time is not None and event.duration is not None:
+                    self.profiler.add(event.task, "ansible", event.time - event.duration, event.duration, event.host,
+                                      play=event.play, status=event.type)
+                if self.verbose:
+                    self.__print_event(event)
+
+        if stream.returncode != 0:
+            raise AnsibleError(stream.output(), "\n".join(failures))
+
+    @staticmethod
+    def __print_event(event: AnsibleEvent) -> None:
+        """
+        Prints a progress line for an Ansible event.
 
-    def manage(self) -> None:
+        :param event: event of the "rtib_events" callback plugin
+        """
+        if event.type == "play_start":
+            print("PLAY [{}]".format(event.play))
+        elif event.type == "task_start":
+            print("TASK [{}]".format(event.task))
+        elif event.type == "host_stats":
+            print("{}: {}".format(event.host, event.message))
+        elif event.host is not None:
+            status = event.type.replace("task_", "").upper()
+            duration = " ({:.1f}s)".format(event.duration) if event.duration is not None else ""
+            message = ": {}".format(event.message) if event.message else ""
+            print("{}: [{}]{}{}".format(status, event.host, duration, message))
+
+    def prepare(self, inventory_path: str = None, groups: list = None) -> None:
+        """
+        Generates playbook, adds variables to inventory file, compiles firewall rulesets
+        and generates Ansible configuration.
+
+        :param inventory_path: where to write the inventory with variables, inventory_path if None
+        :param groups: names of inventory groups that are going to be configured, all groups if None
+        :raises UnresolvedReferenceError: when the groups reference an instance without hosts in the inventory
+        """
+        with self.profiler.span("generate playbook", "manager"):
+            self.__generate_playbook()
+        with self.profiler.span("add variables to inventory", "manager"):
+            inventory = self.__add_variables_to_inventory(inventory_path)
+        self.__check_references(groups)
+        with self.profiler.span("compile firewall rulesets", "manager"):
+            self.__generate_rulesets(inventory)
+        host_count = sum(len(group_dict.get("hosts") or {})
+                         for group_dict in inventory.get("all").get("children").values())
+        with self.profiler.span("generate ansible.cfg", "manager", hosts=host_count):
+            self.__generate_config(host_count)
+
+    def run(self, limit: list = None, inventory_path: str = None) -> None:
+        """
+        Runs Ansible over a prepared playbook and inventory file.
+
+        The configured hosts are recorded in the convergence ledger, so the next manage skips them
+        until they change.
+
+        :param limit: names of inventory groups to configure, all groups if None
+        :param inventory_path: inventory to use, inventory_path if None
+        :raises AnsibleError: when Ansible error occurs
+        """
+        hashes = self.__host_hashes(limit, inventory_path)
+        self.__run_ansible(limit, inventory_path)
+        self.__record({host: digest for hosts in hashes.values() for host, digest in hosts.items()})
+
+    def __role_hash(self, role: str) -> str:
+        """
+        Computes a hash of the role directory contents.
+
+        :param role: name of the role
+        :return: hex digest
+        """
+        digest = hashlib.sha256()
+        working_dir = os.path.abspath(self.working_dir)
+        for root, dirs, files in os.walk(os.path.join(working_dir, "..", "roles", role)):
+            dirs.sort()
+            for file in sorted(files):
+                digest.update(os.path.relpath(os.path.join(root, file), working_dir).encode())
+                with open(os.path.join(root, file), "rb") as role_file:
+                    digest.update(role_file.read())
+        return digest.hexdigest()
+
+    def __host_hashes(self, limit: list = None, inventory_path: str = None) -> dict:
+        """
+        Computes convergence hashes of hosts in the inventory file.
+
+        Hash of a host covers its address and variables, variables of its group, global variables,
+        its firewall ruleset (so it changes with addresses of the instances it accepts connections from)
+        and contents of the roles applied to it.
+
+        :param limit: names of inventory groups to hash, all groups if None
+        :param inventory_path: inventory to read, inventory_path if None
+        :return: dictionary mapping group name to a dictionary mapping host address to its hash
+        """
+        with open(inventory_path or self.inventory_path) as inventory_file:
+            inventory = yaml.safe_load(inventory_file)
+
+        roles = {instance.name: instance.role for instance in self.infrastructure}
+        rulesets = self.__rulesets(inventory)
+        role_hashes = {}
+        global_vars = inventory.get("all").get("vars") or {}
+
+        hashes = {}
+        for group, group_dict in inventory.get("all").get("children").items():
+            if limit is not None and group not in limit:
+                continue
+            for role in (roles.get(group), "network"):
+                if role not in role_hashes:
+                    role_hashes.update({role: self.__role_hash(str(role))})
+
+            group_state = [group_dict.get("vars"), global_vars, role_hashes.get(roles.get(group)),
+                           role_hashes.get("network"), rulesets.get(group).iptables(), rulesets.get(group).ipset()]
+            hashes.update({group: {
+                host: hashlib.sha256(json.dumps([host, host_vars] + group_state, sort_keys=True,
+                                                default=str).encode()).hexdigest()
+                for host, host_vars in (group_dict.get("hosts") or {}).items()}})
+        return hashes
+
+    def __read_ledger(self) -> dict:
+        """
+        Reads the convergence ledger.
+
+        :return: dictionary mapping host address to its hash at its last successful configuration
+        """
+        try:
+            with open(self.__path(self.ledger_path)) as ledger_file:
+                return json.load(ledger_file)
+        except (OSError, ValueError):
+            return {}
+
+    def __write_ledger(self, ledger: dict) -> None:
+        """
+        Writes the convergence ledger.
+
+        :param ledger: dictionary mapping host address to its hash at its last successful configuration
+        """
+        with open(self.__path(self.ledger_path), "w") as ledger_file:
+            json.dump(ledger, ledger_file, indent=2, sort_keys=True)
+
+    def __record(self, hashes: dict) -> None:
+        """
+        Records successfully configured hosts in the convergence ledger.
+
+        :param hashes: dictionary mapping host address to its hash
+        """
+        with self.__ledger_lock:
+            ledger = self.__read_ledger()
+            ledger.update(hashes)
+            self.__write_ledger(ledger)
+
+    @staticmethod
+    def __limit(pending: dict, hashes: dict) -> list:
+        """
+        Converts pending hosts into an Ansible limit, groups with all hosts pending are limited by name.
+
+        :param pending: dictionary mapping group name to the list of its hosts to configure
+        :param hashes: dictionary mapping group name to a dictionary mapping host address to its hash
+        :return: list of group names and host addresses
+        """
+        limit = []
+        for group, hosts in sorted(pending.items()):
+            limit.extend([group] if len(hosts) == len(hashes.get(group)) else sorted(hosts))
+        return limit
+
+    def __run_scheduled(self, pending: dict, hashes: dict) -> None:
+        """
+        Runs every play in a separate Ansible process, independent plays concurrently.
+
+        The critical path of the run is stored in critical_path.
+
+        :param pending: dictionary mapping group name to the list of its hosts to configure
+        :param hashes: dictionary mapping group name to a dictionary mapping host address to its hash
+        :raises DependencyCycleError: when instances reference each other in a cycle
+        :raises AnsibleError: when Ansible error occurs
+        """
+        def run_play(play: str) -> None:
+            self.__run_ansible(self.__limit({play: pending.get(play)}, hashes))
+            self.__record({host: hashes.get(play).get(host) for host in pending.get(play)})
+
+        scheduler = Scheduler(self.infrastructure, self.max_concurrency)
+        durations = scheduler.run(run_play, list(pending))
+        self.critical_path = scheduler.critical_path(durations)
+
+    def manage(self, limit: list = None, force: bool = False) -> dict:
         """
         Generates playbook, adds variables to inventory file and runs Ansible.
+
+        Only hosts that changed since their last successful configuration are configured,
+        they are stored in configured_hosts.
+
+        :param limit: names of inventory groups to configure, all groups if None
+        :param force: if True, hosts are configured even if they did not change
+        :raises UnresolvedReferenceError: when the configured groups reference an instance without hosts
+        :return: dictionary with the configured hosts and the critical path of scheduled plays (None if not scheduled)
         """
-        self.__generate_playbook()
-        self.__add_variables_to_inventory()
-        self.__run_ansible()
+        self.prepare(groups=limit)
+        self.critical_path = None
+
+        with self.profiler.span("compare ledger", "manager") as span_args:
+            hashes = self.__host_hashes(limit)
+            ledger = {} if force or self.force else self.__read_ledger()
+            pending = {group: [host for host, digest in hosts.items() if ledger.get(host) != digest]
+                       for group, hosts in hashes.items()}
+            pending = {group: hosts for group, hosts in pending.items() if hosts}
+            span_args.update({"pending": sum(len(hosts) for hosts in pending.values())})
+        self.configured_hosts = sorted(host for hosts in pending.values() for host in hosts)
+
+        if pending and self.max_concurrency > 1:
+            self.__run_scheduled(pending, hashes)
+        elif pending:
+            if limit is None and pending.keys() == hashes.keys() and self.__limit(pending, hashes) == sorted(pending):
+                self.__run_ansible()
+            else:
+                self.__run_ansible(self.__limit(pending, hashes))
+            self.__record({host: hashes.get(group).get(host) for group, hosts in pending.items() for host in hosts})
+        return {"configured_hosts": self.configured_hosts, "critical_path": self.critical_path}
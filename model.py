@@ -0,0 +1,201 @@
+from typing import Iterator, KeysView, Optional
+
+
+def _mapping(value) -> dict:
+    """
+    Returns the value if it is a dictionary, an empty dictionary otherwise.
+
+    The model is built before validation, so malformed parts of the description are treated as missing.
+
+    :param value: any value from the description
+    :return: the value or an empty dictionary
+    """
+    return value if isinstance(value, dict) else {}
+
+
+def references(role_args: dict, names) -> set:
+    """
+    Returns names of instances referenced by "redirect_to" and "accept_from" role arguments.
+
+    :param role_args: role arguments of an instance
+    :param names: names of all instances, other values are addresses
+    :return: set of referenced instance names
+    """
+    referenced = role_args.get("accept_from")
+    referenced = set(referenced) if isinstance(referenced, list) else set()
+    referenced.add(role_args.get("redirect_to"))
+    return {name for name in referenced if isinstance(name, str) and name in names}
+
+
+def resolve_references(role_args: dict, groups: dict, names) -> tuple:
+    """
+    Resolves "redirect_to" and "accept_from" role arguments to addresses of inventory hosts.
+
+    "redirect_to" is resolved into "redirect_to_host" (the first host of the module) and "redirect_to_hosts"
+    (all hosts of the module), "accept_from" into "allow_from" (hosts of all listed modules and the listed
+    addresses, without duplicates). Values that are not names of instances are addresses and are kept.
+
+    :param role_args: role arguments of an instance, global arguments already merged
+    :param groups: dictionary mapping inventory group name to the list of its host addresses
+    :param names: names of all instances
+    :return: tuple of the dictionary of resolved variables and the list of referenced instances without hosts
+    """
+    variables = {}
+    unresolved = []
+
+    def resolve(value) -> list:
+        if value in names:
+            if not groups.get(value):
+                unresolved.append(value)
+            return list(groups.get(value) or [])
+        return [value]
+
+    if role_args.get("redirect_to") is not None:
+        hosts = resolve(role_args.get("redirect_to"))
+        variables.update({"redirect_to_host": hosts[0] if hosts else None, "redirect_to_hosts": hosts})
+    if isinstance(role_args.get("accept_from"), list):
+        sources = [host for value in role_args.get("accept_from") for host in resolve(value)]
+        variables.update({"allow_from": list(dict.fromkeys(sources))})
+    return variables, unresolved
+
+
+class Instance:
+    """
+    A class representing an instance of the infrastructure description.
+
+    Global arguments are already merged into resolved_role_arguments and resolved_provider_arguments,
+    arguments of the instance take precedence.
+    """
+    __slots__ = ("name", "role", "provider", "role_arguments", "provider_arguments", "resolved_role_arguments",
+                 "resolved_provider_arguments", "references", "path")
+
+    def __init__(self, instance_dict: dict, global_role_arguments: dict, global_provider_arguments: dict,
+                 path: str) -> None:
+        """
+        Instance constructor.
+
+        :param instance_dict: description of the instance
+        :param global_role_arguments: role arguments of all instances
+        :param global_provider_arguments: provider arguments of all instances
+        :param path: path of the instance in the description, e.g. "infrastructure.instances[3]"
+        """
+        arguments = _mapping(instance_dict.get("arguments"))
+        self.name = instance_dict.get("name")
+        self.role = instance_dict.get("role")
+        self.provider = instance_dict.get("provider")
+        self.role_arguments = _mapping(arguments.get("role"))
+        self.provider_arguments = _mapping(arguments.get("provider"))
+        self.resolved_role_arguments = {**global_role_arguments, **self.role_arguments}
+        self.resolved_provider_arguments = {**global_provider_arguments, **self.provider_arguments}
+        self.references = set()  # filled in by Infrastructure once all names are known
+        self.path = path
+
+    def __repr__(self) -> str:
+        return "Instance({!r}, role={!r}, provider={!r})".format(self.name, self.role, self.provider)
+
+
+class Infrastructure:
+    """
+    A class representing a parsed infrastructure description.
+
+    It is built once and shared by Validator, Orchestrator and Manager. Instances are indexed by name,
+    so lookups and references between instances are resolved in linear time overall.
+    """
+    __slots__ = ("description", "name", "instances", "global_role_arguments", "global_provider_arguments",
+                 "global_ansible_arguments", "__index", "__referencing")
+
+    def __init__(self, description: dict) -> None:
+        """
+        Infrastructure constructor.
+
+        :param description: dictionary containing infrastructure description (with the "infrastructure" key)
+        """
+        self.description = description
+        infrastructure = _mapping(_mapping(description).get("infrastructure"))
+        global_arguments = _mapping(infrastructure.get("global_arguments"))
+        self.name = infrastructure.get("name")
+        self.global_role_arguments = _mapping(global_arguments.get("role"))
+        self.global_provider_arguments = _mapping(global_arguments.get("provider"))
+        self.global_ansible_arguments = _mapping(global_arguments.get("ansible"))  # ansible.cfg sections
+
+        instances = infrastructure.get("instances")
+        self.instances = [Instance(instance_dict, self.global_role_arguments, self.global_provider_arguments,
+                                   "infrastructure.instances[{}]".format(i))
+                          for i, instance_dict in enumerate(instances if isinstance(instances, list) else [])
+                          if isinstance(instance_dict, dict)]
+
+        self.__index = {}
+        for instance in self.instances:
+            self.__index.setdefault(instance.name, instance)
+
+        self.__referencing = {}
+        for instance in self.instances:
+            instance.references = references(instance.resolved_role_arguments, self.__index) - {instance.name}
+            for name in instance.references:
+                self.__referencing.setdefault(name, set()).add(instance.name)
+
+    def __iter__(self) -> Iterator[Instance]:
+        return iter(self.instances)
+
+    def __len__(self) -> int:
+        return len(self.instances)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__index
+
+    def get(self, name: str) -> Optional[Instance]:
+        """
+        Returns the instance of the given name.
+
+        :param name: name of the instance
+        :return: the instance, None if there is no such instance
+        """
+        return self.__index.get(name)
+
+    @property
+    def names(self) -> KeysView:
+        """
+        Names of all instances.
+        """
+        return self.__index.keys()
+
+    def referencing(self, name: str) -> set:
+        """
+        Returns names of instances referencing the given instance in their role arguments.
+
+        :param name: name of the referenced instance
+        :return: set of referencing instance names
+        """
+        return set(self.__referencing.get(name, ()))
+
+
+def diff(old: Infrastructure, new: Infrastructure) -> dict:
+    """
+    Compares two versions of an infrastructure description instance by instance.
+
+    Added instances and instances whose provider or provider arguments changed have to be applied.
+    They and instances whose role or role arguments changed have to be configured, as well as instances
+    referencing applied or removed instances, since the addresses they resolve to may have changed.
+
+    :param old: the previous description
+    :param new: the current description
+    :return: dictionary with sets of instance names under "added", "removed", "apply" and "configure"
+    """
+    added = {instance.name for instance in new if instance.name not in old}
+    removed = {instance.name for instance in old if instance.name not in new}
+    apply = set(added)
+    configure = set(added)
+    for instance in new:
+        previous = old.get(instance.name)
+        if previous is None:
+            continue
+        if (instance.provider, instance.resolved_provider_arguments) \
+                != (previous.provider, previous.resolved_provider_arguments):
+            apply.add(instance.name)
+        if (instance.role, instance.resolved_role_arguments) != (previous.role, previous.resolved_role_arguments):
+            configure.add(instance.name)
+
+    for name in apply | removed:
+        configure.update(new.referencing(name) | old.referencing(name))
+    configure.update(apply)
+    return {"added": added, "removed": removed, "apply": apply, "configure": configure - removed}
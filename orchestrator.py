@@ -2,140 +2,905 @@ import json
 import yaml
 import shutil
 import os
+import time
+import hashlib
+import threading
+import subprocess
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
 
-from parse import compile
 import python_terraform as tf
 
 from exceptions import TerraformError
+from state import TerraformState
+from events import EventStream, TerraformEvent, parse_terraform_event
+from profiler import Profiler
+from model import Infrastructure
+from parallelism import ParallelismController
+from keys import KeyStore
+from inventory import dump_inventory
+
+
+class Terraform(tf.Terraform):
+    """
+    Terraform of a working directory, run with environment variables of its own.
+
+    Unlike setting them in os.environ, the variables (e.g. TF_PLUGIN_CACHE_DIR) do not leak into other
+    infrastructures driven by the same process.
+    """
+    def __init__(self, working_dir: str = None, env: dict = None) -> None:
+        """
+        Terraform constructor.
+
+        :param working_dir: Terraform working directory, the current working directory if None
+        :param env: environment variables added to the environment of the process for every command
+        """
+        super().__init__(working_dir=working_dir)
+        self.env = dict(env or {})
+
+    def environment(self) -> dict:
+        """
+        Returns the environment Terraform commands run with.
+
+        :return: environment of the process with env added
+        """
+        return {**os.environ, **self.env}
+
+    def cmd(self, cmd: str, *args, **kwargs) -> tuple:
+        """
+        Runs a Terraform command and captures its output, see python_terraform.Terraform.cmd.
+
+        :param cmd: Terraform command
+        :param args: arguments of the command
+        :param kwargs: options of the command
+        :return: tuple of return code, stdout and stderr
+        """
+        for option in ("capture_output", "raise_on_error", "synchronous"):
+            kwargs.pop(option, None)
+        process = subprocess.run(self.generate_cmd_string(cmd, *args, **kwargs), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, cwd=self.working_dir or None, env=self.environment(),
+                                 universal_newlines=True)
+        self.temp_var_files.clean_up()
+        return process.returncode, process.stdout, process.stderr
+
+
+def init_hash(working_dir: str = ".") -> str:
+    """
+    Computes a hash of everything "terraform init" depends on.
+
+    That is the modules in "main.tf.json" with their sources (every module is installed by init,
+    even if its source is shared with another one), contents of the source directories
+    and the provider lock file.
+
+    :param working_dir: Terraform working directory
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(os.path.join(working_dir, "main.tf.json")) as main_tf_json:
+            modules = json.load(main_tf_json).get("module", {})
+    except (OSError, ValueError):
+        modules = {}
+
+    for key, module_dict in sorted(modules.items()):
+        digest.update("{}={}\n".format(key, module_dict.get("source")).encode())
+
+    paths = [os.path.join(working_dir, ".terraform.lock.hcl")]
+    for source in sorted({module_dict.get("source") for module_dict in modules.values()}):
+        for root, dirs, files in os.walk(os.path.join(working_dir, source)):
+            dirs.sort()
+            paths.extend(os.path.join(root, file) for file in sorted(files))
+
+    for path in paths:
+        if os.path.isfile(path):
+            digest.update(path.encode())
+            with open(path, "rb") as hashed_file:
+                digest.update(hashed_file.read())
+    return digest.hexdigest()
+
+
+def init_terraform(terraform: tf.Terraform, working_dir: str = ".", plugin_dir: str = None,
+                   profiler: Profiler = None) -> tuple:
+    """
+    Runs "terraform init" unless the module set and provider lock are unchanged since the last init.
+
+    :param terraform: Terraform of the working directory
+    :param working_dir: Terraform working directory
+    :param plugin_dir: local filesystem provider mirror to install providers from, providers are downloaded if None
+    :param profiler: profiler recording the init, nothing is recorded if None
+    :return: tuple of return code, stdout and stderr
+    """
+    profiler = profiler or Profiler(enabled=False)
+    with profiler.span("terraform init", "terraform", working_dir=working_dir) as span_args:
+        hash_path = os.path.join(working_dir, ".terraform", "rtib_init.sha256")
+        try:
+            with open(hash_path) as hash_file:
+                if hash_file.read() == init_hash(working_dir):
+                    span_args.update({"cached": True})
+                    return 0, "", ""
+        except OSError:
+            pass
+
+        ret_init, out_init, err_init = terraform.init(plugin_dir=plugin_dir)
+        if ret_init == 0 and os.path.isdir(os.path.dirname(hash_path)):
+            with open(hash_path, "w") as hash_file:
+                hash_file.write(init_hash(working_dir))  # init may have written the lock file
+        return ret_init, out_init, err_init
+
+
+def apply_terraform(terraform: tf.Terraform, targets: list = None, verbose: bool = False,
+                    profiler: Profiler = None, refresh: bool = True, plan_path: str = None, parallelism: int = None,
+                    on_event: Callable[[TerraformEvent], None] = None) -> tuple:
+    """
+    Runs "terraform apply" with machine-readable output and parses it line by line.
+
+    :param terraform: Terraform of the working directory
+    :param targets: addresses to limit the apply to, everything if None
+    :param verbose: if True, progress of the apply gets printed as it arrives
+    :param profiler: profiler recording the apply and every applied resource, nothing is recorded if None
+    :param refresh: if False, the state is not refreshed before planning
+    :param plan_path: saved plan to apply without planning again, targets and refresh are ignored if set
+    :param parallelism: maximum number of concurrent operations, the Terraform default if None
+    :param on_event: callback receiving every parsed event
+    :return: tuple of return code, dictionary mapping action to the number of resources
+             it was applied to, and error messages
+    """
+    profiler = profiler or Profiler(enabled=False)
+    if plan_path is not None:
+        cmd = terraform.generate_cmd_string("apply", plan_path, json=tf.IsFlagged, input=False,
+                                            auto_approve=tf.IsFlagged, parallelism=parallelism)
+    else:
+        cmd = terraform.generate_cmd_string("apply", json=tf.IsFlagged, input=False, auto_approve=tf.IsFlagged,
+                                            target=targets, refresh=None if refresh else False,
+                                            parallelism=parallelism)
+    env = terraform.environment() if isinstance(terraform, Terraform) else None
+    stream = EventStream(cmd, parse_terraform_event, env=env, cwd=terraform.working_dir)
+    actions = Counter()
+    errors = []
+    started = {}
+    with profiler.span("terraform apply", "terraform", targets=targets) as span_args:
+        for event in stream:
+            if on_event is not None:
+                on_event(event)
+            if event.type == "apply_start":
+                started.update({event.resource: event.seconds()})
+            elif event.type in ("apply_complete", "apply_errored") and event.resource in started:
+                start = started.pop(event.resource)
+                profiler.add(event.resource, "terraform", start, event.seconds() - start, event.resource,
+                             action=event.action, status=event.type)
+            if event.type == "apply_complete":
+                actions.update([event.action])
+            elif event.level == "error":
+                errors.append(event.message)
+            if verbose and event.message:
+                print(event.message)
+        span_args.update(actions)
+
+    return stream.returncode, dict(actions), "\n".join(errors) or stream.output()
+
+
+def plan_terraform(terraform: tf.Terraform, plan_path: str, refresh: bool = True,
+                   profiler: Profiler = None) -> tuple:
+    """
+    Runs "terraform plan" saving the plan into a file and renders the saved plan as JSON.
+
+    :param terraform: Terraform of the working directory
+    :param plan_path: where to save the binary plan
+    :param refresh: if False, the state is not refreshed before planning
+    :param profiler: profiler recording the plan, nothing is recorded if None
+    :return: tuple of return code, plan rendered by "terraform show -json" (None on failure) and error messages
+    """
+    profiler = profiler or Profiler(enabled=False)
+    with profiler.span("terraform plan", "terraform", refresh=refresh):
+        ret_plan, out_plan, err_plan = terraform.plan(out=plan_path, refresh=refresh)
+        if ret_plan not in (0, 2):  # 2 is "succeeded with changes" of -detailed-exitcode
+            return ret_plan, None, err_plan
+
+        ret_show, out_show, err_show = terraform.cmd("show", plan_path, json=tf.IsFlagged)
+        if ret_show != 0:
+            return ret_show, None, err_show
+    return 0, json.loads(out_show), ""
+
+
+def planned_changes(plan: dict) -> dict:
+    """
+    Lists the modules a plan changes.
+
+    :param plan: plan rendered by "terraform show -json"
+    :return: dictionary mapping module name to the sorted list of actions planned for its resources
+    """
+    changes = {}
+    for resource_change in plan.get("resource_changes") or []:
+        actions = resource_change.get("change", {}).get("actions", [])
+        if set(actions) <= {"no-op", "read"}:
+            continue
+        action = "replace" if set(actions) == {"create", "delete"} else actions[0]
+        module_address = resource_change.get("module_address") or "module."  # "module.<name>" of instances
+        changes.setdefault(module_address.split(".")[1], set()).add(action)
+    return {module: sorted(actions) for module, actions in sorted(changes.items())}
+
+
+def apply_shard(shard_dir: str, plugin_dir: str = None, verbose: bool = False, profile: bool = False,
+                parallelism: int = None, delay: float = 0.0, env: dict = None) -> tuple:
+    """
+    Runs "terraform init" and "terraform apply" in a shard working directory.
+
+    Defined at module level, so it can be run in a worker process.
+
+    :param shard_dir: path to the shard working directory
+    :param plugin_dir: local filesystem provider mirror, see init_terraform
+    :param verbose: if True, progress of the apply gets printed as it arrives
+    :param profile: if True, timings of the shard are recorded
+    :param parallelism: maximum number of concurrent operations of the apply, the Terraform default if None
+    :param delay: seconds to wait before the apply, the backoff of a retried shard
+    :param env: environment variables of Terraform, see Terraform
+    :return: tuple of return code, applied actions (see apply_terraform), errors, outputs
+             of the shard (None on failure), recorded trace events and duration of the apply in seconds
+    """
+    time.sleep(delay)
+    profiler = Profiler(enabled=profile)
+    terraform = Terraform(shard_dir, env)
+    with profiler.span("apply shard", "terraform", shard=shard_dir):
+        ret_init, out_init, err_init = init_terraform(terraform, shard_dir, plugin_dir, profiler)
+        if ret_init != 0:
+            return ret_init, {}, err_init, None, profiler.events, 0.0
+
+        start = time.monotonic()
+        ret_apply, actions, err_apply = apply_terraform(terraform, verbose=verbose, profiler=profiler,
+                                                        parallelism=parallelism)
+        seconds = time.monotonic() - start
+        if ret_apply != 0:
+            return ret_apply, actions, err_apply, None, profiler.events, seconds
+        with profiler.span("read outputs", "terraform"):
+            outputs = TerraformState(terraform, shard_dir).outputs()
+    return ret_apply, actions, err_apply, outputs, profiler.events, seconds
+
+
+def destroy_shard(shard_dir: str, env: dict = None) -> tuple:
+    """
+    Runs "terraform destroy" in a shard working directory.
+
+    :param shard_dir: path to the shard working directory
+    :param env: environment variables of Terraform, see Terraform
+    :return: tuple of return code, stdout and stderr
+    """
+    terraform = Terraform(shard_dir, env)
+    return terraform.destroy(force=tf.IsNotFlagged, auto_approve=tf.IsFlagged)
 
 
 class Orchestrator:
     """
     A class providing configuration orchestration via Terraform.
-    """
-    terraform = tf.Terraform()
 
-    def __init__(self, infrastructure_description: dict, verbose: bool = False) -> None:
+    By default, all instances are modules of a single root module in the working directory.
+    In sharded mode, every instance (or every provider) gets its own working directory and state
+    under "shards", and the shards are applied concurrently.
+
+    All files are kept in the working directory given to the constructor and every Orchestrator has
+    its own Terraform, so several infrastructures can be orchestrated from threads of one process.
+
+    Applies run with a parallelism budget per provider (see ParallelismController). When a provider
+    reports throttling or rate limit errors, its budget is lowered and only the failed modules
+    (or shards) are applied again, after an exponential backoff starting at retry_delay seconds.
+    """
+    shards_dir = "shards"
+    plan_path = "rtib.tfplan"
+    plan_json_path = "rtib.tfplan.json"
+    shard_modes = ("instance", "provider")
+    changing_actions = ("create", "update", "replace", "delete")
+    max_retries = 3
+    retry_delay = 5.0
+
+    def __init__(self, infrastructure: Infrastructure, verbose: bool = False, shard_by: str = None,
+                 max_workers: int = 4, plugin_cache_dir: str = None, plugin_dir: str = None,
+                 profiler: Profiler = None, refresh: bool = True, key_type: str = "ed25519", working_dir: str = ".",
+                 providers_dir: str = None) -> None:
         """
         Orchestrator constructor.
 
-        :param infrastructure_description: dictionary containing infrastructure description
+        :param infrastructure: parsed infrastructure description
         :param verbose: if True, Terraform output gets printed.
+        :param shard_by: "instance" or "provider" to use one Terraform state per shard, None for a single state
+        :param max_workers: maximum number of shards applied at once
+        :param plugin_cache_dir: provider plugin cache shared by all infrastructures
+        :param plugin_dir: local filesystem provider mirror, providers are downloaded if None
+        :param profiler: profiler recording the orchestration, nothing is recorded if None
+        :param refresh: if False, the state is not refreshed before planning
+        :param key_type: type of generated SSH keys, "ed25519" or "rsa"
+        :param working_dir: directory of the infrastructure's Terraform configuration, state, keys and inventory
+        :param providers_dir: directory with provider modules, "providers" next to working_dir if None
         """
-        self.infrastructure_description = infrastructure_description.get("infrastructure")
+        if shard_by is not None and shard_by not in self.shard_modes:
+            raise ValueError("Unknown shard mode: {}".format(shard_by))
+        self.infrastructure = infrastructure
+        self.working_dir = working_dir
+        self.providers_dir = providers_dir if providers_dir is not None else self.__path("..", "providers")
         self.verbose = verbose
+        self.shard_by = shard_by
+        self.max_workers = max_workers
+        self.plugin_dir = plugin_dir
+        self.profiler = profiler or Profiler(enabled=False)
+        self.refresh = refresh
+        self.applied_plan = False
+        env = {}
+        if plugin_cache_dir is not None:
+            os.makedirs(plugin_cache_dir, exist_ok=True)
+            env.update({"TF_PLUGIN_CACHE_DIR": os.path.abspath(plugin_cache_dir)})
+        self.terraform = Terraform(working_dir, env)
+        self.state = TerraformState(self.terraform, working_dir)
+        self.inventory_path = self.__path("hosts.yaml")
+        self.inventory_lock = threading.Lock()  # guards writes of inventory_path
+        self.parallelism = ParallelismController(stats_path=self.__path(ParallelismController.stats_path))
+        self.keys = KeyStore(self.__path("ssh_keys"), key_type=key_type)
+
+    def __path(self, *parts: str) -> str:
+        """
+        Returns the path of a file of the infrastructure.
+
+        :param parts: path of the file relative to the working directory
+        :return: path of the file
+        """
+        return os.path.normpath(os.path.join(self.working_dir, *parts))
 
     @staticmethod
-    def __changed_infrastructure(apply_output: str) -> bool:
+    def __changed_infrastructure(actions: dict) -> bool:
         """
         Checks whether "terraform apply" changed the infrastructure.
 
-        :param apply_output: output of "terraform apply" command
+        :param actions: dictionary mapping action to the number of resources it was applied to
         :return: True if infrastructure changed, False otherwise
         """
-        for line in apply_output.split("\n"):
-            if "Apply complete!" in line:
-                return not all(changed == 0 for changed in [int(s) for s in line.split() if s.isdigit()])
+        return any(actions.get(action) for action in Orchestrator.changing_actions)
+
+    def __provision_keys(self, instances: list) -> dict:
+        """
+        Makes sure every host of the instances has an SSH key pair, see KeyStore.
 
-    def __parse_description(self) -> None:
+        :param instances: instances to provision keys of
+        :return: dictionary mapping instance name to the list of public keys of its hosts
+        """
+        totals = {}
+        for instance in instances:
+            total = instance.resolved_provider_arguments.get("total", 1)
+            totals.update({instance.name: total if isinstance(total, int) else 1})
+        with self.profiler.span("provision keys", "orchestrator", hosts=sum(totals.values())):
+            return self.keys.ensure(totals)
+
+    def __parse_description(self, instances: list = None, working_dir: str = None,
+                            providers_path: str = None, public_keys: dict = None) -> None:
         """
         Parses infrastructure description into input files for Terraform.
 
         Modules description along with variables is written into "main.tf.json".
         Definition of outputs to capture is stored to "outputs.tf.json".
+        Every module gets the public SSH keys of its hosts in the "public_keys" variable.
+
+        :param instances: instances to parse, all instances if None
+        :param working_dir: directory to write the files into, the working directory if None
+        :param providers_path: path to the providers directory relative to working_dir, derived from providers_dir if None
+        :param public_keys: dictionary mapping instance name to public keys of its hosts, provisioned if None
+        """
+        if instances is None:
+            instances = self.infrastructure.instances
+        if working_dir is None:
+            working_dir = self.working_dir
+        if providers_path is None:
+            providers_path = os.path.relpath(self.providers_dir, working_dir)
+        if public_keys is None:
+            public_keys = self.__provision_keys(instances)
+
+        with self.profiler.span("parse description", "orchestrator", working_dir=working_dir):
+            modules_dict = {"module": {}}
+            output_dict = {"output": {}}
+
+            for instance in instances:
+                path = "{}/{}".format(providers_path, instance.provider)
+                module_dict = {"source": path, "name": instance.name}
+                module_dict.update(instance.resolved_provider_arguments)
+                module_dict.update({"public_keys": public_keys.get(instance.name)})
+
+                modules_dict.get("module").update({instance.name: module_dict})
+                output_dict.get("output").update({instance.name: {"value": "${{module.{}}}".format(instance.name)}})
+
+            main_json = json.dumps(modules_dict, indent=2)
+            with open(os.path.join(working_dir, "main.tf.json"), "w") as main_tf_json:
+                main_tf_json.write(main_json)
+
+            outputs_json = json.dumps(output_dict, indent=2)
+            with open(os.path.join(working_dir, "outputs.tf.json"), "w") as outputs_tf_json:
+                outputs_tf_json.write(outputs_json)
+
+    def __parse_shards(self) -> dict:
         """
-        global_provider_args = self.infrastructure_description.get("global_arguments", {}).get("provider", {})
-        instances = self.infrastructure_description.get("instances")
+        Parses infrastructure description into one Terraform working directory per shard.
 
-        modules_dict = {"module": {}}
-        output_dict = {"output": {}}
+        Every shard directory gets its own "main.tf.json" and "outputs.tf.json",
+        SSH keys of all shards are provisioned at once.
 
-        for instance_dict in instances:
-            provider = instance_dict.get("provider")
-            name = instance_dict.get("name")
+        :return: dictionary mapping shard directory to the list of its instances
+        """
+        shards = {}
+        for instance in self.infrastructure:
+            key = instance.name if self.shard_by == "instance" else instance.provider
+            shards.setdefault(self.__path(self.shards_dir, key), []).append(instance)
 
-            path = "../providers/{}".format(provider)
-            module_dict = {"source": path, "name": name}
-            module_dict.update(global_provider_args)
+        public_keys = self.__provision_keys(self.infrastructure.instances)
+        for shard_dir, instances in shards.items():
+            os.makedirs(shard_dir, exist_ok=True)
+            self.__parse_description(instances, shard_dir, public_keys=public_keys)
 
-            arguments = instance_dict.get("arguments", {})
-            for argument, value in arguments.get("provider", {}).items():
-                module_dict.update({argument: value})
+        return shards
 
-            modules_dict.get("module").update({name: module_dict})
-            output_dict.get("output").update({name: {"value": "${{module.{}}}".format(name)}})
+    def __shard_hash(self, shard_dir: str, instances: list) -> str:
+        """
+        Computes a hash of the shard configuration, including the used provider modules.
 
-        main_json = json.dumps(modules_dict, indent=2)
-        with open("main.tf.json", "w") as main_tf_json:
-            main_tf_json.write(main_json)
+        :param shard_dir: path to the shard working directory
+        :param instances: instances of the shard
+        :return: hex digest of the configuration
+        """
+        digest = hashlib.sha256()
+        paths = [os.path.join(shard_dir, "main.tf.json"), os.path.join(shard_dir, "outputs.tf.json")]
+        for provider in sorted({instance.provider for instance in instances}):
+            for root, dirs, files in os.walk(os.path.join(self.providers_dir, provider)):
+                dirs.sort()
+                paths.extend(os.path.join(root, file) for file in sorted(files))
+
+        for path in paths:
+            digest.update(path.encode())
+            with open(path, "rb") as config_file:
+                digest.update(config_file.read())
+        return digest.hexdigest()
+
+    def __create_inventory(self, tf_output_dict: dict = None, merge: bool = False, removed: list = ()) -> dict:
+        """
+        Creates inventory file for later use by Ansible.
 
-        outputs_json = json.dumps(output_dict, indent=2)
-        with open("outputs.tf.json", "w") as outputs_tf_json:
-            outputs_tf_json.write(outputs_json)
+        The inventory is written into inventory_path.
 
-    def __create_inventory(self) -> None:
+        :param tf_output_dict: Terraform outputs to create the inventory from, read from Terraform if None
+        :param merge: if True, only groups of the modules in tf_output_dict are replaced in the existing inventory
+        :param removed: names of modules whose groups are dropped from the existing inventory when merging
+        :return: inventory groups keyed by module name
         """
-        Creates inventory file for later use by Ansible.
+        if tf_output_dict is None:
+            with self.profiler.span("read outputs", "terraform"):
+                tf_output_dict = self.state.outputs()
+        children = {}
 
-        The inventory is written into "hosts.yaml".
+        with self.profiler.span("create inventory", "orchestrator", modules=len(tf_output_dict)):
+            for module in tf_output_dict:
+                module_dict = tf_output_dict.get(module)
+                value_dict = module_dict.get("value")
+                hosts = {host: {"ansible_ssh_private_key_file": os.path.relpath(self.keys.path(module, i),
+                                                                                self.working_dir)}
+                         for i, host in enumerate(value_dict.get("hosts"))}
+
+                other_vars = {var: value for var, value in value_dict.items() if var != "hosts"}
+                if other_vars:
+                    children.update({module: {"hosts": hosts, "vars": other_vars}})
+                else:
+                    children.update({module: {"hosts": hosts, "vars": {}}})
+
+            with self.inventory_lock:
+                if merge and os.path.exists(self.inventory_path):
+                    with open(self.inventory_path) as inventory_file:
+                        inventory = yaml.safe_load(inventory_file)
+                    inventory.get("all").get("children").update(children)
+                    children = inventory.get("all").get("children")
+                    for module in removed:
+                        children.pop(module, None)
+
+                tf_output = dump_inventory({"all": {"children": children}})
+                with open(self.inventory_path, "w") as tf_output_yaml:
+                    tf_output_yaml.write(tf_output)
+
+        return children
+
+    def __list_resources(self, state: TerraformState = None) -> list:
         """
-        # None as empty string
-        yaml.SafeDumper.add_representer(
-            type(None),
-            lambda dumper, value: dumper.represent_scalar(u'tag:yaml.org,2002:null', ''))
+        Returns a list of resources orchestrated by Terraform.
 
-        tf_output_dict = self.terraform.output(json=tf.IsFlagged)
-        children = {}
+        :param state: state of the working directory to list, the main one if None
+        :return: list of resources
+        """
+        return (state or self.state).resources()
 
-        for module in tf_output_dict:
-            module_dict = tf_output_dict.get(module)
-            value_dict = module_dict.get("value")
-            hosts = {host: {"ansible_ssh_private_key_file": "ssh_keys/{}_{}".format(module, i)}
-                     for i, host in enumerate(value_dict.get("hosts"))}
+    @staticmethod
+    def __event_module(event: TerraformEvent) -> str:
+        """
+        Returns the module an event of "terraform apply" belongs to.
+
+        :param event: parsed event
+        :return: name of the module, None if the event does not belong to any
+        """
+        address = event.module or event.resource or ""
+        return address.split(".")[1] if address.startswith("module.") else None
 
-            other_vars = {var: value for var, value in value_dict.items() if var != "hosts"}
-            if other_vars:
-                children.update({module: {"hosts": hosts, "vars": other_vars}})
+    def __apply_with_retries(self, modules: list = None,
+                             on_event: Callable[[TerraformEvent], None] = None) -> dict:
+        """
+        Runs "terraform apply" of modules with the parallelism budget of their providers.
+
+        Terraform's parallelism is global to an apply, so the smallest budget of the applied providers is used.
+        When the apply fails on throttling or rate limit errors, budgets of the throttled providers
+        are lowered and only the failed modules are applied again after an exponential backoff.
+
+        :param modules: names of modules to apply, all modules if None
+        :param on_event: callback receiving every parsed event of all attempts
+        :raises TerraformError: when Terraform error occurs, or throttling persists after max_retries retries
+        :return: dictionary mapping action to the number of resources it was applied to in all attempts
+        """
+        provider_of = {instance.name: instance.provider for instance in self.infrastructure}
+        targets = None if modules is None else ["module." + module for module in modules]
+        modules = set(provider_of) if modules is None else set(modules)
+        applied = Counter()
+
+        for attempt in range(self.max_retries + 1):
+            providers = {provider_of.get(module) for module in modules} - {None}
+            parallelism = min((self.parallelism.parallelism(provider) for provider in providers), default=None)
+            completed = Counter()
+            failed = set()
+            throttled = set()
+
+            def on_attempt_event(event: TerraformEvent) -> None:
+                module = self.__event_module(event)
+                if event.type == "apply_complete":
+                    completed.update([provider_of.get(module)])
+                elif event.level == "error":
+                    failed.add(module)
+                    if self.parallelism.throttled(event.message):
+                        throttled.update({provider_of.get(module)} if provider_of.get(module) else providers)
+                if on_event is not None:
+                    on_event(event)
+
+            start = time.monotonic()
+            ret_apply, actions, err_apply = apply_terraform(self.terraform, targets, self.verbose, self.profiler,
+                                                            refresh=self.refresh, parallelism=parallelism,
+                                                            on_event=on_attempt_event)
+            seconds = time.monotonic() - start
+            applied.update(actions)
+            for provider in providers:
+                self.parallelism.record(provider, completed.get(provider, 0), seconds, provider in throttled)
+            self.parallelism.save()
+
+            if ret_apply == 0:
+                return dict(applied)
+            if not throttled or attempt == self.max_retries:
+                raise TerraformError(err_apply)
+
+            if None not in failed:  # errors of unknown modules retry all modules of the attempt
+                modules = failed
+                targets = ["module." + module for module in sorted(modules)]
+            with self.profiler.span("retry backoff", "orchestrator", attempt=attempt + 1, modules=sorted(modules)):
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def __orchestrate_shards(self, on_module_ready: Callable[[str, dict], None] = None) -> bool:
+        """
+        Applies changed shards concurrently and merges their outputs into a single inventory file.
+
+        Shards whose configuration did not change since their last successful apply are not refreshed,
+        their cached outputs are used instead. Shards of removed instances are destroyed.
+
+        :param on_module_ready: callback receiving the module name and its inventory group
+        :raises TerraformError: when Terraform error occurs in any of the shards
+        :return: True if infrastructure changed, False otherwise
+        """
+        shards = self.__parse_shards()
+        shards_dir = self.__path(self.shards_dir)
+        removed = [os.path.join(shards_dir, shard) for shard in os.listdir(shards_dir)
+                   if os.path.join(shards_dir, shard) not in shards]
+
+        tf_output_dict = {}
+        changed = False
+        errors = []
+
+        def shard_applied(outputs: dict) -> None:
+            tf_output_dict.update(outputs)
+            children = self.__create_inventory(tf_output_dict)
+            if on_module_ready is not None:
+                for module in outputs:
+                    on_module_ready(module, children.get(module))
+
+        pending = {}
+        for shard_dir, instances in shards.items():
+            shard_hash = self.__shard_hash(shard_dir, instances)
+            try:
+                with open(os.path.join(shard_dir, ".applied")) as applied_file:
+                    applied = json.load(applied_file)
+            except (OSError, ValueError):
+                applied = {}
+
+            if applied.get("hash") == shard_hash:
+                shard_applied(applied.get("outputs"))
             else:
-                children.update({module: {"hosts": hosts, "vars": {}}})
+                pending.update({shard_dir: shard_hash})
+
+        # shards of a provider applied at once share its budget
+        provider_of = {shard_dir: shards.get(shard_dir)[0].provider for shard_dir in pending}
+        sharing = Counter(provider_of.values())
+
+        def submit(shard_dir: str, attempt: int = 0) -> Future:
+            provider = provider_of.get(shard_dir)
+            parallelism = max(1, self.parallelism.parallelism(provider) // sharing.get(provider))
+            delay = self.retry_delay * 2 ** (attempt - 1) if attempt else 0.0
+            future = executor.submit(apply_shard, shard_dir, self.plugin_dir, self.verbose, self.profiler.enabled,
+                                     parallelism, delay, self.terraform.env)
+            futures.update({future: (shard_dir, pending.get(shard_dir), attempt)})
+            return future
+
+        with self.profiler.span("apply shards", "orchestrator", shards=len(shards)), \
+                ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(destroy_shard, shard_dir, self.terraform.env): (shard_dir, None, 0)
+                       for shard_dir in removed}
+            for shard_dir in pending:
+                submit(shard_dir)
+
+            running = set(futures)
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard_dir, shard_hash, attempt = futures.pop(future)
+                    ret, actions, err = future.result()[:3]
+                    if shard_hash is not None:
+                        self.profiler.extend(future.result()[4])
+                        throttled = ret != 0 and self.parallelism.throttled(err)
+                        self.parallelism.record(provider_of.get(shard_dir), sum(actions.values()),
+                                                future.result()[5], throttled)
+                        if throttled and attempt < self.max_retries:
+                            running.add(submit(shard_dir, attempt + 1))  # only the failed shard, after a backoff
+                            continue
+                    if ret != 0:
+                        errors.append("{}: {}".format(shard_dir, err))
+                        continue
+
+                    if shard_hash is None:
+                        shutil.rmtree(shard_dir)
+                        changed = True
+                        continue
+
+                    changed = Orchestrator.__changed_infrastructure(actions) or changed
+                    outputs = future.result()[3]
+                    if outputs is None:
+                        errors.append("{}: cannot read Terraform outputs".format(shard_dir))
+                        continue
+                    with open(os.path.join(shard_dir, ".applied"), "w") as applied_file:
+                        json.dump({"hash": shard_hash, "outputs": outputs}, applied_file)
+                    shard_applied(outputs)
+
+        if pending:
+            self.parallelism.save()
+        if errors:
+            raise TerraformError("\n".join(errors))
+        return changed
+
+    def __plan_hash(self) -> str:
+        """
+        Computes the key of a saved plan, a hash of the Terraform configuration parsed from the description,
+        the used provider modules and the state the plan was made against.
 
-        tf_output = yaml.safe_dump({"all": {"children": children}})
-        with open("hosts.yaml", "w") as tf_output_yaml:
-            tf_output_yaml.write(tf_output)
+        :return: hex digest
+        """
+        digest = hashlib.sha256(self.__shard_hash(self.working_dir, self.infrastructure.instances).encode())
+        if os.path.isfile(self.__path("terraform.tfstate")):
+            with open(self.__path("terraform.tfstate"), "rb") as state_file:
+                digest.update(state_file.read())
+        return digest.hexdigest()
 
-    def __list_resources(self) -> list:
+    def __saved_plan(self) -> dict:
         """
-        Returns a list of resources orchestrated by Terraform.
+        Reads the saved plan, if it was made for the current description and state.
 
-        :return: list of resources
+        :return: the saved plan (see plan_infrastructure), None if there is none or it is stale
+        """
+        try:
+            with open(self.__path(self.plan_json_path)) as plan_file:
+                saved = json.load(plan_file)
+        except (OSError, ValueError):
+            return None
+        if saved.get("hash") != self.__plan_hash() or not os.path.isfile(self.__path(self.plan_path)):
+            return None
+        return saved
+
+    def __remove_plan(self) -> None:
         """
-        return self.terraform.state_cmd("list")[1].split('\n')
+        Removes the saved plan, e.g. after it was applied.
+        """
+        for path in (self.__path(self.plan_path), self.__path(self.plan_json_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def plan_infrastructure(self) -> dict:
+        """
+        Parses infrastructure description and saves a Terraform plan of it.
+
+        The binary plan is saved into "rtib.tfplan" and its JSON rendering, keyed to the hash of the description
+        and state, into "rtib.tfplan.json". The next orchestration applies the saved plan as long as
+        the description and state did not change since.
+
+        :raises TerraformError: when Terraform error occurs
+        :raises ValueError: in sharded mode, shards are planned and applied on their own
+        :return: dictionary mapping the modules the plan changes to the sorted list of their planned actions
+        """
+        if self.shard_by is not None:
+            raise ValueError("Saved plans are not supported in sharded mode")
+
+        self.__parse_description()
+
+        ret_init, out_init, err_init = init_terraform(self.terraform, self.working_dir, self.plugin_dir, self.profiler)
+        if ret_init != 0:
+            raise TerraformError(err_init)
+
+        self.__remove_plan()
+        ret_plan, plan, err_plan = plan_terraform(self.terraform, self.plan_path, self.refresh, self.profiler)
+        if ret_plan != 0:
+            raise TerraformError(err_plan)
+
+        changes = planned_changes(plan)
+        with open(self.__path(self.plan_json_path), "w") as plan_file:
+            json.dump({"hash": self.__plan_hash(), "refresh": self.refresh, "changes": changes, "plan": plan},
+                      plan_file)
+        return changes
 
     def orchestrate_infrastructure(self) -> bool:
         """
         Parses infrastructure description, runs Terraform and creates an inventory file.
 
-        If verbosity is set to True, also prints the Terraform output.
+        If a plan saved by plan_infrastructure still matches the description and state, it is applied
+        without planning again, or not at all if it changes nothing. Either way the saved plan is used once,
+        later orchestrations refresh and plan again.
+
+        If verbosity is set to True, also prints the Terraform progress.
 
         :raises TerraformError: when Terraform error occurs
         :return: True if infrastructure changed, False otherwise
         """
+        if self.shard_by is not None:
+            return self.__orchestrate_shards()
+
         self.__parse_description()
 
-        ret_init, out_init, err_init = self.terraform.init()
+        ret_init, out_init, err_init = init_terraform(self.terraform, self.working_dir, self.plugin_dir, self.profiler)
         if ret_init != 0:
             raise TerraformError(err_init)
 
-        ret_apply, out_apply, err_apply = self.terraform.apply(skip_plan=True)
-        if ret_apply != 0:
-            raise TerraformError(err_apply)
+        saved = self.__saved_plan()
+        self.applied_plan = saved is not None
+        if saved is not None and not saved.get("changes"):
+            self.__remove_plan()  # single-use, out-of-band changes are picked up by the next orchestration
+            self.__create_inventory()
+            return False
+
+        if saved is not None:
+            ret_apply, actions, err_apply = apply_terraform(self.terraform, verbose=self.verbose,
+                                                            profiler=self.profiler, plan_path=self.plan_path)
+            self.__remove_plan()  # applied or failed, the plan is stale either way
+            if ret_apply != 0:
+                raise TerraformError(err_apply)
+        else:
+            actions = self.__apply_with_retries()
 
         self.__create_inventory()
 
-        if self.verbose:
-            print(out_apply)
+        return Orchestrator.__changed_infrastructure(actions)
 
-        return Orchestrator.__changed_infrastructure(out_apply)
+    def orchestrate_modules(self, on_module_ready: Callable[[str, dict], None]) -> bool:
+        """
+        Parses infrastructure description and applies all modules at once, reporting them as they finish.
+
+        The modules are applied concurrently by a single "terraform apply". As soon as all planned changes
+        of a module are applied and its new output is in the state, its group is updated in the inventory file
+        and on_module_ready is called with the module name and its inventory group, so its configuration
+        can start while the remaining modules are being applied. Unchanged modules are reported once applying
+        starts, modules whose output cannot be told apart from the previous one (or Terraform versions
+        without planned changes in their output) are reported after the apply. In sharded mode,
+        the shards are applied concurrently and on_module_ready is called for the modules of each shard
+        as soon as the shard is applied.
+
+        :param on_module_ready: callback receiving the module name and its inventory group
+        :raises TerraformError: when Terraform error occurs
+        :return: True if infrastructure changed, False otherwise
+        """
+        if self.shard_by is not None:
+            return self.__orchestrate_shards(on_module_ready)
+
+        self.__parse_description()
+
+        ret_init, out_init, err_init = init_terraform(self.terraform, self.working_dir, self.plugin_dir, self.profiler)
+        if ret_init != 0:
+            raise TerraformError(err_init)
+
+        previous = self.state.outputs()
+        planned = {}  # module name to addresses of its planned changes not applied yet
+        ready = set()
+
+        def report(modules: list) -> None:
+            try:
+                outputs = self.state.outputs()  # local state is written while the apply runs
+            except ValueError:
+                return  # state file caught mid-write, the modules are reported on a later event
+            for module in modules:
+                if module in ready or module not in self.infrastructure.names or outputs.get(module) is None:
+                    continue
+                if module in planned and outputs.get(module) == previous.get(module):
+                    continue  # output of the module not written yet
+                ready.add(module)
+                on_module_ready(module, self.__create_inventory({module: outputs.get(module)}, merge=True).get(module))
+
+        started = False
+
+        def on_event(event: TerraformEvent) -> None:
+            nonlocal started
+            module = self.__event_module(event)
+            if module is None:
+                return
+            if event.type == "planned_change":
+                planned.setdefault(module, set()).add(event.resource)
+            elif event.type == "apply_start" and not started:
+                started = True
+                if planned:  # all changes are planned before the first one is applied
+                    report([name for name in self.infrastructure.names if name not in planned])
+            elif event.type == "apply_complete":
+                planned.get(module, set()).discard(event.resource)
+                report([name for name, pending in planned.items() if not pending])
+
+        actions = self.__apply_with_retries(on_event=on_event)
+
+        inventory = self.__create_inventory()
+        for module in self.infrastructure.names:
+            if module not in ready:
+                on_module_ready(module, inventory.get(module))
+        return Orchestrator.__changed_infrastructure(actions)
+
+    def orchestrate_instances(self, instances: list, removed: list = ()) -> bool:
+        """
+        Parses infrastructure description and applies only the modules of the given instances.
+
+        Modules of removed instances are applied too, which destroys their resources. Only groups
+        of the applied and removed modules are updated in the inventory file. In sharded mode,
+        the shards are orchestrated as usual, unchanged shards are neither refreshed nor applied.
+
+        :param instances: names of instances to apply
+        :param removed: names of instances removed from the description since the last apply
+        :raises TerraformError: when Terraform error occurs
+        :return: True if infrastructure changed, False otherwise
+        """
+        if self.shard_by is not None:
+            return self.__orchestrate_shards()
+        if not instances and not removed:
+            return False
+
+        self.__parse_description()
+
+        ret_init, out_init, err_init = init_terraform(self.terraform, self.working_dir, self.plugin_dir, self.profiler)
+        if ret_init != 0:
+            raise TerraformError(err_init)
+
+        actions = self.__apply_with_retries(list(instances) + list(removed))
+
+        outputs = self.state.outputs()
+        self.__create_inventory({instance: outputs.get(instance) for instance in instances if instance in outputs},
+                                merge=True, removed=removed)
+
+        return Orchestrator.__changed_infrastructure(actions)
+
+    def __destroy_shards(self) -> tuple:
+        """
+        Destroys all shards concurrently.
+
+        :return: tuple of return code, stdout and stderr, return code is non-zero if any shard failed
+        """
+        shards_dir = self.__path(self.shards_dir)
+        shard_dirs = [os.path.join(shards_dir, shard) for shard in os.listdir(shards_dir)]
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(destroy_shard, shard_dirs, [self.terraform.env] * len(shard_dirs)))
+
+        ret = max([result[0] for result in results], default=0)
+        out = "\n".join(result[1] for result in results)
+        err = "\n".join("{}: {}".format(shard_dir, result[2]) for shard_dir, result in zip(shard_dirs, results)
+                        if result[0] != 0)
+        return ret, out, err
 
     def destroy_infrastructure(self) -> None:
         """
@@ -145,9 +910,14 @@ class Orchestrator:
 
         :raises TerraformError: when Terraform error occurs
         """
-        ret_destroy, out_destroy, err_destroy = self.terraform.destroy(force=tf.IsNotFlagged, auto_approve=tf.IsFlagged)
+        with self.profiler.span("terraform destroy", "terraform"):
+            if self.shard_by is not None and os.path.isdir(self.__path(self.shards_dir)):
+                ret_destroy, out_destroy, err_destroy = self.__destroy_shards()
+            else:
+                ret_destroy, out_destroy, err_destroy = self.terraform.destroy(force=tf.IsNotFlagged,
+                                                                               auto_approve=tf.IsFlagged)
         if ret_destroy == 0:
-            shutil.rmtree(os.getcwd())
+            shutil.rmtree(os.path.abspath(self.working_dir))
         else:
             raise TerraformError(err_destroy)
 
@@ -158,15 +928,44 @@ class Orchestrator:
         """
         Rebuilds the specified instance.
 
+        Only the module of the instance is applied and only its group is updated in the inventory file.
+        In sharded mode, only the shard containing the instance is applied.
+
+        If verbosity is set to True, also prints the Terraform progress.
+
         :param instance: name of the instance to rebuild
-        :raises TerraformError: when Terraform error occurs
+        :raises ValueError: when there is no such instance in the description
+        :raises TerraformError: when Terraform error occurs or the instance has no output after the apply
         """
-        resources = self.__list_resources()
-        parser = compile("module.{module_name}.{}")
-        for resource in resources:
-            if resource == "":
-                continue
-            parse_res = parser.parse(resource)
-            if instance == parse_res["module_name"]:
-                self.terraform.taint(resource)
-        self.orchestrate_infrastructure()
+        if instance not in self.infrastructure:
+            raise ValueError("Unknown instance: {}".format(instance))
+        terraform = self.terraform
+        state = self.state
+        if self.shard_by is not None:
+            key = instance if self.shard_by == "instance" else self.infrastructure.get(instance).provider
+            shard_dir = self.__path(self.shards_dir, key)
+            terraform = Terraform(shard_dir, self.terraform.env)
+            state = TerraformState(terraform, shard_dir)
+            if os.path.exists(os.path.join(shard_dir, ".applied")):
+                os.remove(os.path.join(shard_dir, ".applied"))  # forces apply of the shard
+
+        with self.profiler.span("terraform taint", "terraform", instance=instance):
+            for resource in state.module_resources(instance):
+                terraform.taint(resource)
+
+        if self.shard_by is not None:
+            self.orchestrate_infrastructure()  # unchanged shards are neither refreshed nor applied
+            return
+
+        self.__parse_description()
+
+        ret_init, out_init, err_init = init_terraform(self.terraform, self.working_dir, self.plugin_dir, self.profiler)
+        if ret_init != 0:
+            raise TerraformError(err_init)
+
+        self.__apply_with_retries([instance])
+
+        output = self.state.outputs().get(instance)
+        if output is None:
+            raise TerraformError("Instance {} has no output after the apply".format(instance))
+        self.__create_inventory({instance: output}, merge=True)
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import threading
+
+
+class ParallelismController:
+    """
+    A class keeping a Terraform parallelism budget per provider.
+
+    The budget is halved when a provider reports throttling or rate limit errors and grows
+    by a fixed step after every apply without them. Budgets and the achieved resources per minute
+    are kept in stats_path, so the next run of the infrastructure starts where the last one ended.
+    """
+    stats_path = ".parallelism.json"
+    # only rate limits of the API, timeouts and exhausted quotas are not helped by a lower parallelism
+    throttling_patterns = re.compile(
+        r"throttl|rate ?exceeded|rate limit|requestlimitexceeded|too ?many ?requests|\b429\b|over ?limit|"
+        r"\bslow ?down\b", re.IGNORECASE)
+
+    def __init__(self, initial: int = 10, minimum: int = 1, maximum: int = 50, step: int = 2,
+                 stats_path: str = None) -> None:
+        """
+        ParallelismController constructor.
+
+        :param initial: budget of providers without recorded stats, the Terraform default
+        :param minimum: smallest budget
+        :param maximum: largest budget
+        :param step: budget increase after an apply without throttling
+        :param stats_path: where the stats are kept, stats_path of the class if None
+        """
+        if stats_path is not None:
+            self.stats_path = stats_path
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.__stats = None
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def throttled(cls, message: str) -> bool:
+        """
+        Checks whether an error is caused by throttling or rate limits of the provider's API.
+
+        Such errors are transient and the failed modules can be retried with a lower parallelism.
+
+        :param message: error message of Terraform
+        :return: True if the error is a throttling error, False otherwise
+        """
+        return bool(message) and cls.throttling_patterns.search(message) is not None
+
+    def __load(self) -> dict:
+        """
+        Reads the recorded stats, once.
+
+        :return: dictionary mapping provider to its stats
+        """
+        if self.__stats is None:
+            try:
+                with open(self.stats_path) as stats_file:
+                    self.__stats = json.load(stats_file)
+            except (OSError, ValueError):
+                self.__stats = {}
+        return self.__stats
+
+    def parallelism(self, provider: str) -> int:
+        """
+        Returns the current budget of a provider.
+
+        :param provider: name of the provider
+        :return: Terraform parallelism the provider's resources may be applied with
+        """
+        with self.__lock:
+            return self.__load().get(provider, {}).get("parallelism", self.initial)
+
+    def record(self, provider: str, resources: int, seconds: float, throttled: bool) -> int:
+        """
+        Records an apply of the provider's resources and adjusts its budget.
+
+        :param provider: name of the provider
+        :param resources: number of resources applied
+        :param seconds: duration of the apply
+        :param throttled: True if the provider reported throttling errors
+        :return: the new budget
+        """
+        with self.__lock:
+            stats = self.__load().setdefault(provider, {"parallelism": self.initial})
+            parallelism = stats.get("parallelism", self.initial)
+            if throttled:
+                parallelism = max(self.minimum, parallelism // 2)
+                stats.update({"throttled": stats.get("throttled", 0) + 1})
+            else:
+                parallelism = min(self.maximum, parallelism + self.step)
+            stats.update({"parallelism": parallelism})
+            if resources and seconds > 0:
+                stats.update({"resources_per_minute": round(resources * 60 / seconds, 2)})
+            return parallelism
+
+    def save(self) -> None:
+        """
+        Writes the stats into stats_path, atomically.
+        """
+        with self.__lock:
+            stats = json.dumps(self.__load(), indent=2, sort_keys=True)
+            with open(self.stats_path + ".tmp", "w") as stats_file:
+                stats_file.write(stats)
+            os.replace(self.stats_path + ".tmp", self.stats_path)
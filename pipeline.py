@@ -0,0 +1,109 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from orchestrator import Orchestrator
+from manager import Manager
+from readiness import ReadinessProber
+
+
+class Pipeline:
+    """
+    A class overlapping configuration orchestration and management.
+
+    Every module is configured as soon as it is applied, its hosts accept SSH connections and the modules
+    it references (via "redirect_to" or "accept_from") have addresses in the inventory.
+    Inventory snapshots of the modules are kept in snapshot_dir in the working directory of the manager.
+    """
+    snapshot_dir = ".pipeline"
+
+    def __init__(self, orchestrator: Orchestrator, manager: Manager, max_workers: int = 4,
+                 boot_timeout: float = 300.0, probe: str = "banner", ssh_port: int = 22) -> None:
+        """
+        Pipeline constructor.
+
+        :param orchestrator: Orchestrator applying the modules
+        :param manager: Manager configuring the modules, its inventory_path must be set
+        :param max_workers: maximum number of modules configured at once
+        :param boot_timeout: number of seconds each host is given to accept SSH connections
+        :param probe: readiness probe mode, see ReadinessProber
+        :param ssh_port: SSH port probed for readiness
+        """
+        self.orchestrator = orchestrator
+        self.manager = manager
+        self.max_workers = max_workers
+        self.boot_timeout = boot_timeout
+        self.probe = probe
+        self.ssh_port = ssh_port
+        self.snapshot_dir = os.path.normpath(os.path.join(manager.working_dir, self.snapshot_dir))
+        self.timings = {}
+        self.__lock = threading.Lock()
+        self.__applied = set()
+        self.__submitted = set()
+        self.__futures = []
+        self.__executor = None
+        self.__start = None
+
+    def __dependencies(self, module: str) -> set:
+        """
+        Returns names of instances the module references in its role arguments.
+
+        :param module: name of the module
+        :return: set of referenced instance names
+        """
+        instance = self.orchestrator.infrastructure.get(module)
+        return set(instance.references) if instance is not None else set()
+
+    def __module_ready(self, module: str, group: dict) -> None:
+        """
+        Handles the "ready" event emitted by Orchestrator after a module is applied.
+
+        :param module: name of the applied module
+        :param group: inventory group of the module
+        """
+        with self.__lock:
+            self.timings.update({module: {"applied": time.monotonic() - self.__start}})
+            self.__applied.add(module)
+            for pending in sorted(self.__applied - self.__submitted):
+                if self.__dependencies(pending) <= self.__applied:
+                    self.__submitted.add(pending)
+                    self.__futures.append(self.__executor.submit(self.__configure, pending))
+
+    def __configure(self, module: str) -> None:
+        """
+        Waits for the module's hosts and configures them.
+
+        :param module: name of the module
+        """
+        inventory_path = os.path.join(self.snapshot_dir, module + ".yaml")
+        with self.orchestrator.inventory_lock:
+            self.manager.prepare(inventory_path, [module])
+
+        with self.manager.profiler.span("wait for hosts", "readiness", groups=[module]):
+            ReadinessProber(inventory_path, timeout=self.boot_timeout, mode=self.probe,
+                            port=self.ssh_port).wait([module])
+        ready = time.monotonic() - self.__start
+
+        self.manager.run([module], inventory_path)
+        with self.__lock:
+            self.timings.get(module).update({"ready": ready, "configured": time.monotonic() - self.__start})
+
+    def run(self) -> dict:
+        """
+        Applies and configures the infrastructure module by module.
+
+        :raises TerraformError: when Terraform error occurs
+        :raises ReadinessError: when hosts of a module do not accept SSH connections in time
+        :raises AnsibleError: when Ansible error occurs
+        :return: seconds since start at which each module was applied, ready and configured
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self.__start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self.__executor = executor
+            self.orchestrator.orchestrate_modules(self.__module_ready)
+
+        for future in self.__futures:
+            future.result()  # re-raises the first configuration error
+        return self.timings
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class Profiler:
+    """
+    A class recording timing spans of RTIB phases as Chrome trace events.
+
+    Spans measured in this process are recorded per thread, so spans opened inside other spans nest.
+    Spans measured by Terraform or Ansible are added on named tracks (a resource, a host).
+    The trace can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+    A disabled profiler records nothing, so components can always use one.
+    """
+    def __init__(self, enabled: bool = True) -> None:
+        """
+        Profiler constructor.
+
+        :param enabled: if False, nothing is recorded
+        """
+        self.enabled = enabled
+        self.events = []
+        self.__tracks = {}
+        self.__threads = set()
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, category: str = "rtib", **args) -> Iterator[dict]:
+        """
+        Measures the duration of the enclosed block.
+
+        :param name: name of the span
+        :param category: category of the span, e.g. "terraform" or "ansible"
+        :param args: additional information shown with the span
+        :return: context manager yielding the span arguments, they can be updated inside the block
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        start = time.time()
+        counter = time.perf_counter()
+        try:
+            yield args
+        finally:
+            thread = threading.current_thread()
+            self.__record({"name": name, "cat": category, "ph": "X", "ts": start * 1e6,
+                           "dur": (time.perf_counter() - counter) * 1e6, "pid": os.getpid(), "tid": thread.ident,
+                           "args": args}, thread.ident, thread.name)
+
+    def add(self, name: str, category: str, start: float, duration: float, track: str, **args) -> None:
+        """
+        Adds a span measured outside of this process.
+
+        :param name: name of the span
+        :param category: category of the span
+        :param start: start of the span, seconds since the epoch
+        :param duration: duration of the span in seconds
+        :param track: name of the track (row) the span is shown on
+        :param args: additional information shown with the span
+        """
+        if not self.enabled:
+            return
+
+        with self.__lock:
+            tid = self.__tracks.setdefault(track, -(len(self.__tracks) + 1))  # negative ids never clash with threads
+        self.__record({"name": name, "cat": category, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                       "pid": os.getpid(), "tid": tid, "args": args}, tid, track)
+
+    def extend(self, events: list) -> None:
+        """
+        Adds events recorded by a profiler in another process.
+
+        :param events: trace events of the other profiler
+        """
+        if self.enabled and events:
+            with self.__lock:
+                self.events.extend(events)
+
+    def __record(self, event: dict, tid: int, track: str) -> None:
+        """
+        Records a trace event, naming its track on first use.
+
+        :param event: trace event
+        :param tid: id of the track
+        :param track: name of the track
+        """
+        with self.__lock:
+            if (event.get("pid"), tid) not in self.__threads:
+                self.__threads.add((event.get("pid"), tid))
+                self.events.append({"name": "thread_name", "ph": "M", "pid": event.get("pid"), "tid": tid,
+                                    "args": {"name": track}})
+            self.events.append(event)
+
+    def write(self, path: str) -> None:
+        """
+        Writes the recorded events as a Chrome trace JSON file.
+
+        :param path: path of the trace file
+        """
+        with self.__lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(path, "w") as trace_file:
+            json.dump(trace, trace_file, default=str)
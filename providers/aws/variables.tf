@@ -17,4 +17,8 @@ variable "name" {
 
 variable "total" {
   default = 1
-}
\ No newline at end of file
+}
+
+variable "public_keys" {
+  type = list(string)
+}
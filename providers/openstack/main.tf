@@ -24,15 +24,12 @@ resource "openstack_compute_instance_v2" "openstack_instance" {
   network {
     name = var.network_name
   }
-  provisioner "local-exec" {
-    command = "echo \"${openstack_compute_keypair_v2.keypair.*.private_key[count.index]}\" > ssh_keys/\"${var.name}_${count.index}\" && chmod 600 ssh_keys/\"${var.name}_${count.index}\""
-  }
 }
 
 resource "openstack_compute_keypair_v2" "keypair" {
   count = var.total
   name = "${var.name}_${count.index}_key"
-
+  public_key = var.public_keys[count.index]
 }
 
 resource "openstack_networking_floatingip_v2" "fip" {
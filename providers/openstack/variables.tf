@@ -42,3 +42,8 @@ variable "infrastructure_name" {
   default = "test_infrastructure"
   type = string
 }
+
+
+variable "public_keys" {
+  type = list(string)
+}
@@ -0,0 +1,124 @@
+import asyncio
+import shutil
+import time
+import yaml
+
+from exceptions import ReadinessError
+
+
+class ReadinessProber:
+    """
+    A class waiting for orchestrated hosts to accept SSH connections.
+    """
+    modes = ("port", "banner", "keyscan")
+
+    def __init__(self, inventory_path: str, timeout: float = 300.0, interval: float = 2.0,
+                 mode: str = "banner", port: int = 22) -> None:
+        """
+        ReadinessProber constructor.
+
+        :param inventory_path: path to the inventory file created by Orchestrator
+        :param timeout: number of seconds each host is given to become reachable
+        :param interval: number of seconds between two probes of the same host
+        :param mode: "port" only connects to the SSH port, "banner" also waits for the SSH banner,
+                     "keyscan" waits for ssh-keyscan to return a host key
+        :param port: SSH port to probe
+        :raises ValueError: when the mode is unknown or ssh-keyscan is not installed for the "keyscan" mode
+        """
+        if mode not in self.modes:
+            raise ValueError("Unknown probe mode: {}".format(mode))
+        if mode == "keyscan" and shutil.which("ssh-keyscan") is None:
+            raise ValueError("ssh-keyscan is not installed, it is required by the keyscan probe mode")
+        self.inventory_path = inventory_path
+        self.timeout = timeout
+        self.interval = interval
+        self.mode = mode
+        self.port = port
+
+    def __read_hosts(self, groups: list = None) -> dict:
+        """
+        Reads hosts from the inventory file.
+
+        :param groups: names of inventory groups to read, all groups if None
+        :return: dictionary mapping host address to its group
+        """
+        with open(self.inventory_path) as inventory_file:
+            inventory = yaml.safe_load(inventory_file)
+
+        hosts = {}
+        for group, group_dict in inventory.get("all").get("children").items():
+            if groups is not None and group not in groups:
+                continue
+            for host in group_dict.get("hosts") or {}:
+                hosts.update({host: group})
+        return hosts
+
+    async def __check(self, host: str, timeout: float) -> bool:
+        """
+        Probes the host once.
+
+        :param host: address of the host
+        :param timeout: maximum number of seconds the probe may take
+        :return: True if the host is ready, False otherwise
+        """
+        if self.mode == "keyscan":
+            process = await asyncio.create_subprocess_exec(
+                "ssh-keyscan", "-T", str(max(1, int(timeout))), "-p", str(self.port), host,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            out, _ = await process.communicate()
+            return process.returncode == 0 and bool(out.strip())
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, self.port), timeout)
+        try:
+            if self.mode == "banner":
+                banner = await asyncio.wait_for(reader.readline(), timeout)
+                return banner.startswith(b"SSH-")
+            return True
+        finally:
+            writer.close()
+
+    async def __probe(self, host: str) -> float:
+        """
+        Probes the host until it is ready or its deadline passes.
+
+        :param host: address of the host
+        :return: number of seconds it took the host to become ready, None if the deadline passed
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                if await self.__check(host, min(remaining, max(self.interval, 5.0))):
+                    return time.monotonic() - start
+            except (OSError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(min(self.interval, max(deadline - time.monotonic(), 0)))
+
+    async def __probe_all(self, hosts: list) -> dict:
+        """
+        Probes all hosts concurrently.
+
+        :param hosts: list of host addresses
+        :return: dictionary mapping host address to its time-to-ready (None if not ready)
+        """
+        times = await asyncio.gather(*(self.__probe(host) for host in hosts))
+        return dict(zip(hosts, times))
+
+    def wait(self, groups: list = None) -> dict:
+        """
+        Waits until every host in the inventory accepts SSH connections.
+
+        :param groups: names of inventory groups to wait for, all groups if None
+        :raises ReadinessError: when some hosts are not ready before their deadline
+        :return: dictionary mapping host address to the number of seconds it took to become ready
+        """
+        hosts = self.__read_hosts(groups)
+        times = asyncio.run(self.__probe_all(list(hosts)))
+
+        not_ready = ["{} ({})".format(host, hosts.get(host)) for host, ready in times.items() if ready is None]
+        if not_ready:
+            raise ReadinessError("Hosts not reachable after {} seconds: {}".format(self.timeout, ", ".join(not_ready)))
+        return times
@@ -0,0 +1,397 @@
+"""
+TCP redirector deployed by the pipe_redirector role (redirect_engine: rtib).
+
+The module is copied to the redirector host and run by its system Python, so it only uses the standard
+library (uvloop is used if installed). Every listening port is forwarded to the same (or a mapped) port
+of one of the backends, chosen round-robin or by the least number of active connections.
+Backends failing a TCP health check are skipped until they recover, a connection refused by a backend
+is retried with the next one.
+On Linux with Python 3.10+, data is moved between the sockets with splice(2), so it never enters
+user space; elsewhere it is copied through a reusable buffer.
+
+Usage: python3 redirector.py --listen 80 --listen 8443:443 --backend 10.0.0.1 --backend 10.0.0.2
+"""
+import os
+import socket
+import asyncio
+import argparse
+import itertools
+from typing import List, Optional, Tuple
+
+
+class Backend:
+    """
+    A class representing a backend host the connections are forwarded to.
+    """
+    def __init__(self, host: str) -> None:
+        """
+        Backend constructor.
+
+        :param host: address of the backend
+        """
+        self.host = host
+        self.healthy = True
+        self.active = 0
+        self.connections = 0
+
+    def __repr__(self) -> str:
+        return "Backend({!r}, healthy={}, active={})".format(self.host, self.healthy, self.active)
+
+
+class BackendPool:
+    """
+    A class choosing backends for new connections.
+
+    When no backend is healthy, all backends are used, so the redirector never drops traffic
+    only because of failed health checks.
+    """
+    strategies = ("round-robin", "least-connections")
+
+    def __init__(self, hosts: List[str], strategy: str = "round-robin") -> None:
+        """
+        BackendPool constructor.
+
+        :param hosts: addresses of the backends
+        :param strategy: "round-robin" or "least-connections"
+        """
+        if strategy not in self.strategies:
+            raise ValueError("Unknown strategy: {}".format(strategy))
+        if not hosts:
+            raise ValueError("There must be at least one backend")
+        self.backends = [Backend(host) for host in hosts]
+        self.strategy = strategy
+        self.__counter = itertools.count()
+
+    def choose(self, exclude: List[Backend] = ()) -> Optional[Backend]:
+        """
+        Chooses the backend of a new connection.
+
+        :param exclude: backends that must not be chosen, e.g. those that already refused the connection
+        :return: the chosen backend, None if all backends are excluded
+        """
+        remaining = [backend for backend in self.backends if backend not in exclude]
+        candidates = [backend for backend in remaining if backend.healthy] or remaining
+        if not candidates:
+            return None
+        if self.strategy == "least-connections":
+            return min(candidates, key=lambda backend: backend.active)
+        return candidates[next(self.__counter) % len(candidates)]
+
+
+def parse_listener(value: str) -> Tuple[int, int]:
+    """
+    Parses a listener argument.
+
+    :param value: "PORT" or "PORT:BACKEND_PORT"
+    :return: tuple of the listening port and the backend port
+    """
+    port, _, backend_port = value.partition(":")
+    return int(port), int(backend_port or port)
+
+
+class Redirector:
+    """
+    A class forwarding TCP connections from listening ports to a pool of backends.
+    """
+    def __init__(self, listeners: List[Tuple[int, int]], pool: BackendPool, bind: str = "0.0.0.0",
+                 health_port: int = None, health_interval: float = 5.0, health_timeout: float = 2.0,
+                 splice: bool = None, chunk_size: int = 65536) -> None:
+        """
+        Redirector constructor.
+
+        :param listeners: list of tuples of a listening port (0 for any free port) and a backend port
+        :param pool: backends the connections are forwarded to
+        :param bind: address to listen on
+        :param health_port: port of the backends probed by health checks, the first backend port if None
+        :param health_interval: number of seconds between two health checks, no checks if 0
+        :param health_timeout: maximum number of seconds a health check may take
+        :param splice: if True, data is moved with splice(2), autodetected if None
+        :param chunk_size: maximum number of bytes moved at once
+        """
+        self.listeners = listeners
+        self.pool = pool
+        self.bind = bind
+        self.health_port = health_port if health_port is not None else listeners[0][1]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.splice = hasattr(os, "splice") if splice is None else splice
+        self.chunk_size = chunk_size
+        self.addresses = []
+        self.transferred = 0
+        self.__sockets = []
+        self.__tasks = []
+        self.__connections = set()
+
+    async def start(self) -> None:
+        """
+        Starts listening and health checking.
+
+        Bound addresses are stored in addresses, in the order of listeners.
+        """
+        loop = asyncio.get_running_loop()
+        for port, backend_port in self.listeners:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((self.bind, port))
+            server.listen(1024)
+            server.setblocking(False)
+            self.__sockets.append(server)
+            self.addresses.append(server.getsockname())
+            self.__tasks.append(loop.create_task(self.__accept(server, backend_port)))
+        if self.health_interval:
+            self.__tasks.append(loop.create_task(self.__check_health()))
+
+    async def close(self) -> None:
+        """
+        Stops listening and closes all forwarded connections.
+        """
+        tasks = self.__tasks + list(self.__connections)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in self.__sockets:
+            server.close()
+        self.__tasks, self.__sockets = [], []
+
+    async def __accept(self, server: socket.socket, backend_port: int) -> None:
+        """
+        Accepts connections on a listening socket.
+
+        :param server: listening socket
+        :param backend_port: port of the backends the connections are forwarded to
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            client, _ = await loop.sock_accept(server)
+            task = loop.create_task(self.__forward(client, backend_port))
+            self.__connections.add(task)
+            task.add_done_callback(self.__connections.discard)
+
+    async def __connect(self, backend_port: int) -> Tuple[Optional[Backend], Optional[socket.socket]]:
+        """
+        Connects to a backend, failing over to the next backend when the connection fails.
+
+        :param backend_port: port of the backend
+        :return: tuple of the connected backend and its socket, (None, None) if no backend accepts the connection
+        """
+        loop = asyncio.get_running_loop()
+        tried = []
+        while True:
+            backend = self.pool.choose(tried)
+            if backend is None:
+                return None, None
+            tried.append(backend)
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            upstream.setblocking(False)
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                await loop.sock_connect(upstream, (backend.host, backend_port))
+            except OSError:
+                upstream.close()
+                backend.healthy = False  # checked again by the next health check
+                continue
+            except BaseException:
+                upstream.close()
+                raise
+            return backend, upstream
+
+    async def __forward(self, client: socket.socket, backend_port: int) -> None:
+        """
+        Connects a client to a backend and moves data both ways until both sides are closed.
+
+        :param client: accepted client socket
+        :param backend_port: port of the backend
+        """
+        upstream = None
+        try:
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            backend, upstream = await self.__connect(backend_port)
+            if backend is None:
+                return
+            backend.active += 1
+            backend.connections += 1
+            try:
+                relay = self.__splice if self.splice else self.__copy
+                await asyncio.gather(relay(client, upstream), relay(upstream, client))
+            finally:
+                backend.active -= 1
+        finally:
+            client.close()
+            if upstream is not None:
+                upstream.close()
+
+    @staticmethod
+    def __shutdown(source: socket.socket, destination: socket.socket, error: bool) -> None:
+        """
+        Propagates the end of one direction of a connection.
+
+        :param source: socket that reached the end of its data
+        :param destination: socket the data was moved to
+        :param error: if True, both sockets are shut down, so the other direction ends too
+        """
+        shutdowns = [(destination, socket.SHUT_WR)]
+        if error:
+            shutdowns.extend([(source, socket.SHUT_RDWR), (destination, socket.SHUT_RDWR)])
+        for sock, how in shutdowns:
+            try:
+                sock.shutdown(how)
+            except OSError:
+                pass
+
+    async def __copy(self, source: socket.socket, destination: socket.socket) -> None:
+        """
+        Moves data from one socket to another through a user space buffer.
+
+        :param source: socket to read from
+        :param destination: socket to write to
+        """
+        loop = asyncio.get_running_loop()
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        error = False
+        try:
+            while True:
+                size = await loop.sock_recv_into(source, buffer)
+                if not size:
+                    break
+                await loop.sock_sendall(destination, view[:size])
+                self.transferred += size
+        except OSError:
+            error = True
+        finally:
+            self.__shutdown(source, destination, error)
+
+    @staticmethod
+    async def __wait(fd: int, writable: bool) -> None:
+        """
+        Waits until a file descriptor is readable or writable.
+
+        :param fd: file descriptor
+        :param writable: if True, waits for writability, for readability otherwise
+        """
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+    async def __splice(self, source: socket.socket, destination: socket.socket) -> None:
+        """
+        Moves data from one socket to another through a kernel pipe with splice(2).
+
+        :param source: socket to read from
+        :param destination: socket to write to
+        """
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        pipe_read, pipe_write = os.pipe()
+        error = False
+        try:
+            while True:
+                try:
+                    size = os.splice(source.fileno(), pipe_write, self.chunk_size, flags=flags)
+                except BlockingIOError:
+                    await self.__wait(source.fileno(), writable=False)
+                    continue
+                if not size:
+                    break
+                pending = size
+                while pending:
+                    try:
+                        pending -= os.splice(pipe_read, destination.fileno(), pending, flags=flags)
+                    except BlockingIOError:
+                        await self.__wait(destination.fileno(), writable=True)
+                self.transferred += size
+        except OSError:
+            error = True
+        finally:
+            os.close(pipe_read)
+            os.close(pipe_write)
+            self.__shutdown(source, destination, error)
+
+    async def __probe(self, backend: Backend) -> None:
+        """
+        Checks that a backend accepts TCP connections.
+
+        :param backend: the backend to check
+        """
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(backend.host, self.health_port),
+                                               self.health_timeout)
+            writer.close()
+            backend.healthy = True
+        except (OSError, asyncio.TimeoutError):
+            backend.healthy = False
+
+    async def __check_health(self) -> None:
+        """
+        Checks all backends every health_interval seconds.
+        """
+        while True:
+            await asyncio.gather(*(self.__probe(backend) for backend in self.pool.backends))
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self) -> dict:
+        """
+        Returns counters of the redirector.
+
+        :return: dictionary with transferred bytes and connections of every backend
+        """
+        return {"transferred": self.transferred,
+                "backends": {backend.host: {"healthy": backend.healthy, "active": backend.active,
+                                            "connections": backend.connections} for backend in self.pool.backends}}
+
+
+def install_event_loop() -> Optional[str]:
+    """
+    Installs the uvloop event loop policy if uvloop is available.
+
+    :return: "uvloop" if it was installed, None otherwise
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    uvloop.install()
+    return "uvloop"
+
+
+async def serve(redirector: Redirector) -> None:
+    """
+    Runs the redirector until it is cancelled.
+
+    :param redirector: the redirector
+    """
+    await redirector.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await redirector.close()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="TCP redirector of RTIB")
+    parser.add_argument("--listen", action="append", required=True, type=parse_listener, metavar="PORT[:BACKEND_PORT]",
+                        help="port to listen on, forwarded to the same port of the backends unless mapped")
+    parser.add_argument("--backend", action="append", required=True, help="address of a backend")
+    parser.add_argument("--strategy", choices=BackendPool.strategies, default="round-robin")
+    parser.add_argument("--bind", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--health-port", type=int, help="backend port probed by health checks")
+    parser.add_argument("--health-interval", type=float, default=5.0, help="seconds between health checks, 0 disables")
+    parser.add_argument("--no-splice", action="store_true", help="copy data in user space instead of splice(2)")
+    args = parser.parse_args(argv)
+
+    install_event_loop()
+    redirector = Redirector(args.listen, BackendPool(args.backend, args.strategy), args.bind, args.health_port,
+                            args.health_interval, splice=False if args.no_splice else None)
+    try:
+        asyncio.run(serve(redirector))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
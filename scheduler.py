@@ -0,0 +1,151 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
+
+from exceptions import DependencyCycleError
+from model import Infrastructure
+
+
+class Scheduler:
+    """
+    A class scheduling plays according to references between instances.
+
+    Play of an instance runs after plays of the instances it redirects to and of the instances
+    accepting connections from it, independent plays run concurrently.
+    """
+    def __init__(self, infrastructure: Infrastructure, max_concurrency: int = 4) -> None:
+        """
+        Scheduler constructor.
+
+        :param infrastructure: parsed infrastructure description
+        :param max_concurrency: maximum number of plays run at once
+        """
+        self.max_concurrency = max_concurrency
+        self.dependencies = self.__build_dependencies(infrastructure)
+
+    @staticmethod
+    def __build_dependencies(infrastructure: Infrastructure) -> dict:
+        """
+        Builds the dependency graph of plays.
+
+        :param infrastructure: parsed infrastructure description
+        :return: dictionary mapping play name to the set of plays that must run before it
+        """
+        dependencies = {name: set() for name in infrastructure.names}
+
+        for instance in infrastructure:
+            role_args = instance.resolved_role_arguments
+            if role_args.get("redirect_to") in instance.references:
+                dependencies.get(instance.name).add(role_args.get("redirect_to"))
+            for source in instance.references & set(role_args.get("accept_from") or []):
+                dependencies.get(source).add(instance.name)
+
+        return dependencies
+
+    def waves(self, plays: list = None) -> list:
+        """
+        Splits plays into waves, every play depends only on plays from the previous waves.
+
+        :param plays: names of plays to schedule, all plays if None
+        :raises DependencyCycleError: when plays depend on each other in a cycle
+        :return: list of waves, each wave being a sorted list of play names
+        """
+        plays = self.dependencies.keys() if plays is None else self.dependencies.keys() & set(plays)
+        remaining = {play: self.dependencies.get(play) & plays for play in plays}
+
+        waves = []
+        while remaining:
+            wave = sorted(play for play, dependencies in remaining.items() if not dependencies)
+            if not wave:
+                raise DependencyCycleError(
+                    "Cyclic references between instances: {}".format(", ".join(sorted(remaining))))
+            waves.append(wave)
+            for play in wave:
+                del remaining[play]
+            for dependencies in remaining.values():
+                dependencies.difference_update(wave)
+        return waves
+
+    @staticmethod
+    def __timed(run_play: Callable[[str], None], play: str) -> float:
+        """
+        Runs the play and measures its duration.
+
+        :param run_play: function running a single play
+        :param play: name of the play
+        :return: duration of the play in seconds
+        """
+        start = time.monotonic()
+        run_play(play)
+        return time.monotonic() - start
+
+    def run(self, run_play: Callable[[str], None], plays: list = None) -> dict:
+        """
+        Runs plays concurrently, each one as soon as all its dependencies finish.
+
+        Plays depending on a failed play are not run.
+
+        :param run_play: function running a single play
+        :param plays: names of plays to run, all plays if None
+        :raises DependencyCycleError: when plays depend on each other in a cycle
+        :return: dictionary mapping play name to its duration in seconds
+        """
+        plays = self.dependencies.keys() if plays is None else self.dependencies.keys() & set(plays)
+        self.waves(plays)
+        pending = {play: self.dependencies.get(play) & plays for play in plays}
+
+        durations = {}
+        failed = set()
+        errors = []
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while pending or futures:
+                progress = True
+                while progress:
+                    progress = False
+                    for play in sorted(pending):
+                        if pending.get(play) & failed:
+                            failed.add(play)
+                        elif pending.get(play) <= durations.keys():
+                            futures.update({executor.submit(self.__timed, run_play, play): play})
+                        else:
+                            continue
+                        del pending[play]
+                        progress = True
+
+                if not futures:
+                    break
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    play = futures.pop(future)
+                    try:
+                        durations.update({play: future.result()})
+                    except Exception as err:
+                        failed.add(play)
+                        errors.append(err)
+
+        if errors:
+            raise errors[0]
+        return durations
+
+    def critical_path(self, durations: dict) -> tuple:
+        """
+        Finds the longest chain of dependent plays.
+
+        :param durations: dictionary mapping play name to its duration in seconds
+        :return: tuple of the list of plays on the critical path and its total duration in seconds
+        """
+        finish = {}
+        previous = {}
+        for wave in self.waves(list(durations)):
+            for play in wave:
+                before = max(self.dependencies.get(play) & durations.keys(), key=finish.get, default=None)
+                finish.update({play: durations.get(play) + finish.get(before, 0)})
+                previous.update({play: before})
+
+        if not finish:
+            return [], 0
+        path = [max(finish, key=finish.get)]
+        while previous.get(path[-1]) is not None:
+            path.append(previous.get(path[-1]))
+        return list(reversed(path)), finish.get(path[0])
@@ -0,0 +1,106 @@
+import os
+import json
+
+import python_terraform as tf
+
+
+class TerraformState:
+    """
+    A class reading Terraform state.
+
+    Local state is parsed directly from "terraform.tfstate" and cached until the file changes,
+    state of remote backends is read via Terraform CLI.
+    """
+    def __init__(self, terraform: tf.Terraform, working_dir: str = ".") -> None:
+        """
+        TerraformState constructor.
+
+        :param terraform: Terraform of the working directory, used for remote backends
+        :param working_dir: Terraform working directory
+        """
+        self.terraform = terraform
+        self.working_dir = working_dir
+        self.__cache_key = None
+        self.__cache = None
+
+    def __remote(self) -> bool:
+        """
+        Checks whether the working directory uses a remote backend.
+
+        :return: True if the state is not stored locally, False otherwise
+        """
+        try:
+            with open(os.path.join(self.working_dir, ".terraform", "terraform.tfstate")) as backend_file:
+                backend = json.load(backend_file).get("backend") or {}
+        except (OSError, ValueError):
+            return False
+        return backend.get("type", "local") != "local"
+
+    def __load(self) -> dict:
+        """
+        Parses the local state file, the parsed state is reused while the file's mtime and size are unchanged.
+
+        :return: parsed state, empty if there is no state yet
+        """
+        path = os.path.join(self.working_dir, "terraform.tfstate")
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return {}
+
+        cache_key = (stat.st_mtime_ns, stat.st_size)
+        if cache_key != self.__cache_key:
+            with open(path) as state_file:
+                self.__cache = json.load(state_file)
+            self.__cache_key = cache_key
+        return self.__cache
+
+    @staticmethod
+    def __address(resource: dict, instance: dict) -> str:
+        """
+        Formats the address of a resource instance the way "terraform state list" does.
+
+        :param resource: resource from the state file
+        :param instance: instance of the resource
+        :return: resource address
+        """
+        address = "{}.{}".format(resource.get("type"), resource.get("name"))
+        if resource.get("mode") == "data":
+            address = "data." + address
+        if resource.get("module"):
+            address = "{}.{}".format(resource.get("module"), address)
+        if "index_key" in instance:
+            address += "[{}]".format(json.dumps(instance.get("index_key")))
+        return address
+
+    def outputs(self) -> dict:
+        """
+        Returns root module outputs in the format of "terraform output -json".
+
+        :return: dictionary mapping output name to a dictionary with its value and type
+        """
+        if self.__remote():
+            return self.terraform.output(json=tf.IsFlagged) or {}
+        return self.__load().get("outputs", {})
+
+    def resources(self) -> list:
+        """
+        Returns addresses of all resources in the state, as "terraform state list" does.
+
+        :return: list of resource addresses
+        """
+        if self.__remote():
+            return [address for address in self.terraform.state_cmd("list")[1].split("\n") if address]
+        return [self.__address(resource, instance)
+                for resource in self.__load().get("resources", [])
+                for instance in resource.get("instances", [])]
+
+    def module_resources(self, module: str) -> list:
+        """
+        Returns addresses of the resources of a module.
+
+        :param module: name of the module
+        :return: list of resource addresses
+        """
+        prefix = "module.{}.".format(module)
+        return [address for address in self.resources() if address.startswith(prefix)]
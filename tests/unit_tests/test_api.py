@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import yaml
+
+from api import Engagement
+
+
+@patch("orchestrator.ParallelismController.save", MagicMock())
+class TestEngagement(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        for directory in ("providers/aws", "roles/c2_server"):
+            os.makedirs(os.path.join(self.tmp_dir.name, directory))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def engagement(self, name):
+        return Engagement({"infrastructure": {"name": name, "global_arguments": {"role": {"attacker": "1.2.3.4"}},
+                                              "instances": [{"name": "c2", "role": "c2_server", "provider": "aws"}]}},
+                          root=self.tmp_dir.name)
+
+    @patch("api.ReadinessProber")
+    @patch("orchestrator.Orchestrator.orchestrate_infrastructure")
+    @patch("manager.Manager.manage")
+    def test_run(self, mock_manage, mock_orchestrate, mock_prober):
+        mock_orchestrate.return_value = True
+        mock_prober.return_value.wait.return_value = {"1.1.1.1": 1.5}
+        mock_manage.return_value = {"configured_hosts": ["1.1.1.1"], "critical_path": None}
+        engagements = [self.engagement("range_1"), self.engagement("range_2")]
+        cwd = os.getcwd()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(Engagement.run, engagements))
+
+        self.assertEqual(os.getcwd(), cwd)
+        for engagement, result in zip(engagements, results):
+            self.assertTrue(os.path.isdir(engagement.working_dir))
+            self.assertEqual(result, {"changed": True, "applied_plan": False,
+                                      "inventory_path": os.path.join(engagement.working_dir, "hosts.yaml"),
+                                      "ready": {"1.1.1.1": 1.5}, "configured_hosts": ["1.1.1.1"],
+                                      "critical_path": None})
+        self.assertEqual(engagements[1].working_dir, os.path.join(self.tmp_dir.name, "range_2"))
+        self.assertIsNot(engagements[0].orchestrator.terraform, engagements[1].orchestrator.terraform)
+        mock_prober.assert_any_call(os.path.join(self.tmp_dir.name, "range_1", "hosts.yaml"), timeout=300.0,
+                                    mode="banner", port=22)
+
+    @patch("orchestrator.Orchestrator.orchestrate_infrastructure")
+    def test_run_invalid(self, mock_orchestrate):
+        engagement = Engagement({"infrastructure": {"name": "range_1", "instances": [
+            {"name": "c2", "role": "unknown_role", "provider": "aws", "arguments": {"role": {"attacker": "1.2.3.4"}}}]}},
+            root=self.tmp_dir.name)
+
+        self.assertEqual(len(engagement.validate()), 1)
+        self.assertRaises(ValueError, engagement.run)
+        mock_orchestrate.assert_not_called()
+        self.assertFalse(os.path.exists(engagement.working_dir))
+
+    def test_manage_writes_into_working_dir(self):
+        engagement = self.engagement("range_1")
+        os.makedirs(engagement.working_dir)
+        with open(os.path.join(engagement.working_dir, "hosts.yaml"), "w") as inventory_file:
+            inventory_file.write(yaml.safe_dump({"all": {"children": {"c2": {"hosts": {"1.1.1.1": {}}, "vars": {}}}}}))
+
+        with patch("manager.Manager._Manager__run_ansible") as mock_run:
+            result = engagement.manage()
+
+        mock_run.assert_called_once_with()
+        self.assertEqual(result.get("configured_hosts"), ["1.1.1.1"])
+        self.assertTrue(os.path.exists(os.path.join(engagement.working_dir, "playbook.yaml")))
+        self.assertTrue(os.path.exists(os.path.join(engagement.working_dir, ".ledger.json")))
+        self.assertTrue(os.path.exists(os.path.join(engagement.working_dir, "ansible.cfg")))
+        self.assertFalse(os.path.exists("playbook.yaml"))
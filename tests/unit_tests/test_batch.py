@@ -0,0 +1,110 @@
+import os
+import queue
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import yaml
+from schema import SchemaError
+
+from batch import Batch, run_engagement
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmp_dir.name)
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def write_description(self, path, name):
+        with open(os.path.join(self.root, path), "w") as description_file:
+            description_file.write(yaml.safe_dump({"infrastructure": {"name": name, "instances": [
+                {"name": "c2", "role": "c2_server", "provider": "aws"}]}}))
+
+    @patch("batch.CLI")
+    def test_run_engagement(self, mock_cli):
+        cli_obj = mock_cli.return_value
+        cli_obj.infrastructure.name = "range_1"
+        cli_obj.working_dir = os.path.join(self.root, "range_1")
+        cli_obj.orchestrate.side_effect = lambda: print("SAVED PLAN USED") or True
+        cli_obj.manager.configured_hosts = ["1.1.1.1"]
+        progress = queue.Queue()
+        apply_slots = threading.BoundedSemaphore(1)
+        ansible_slots = threading.BoundedSemaphore(1)
+
+        result = run_engagement("range_1.yaml", self.root, {"verbose": False, "forks": 25}, progress,
+                                apply_slots, ansible_slots)
+
+        self.assertEqual(os.getcwd(), self.cwd)
+        mock_cli.assert_called_once_with(os.path.join(self.root, "range_1.yaml"), root=self.root, verbose=False)
+        cli_obj.wait_for_hosts.assert_called_once_with()
+        self.assertEqual(cli_obj.manager.max_forks, 25)
+        self.assertTrue(result.get("ok"))
+        self.assertTrue(result.get("changed"))
+        self.assertEqual(result.get("configured_hosts"), ["1.1.1.1"])
+        self.assertEqual(list(result.get("seconds")), ["validate", "orchestrate", "wait", "manage"])
+        self.assertEqual([progress.get()[1] for _ in range(4)], ["validate", "orchestrate", "wait", "manage"])
+        self.assertTrue(apply_slots.acquire(blocking=False))  # released
+        self.assertTrue(ansible_slots.acquire(blocking=False))
+        with open(result.get("log")) as log_file:
+            self.assertEqual(log_file.read(), "SAVED PLAN USED\n")
+
+    @patch("batch.CLI")
+    def test_run_engagement_failed(self, mock_cli):
+        cli_obj = mock_cli.return_value
+        cli_obj.infrastructure.name = "range_1"
+        cli_obj.validator.validate.side_effect = SchemaError("infrastructure.instances[0].role: missing")
+        progress = queue.Queue()
+
+        result = run_engagement("range_1.yaml", self.root, {}, progress)
+
+        self.assertEqual(os.getcwd(), self.cwd)
+        self.assertFalse(result.get("ok"))
+        self.assertEqual(result.get("error"), "SchemaError: infrastructure.instances[0].role: missing")
+        cli_obj.orchestrate.assert_not_called()
+        self.assertEqual(progress.get(), ("range_1.yaml", "failed", None))
+        self.assertIsNone(result.get("log"))  # no infrastructure directory was created
+
+    @patch("batch.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("batch.run_engagement")
+    def test_run(self, mock_run_engagement):
+        def run_engagement(description_path, root, settings, progress, apply_slots, ansible_slots):
+            progress.put((description_path, "validate", 0.5))
+            ok = description_path != "range_2.yaml"
+            return {"description": description_path, "ok": ok, "error": None if ok else "AnsibleError: failed",
+                    "seconds": {"validate": 0.5, "orchestrate": 10.0} if ok else {"validate": 0.5},
+                    "queued": 1.0 if ok else 0.0}
+
+        mock_run_engagement.side_effect = run_engagement
+        os.chdir(self.root)
+        self.write_description("range_1.yaml", "range_1")
+        self.write_description("range_2.yaml", "range_2")
+        batch = Batch(["range_1.yaml", "range_2.yaml"], max_workers=2, max_forks=100, max_ansible=4, verbose=True)
+
+        results = batch.run()
+
+        self.assertEqual(list(results), ["range_1.yaml", "range_2.yaml"])
+        self.assertEqual(mock_run_engagement.call_args[0][2], {"verbose": True, "forks": 25})
+        summary = batch.summary().split("\n")
+        self.assertEqual(summary[0].split(), ["DESCRIPTION", "STATUS", "QUEUED", "VALIDATE", "ORCHESTRATE", "WAIT",
+                                              "MANAGE", "TOTAL"])
+        self.assertEqual(summary[1].split(), ["range_1.yaml", "OK", "1.0", "0.5", "10.0", "-", "-", "10.5"])
+        self.assertEqual(summary[2].split(), ["range_2.yaml", "FAILED", "0.0", "0.5", "-", "-", "-", "0.5"])
+        self.assertTrue(summary[3].endswith("(11.0 SECONDS ONE AFTER ANOTHER)"))
+        self.assertEqual(summary[4], "range_2.yaml: AnsibleError: failed")
+
+        batch = Batch(["range_1.yaml", "range_2.yaml"], max_forks=100, max_ansible=4, jobs=2)
+        self.assertEqual(batch.settings, {"jobs": 2, "forks": 12})
+
+    def test_same_name(self):
+        os.chdir(self.root)
+        self.write_description("range_1.yaml", "range")
+        self.write_description("range_2.yaml", "range")
+
+        self.assertRaises(ValueError, Batch, ["range_1.yaml", "range_2.yaml"])
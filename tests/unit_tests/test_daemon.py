@@ -0,0 +1,147 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+import yaml
+
+from daemon import Daemon, request
+from exceptions import TerraformError
+from model import Infrastructure
+from profiler import Profiler
+
+
+@patch("daemon.ReadinessProber", MagicMock())
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.description = yaml.safe_load(description_file)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.description_path = os.path.join(self.tmp_dir.name, "infrastructure.yaml")
+        self.write_description()
+
+        infrastructure = Infrastructure(self.description)
+        self.orchestrator = MagicMock(infrastructure=infrastructure, profiler=Profiler(enabled=False))
+        self.orchestrator.orchestrate_instances.return_value = True
+        self.manager = MagicMock(infrastructure=infrastructure, configured_hosts=["1.1.1.1"],
+                                 working_dir=self.tmp_dir.name,
+                                 inventory_path=os.path.join(self.tmp_dir.name, "hosts.yaml"))
+        self.daemon = Daemon(self.orchestrator, self.manager, self.description_path, debounce=0.05, interval=0.01)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_description(self):
+        with open(self.description_path, "w") as description_file:
+            description_file.write(yaml.safe_dump(self.description))
+
+    def edit_description(self):
+        instances = self.description.get("infrastructure").get("instances")
+        instances[1].get("arguments").update({"provider": {"flavor": "standard.large"}})  # interactive_c2
+        instances.pop(2)  # short_haul_c2_redirector
+        instances[2].get("arguments").get("role").update({"accept_from": ["147.251.0.0/16"]})  # short_haul_c2
+        self.write_description()
+
+    def test_reload(self):
+        self.edit_description()
+
+        changes = self.daemon.reload()
+
+        self.assertEqual(changes.get("apply"), {"interactive_c2"})
+        self.orchestrator.orchestrate_instances.assert_called_once_with(["interactive_c2"],
+                                                                        ["short_haul_c2_redirector"])
+        self.manager.manage.assert_called_once_with(["interactive_c2", "interactive_c2_redirector", "short_haul_c2"])
+        self.assertEqual(list(self.daemon.infrastructure.names),
+                         ["interactive_c2_redirector", "interactive_c2", "short_haul_c2"])
+        self.assertIs(self.orchestrator.infrastructure, self.daemon.infrastructure)
+        self.assertEqual(self.daemon.status.get("state"), "idle")
+        self.assertEqual(self.daemon.status.get("reconciles"), 1)
+        self.assertEqual(self.daemon.status.get("configured_hosts"), ["1.1.1.1"])
+
+        self.orchestrator.reset_mock()
+        self.assertIsNone(self.daemon.reload())  # nothing changed since
+        self.orchestrator.orchestrate_instances.assert_not_called()
+
+    def test_reload_invalid(self):
+        self.description.get("infrastructure").get("instances").append({"name": "broken"})
+        self.write_description()
+
+        self.assertIsNone(self.daemon.reload())
+
+        self.orchestrator.orchestrate_instances.assert_not_called()
+        self.assertTrue(self.daemon.status.get("errors"))
+        self.assertEqual(len(self.daemon.infrastructure), 4)
+
+    def test_reload_failed(self):
+        original = self.daemon.infrastructure
+        self.orchestrator.orchestrate_instances.side_effect = TerraformError("apply failed")
+        self.edit_description()
+
+        self.assertRaises(TerraformError, self.daemon.reload)
+
+        self.assertIs(self.daemon.infrastructure, original)
+        self.assertIs(self.orchestrator.infrastructure, original)
+        self.assertEqual(self.daemon.status.get("state"), "failed")
+        self.assertEqual(self.daemon.status.get("errors"), ["TerraformError: apply failed"])
+
+    def test_watch(self):
+        watcher = threading.Thread(target=self.daemon.watch)
+        watcher.start()
+        try:
+            time.sleep(0.05)
+            self.edit_description()
+            self.description.get("infrastructure").get("instances")[0].get("arguments").get("role").update(
+                {"ansible_user": "root"})  # written again before the debounce elapsed
+            self.write_description()
+            for _ in range(200):
+                if self.daemon.status.get("reconciles"):
+                    break
+                time.sleep(0.01)
+        finally:
+            self.daemon.stop()
+            watcher.join()
+
+        self.orchestrator.orchestrate_instances.assert_called_once_with(["interactive_c2"],
+                                                                        ["short_haul_c2_redirector"])
+        self.assertEqual(self.daemon.infrastructure.get("interactive_c2_redirector").role_arguments.get("ansible_user"),
+                         "root")
+
+    def test_serve(self):
+        with open(self.manager.inventory_path, "w") as inventory_file:
+            inventory_file.write(yaml.safe_dump({"all": {"children": {"interactive_c2": {"hosts": {"1.1.1.1": {}}}}}}))
+        server = threading.Thread(target=self.daemon.serve, args=(False,))
+        server.start()
+        try:
+            for _ in range(200):
+                if os.path.exists(self.daemon.socket_path) and self.daemon.status.get("state") == "idle":
+                    break
+                time.sleep(0.01)
+
+            status = request(self.daemon.socket_path, "status")
+            self.edit_description()
+            validation = request(self.daemon.socket_path, "validate")
+            rebuild = request(self.daemon.socket_path, "rebuild", instance="interactive_c2")
+            unknown_instance = request(self.daemon.socket_path, "rebuild", instance="unknown")
+            unknown_command = request(self.daemon.socket_path, "deploy")
+            self.assertEqual(request(self.daemon.socket_path, "stop"), {"ok": True})
+        finally:
+            self.daemon.stop()
+            server.join()
+            socket_exists = os.path.exists(self.daemon.socket_path)
+
+        self.assertTrue(status.get("ok"))
+        self.assertEqual(status.get("infrastructure"), "engagement_54")
+        self.assertEqual(status.get("hosts"), {"interactive_c2": ["1.1.1.1"]})
+        self.assertEqual(validation, {"ok": True, "errors": [], "changes": {
+            "added": [], "removed": ["short_haul_c2_redirector"], "apply": ["interactive_c2"],
+            "configure": ["interactive_c2", "interactive_c2_redirector", "short_haul_c2"]}})
+        self.orchestrator.orchestrate_instances.assert_not_called()  # validate does not reconcile
+        self.assertEqual(rebuild, {"ok": True, "configured_hosts": ["1.1.1.1"]})
+        self.orchestrator.rebuild_instance.assert_called_once_with("interactive_c2")
+        self.manager.manage.assert_called_once_with(["interactive_c2", "interactive_c2_redirector"], force=True)
+        self.assertEqual(unknown_instance, {"ok": False, "error": "ValueError: Unknown instance: unknown"})
+        self.assertFalse(unknown_command.get("ok"))
+        self.assertEqual(self.daemon.socket_path, os.path.join(self.tmp_dir.name, ".rtib.sock"))
+        self.assertFalse(socket_exists)
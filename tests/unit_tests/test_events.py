@@ -0,0 +1,54 @@
+import unittest
+import sys
+
+from events import EventStream, TerraformEvent, AnsibleEvent, parse_terraform_event, parse_ansible_event
+
+
+class TestEvents(unittest.TestCase):
+    def test_parse_terraform_event(self):
+        with open("tests/unit_tests/terraform_apply.jsonl") as apply_file:
+            events = [parse_terraform_event(line) for line in apply_file]
+
+        self.assertEqual(events[-3], TerraformEvent(
+            type="apply_complete", timestamp="2021-06-08T14:02:48.701214+02:00", level="info",
+            resource="module.c2.aws_instance.instance[0]", module="module.c2", action="create", elapsed=32,
+            message="module.c2.aws_instance.instance[0]: Creation complete after 32s [id=i-0a1b2c]"))
+        self.assertEqual(events[-2].type, "change_summary")
+
+    def test_parse_terraform_event_planned_change(self):
+        event = parse_terraform_event('{"@level": "info", "@message": "module.c2.aws_instance.instance[0]: Plan to create", '
+                                      '"type": "planned_change", "change": {"resource": {"addr": '
+                                      '"module.c2.aws_instance.instance[0]", "module": "module.c2"}, "action": "create"}}')
+
+        self.assertEqual(event.type, "planned_change")
+        self.assertEqual(event.resource, "module.c2.aws_instance.instance[0]")
+        self.assertEqual(event.module, "module.c2")
+        self.assertEqual(event.action, "create")
+
+    def test_parse_terraform_event_not_json(self):
+        self.assertIsNone(parse_terraform_event("Initializing provider plugins...\n"))
+        self.assertIsNone(parse_terraform_event("[1, 2]\n"))
+
+    def test_parse_ansible_event(self):
+        ret = parse_ansible_event('{"event": "task_failed", "time": 1623153731.5, "host": "1.2.3.4", "play": "c2", '
+                                  '"task": "install apache2", "duration": 2.5, "msg": "No package"}\n')
+
+        self.assertEqual(ret, AnsibleEvent(type="task_failed", time=1623153731.5, host="1.2.3.4", play="c2",
+                                           task="install apache2", duration=2.5, message="No package"))
+        self.assertIsNone(parse_ansible_event('{"type": "version"}\n'))
+        self.assertIsNone(parse_ansible_event("PLAY RECAP ****\n"))
+
+    def test_event_stream(self):
+        script = ("import sys\n"
+                  "for i in range(100):\n"
+                  "    print('{\"event\": \"task_ok\", \"host\": \"10.0.0.%d\"}' % i)\n"
+                  "    print('noise %d' % i)\n"
+                  "sys.exit(3)\n")
+        stream = EventStream([sys.executable, "-c", script], parse_ansible_event, tail=5)
+
+        hosts = [event.host for event in stream]
+
+        self.assertEqual(hosts, ["10.0.0.{}".format(i) for i in range(100)])
+        self.assertEqual(stream.counts.get("task_ok"), 100)
+        self.assertEqual(stream.output(), "\n".join("noise {}".format(i) for i in range(95, 100)))
+        self.assertEqual(stream.returncode, 3)
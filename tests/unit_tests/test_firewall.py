@@ -0,0 +1,55 @@
+import unittest
+
+from firewall import Ruleset, is_network
+
+
+class TestFirewall(unittest.TestCase):
+    def test_is_network(self):
+        self.assertTrue(is_network("1.2.3.4"))
+        self.assertTrue(is_network("147.251.0.0/16"))
+        self.assertFalse(is_network("muni.cz"))
+        self.assertFalse(is_network("2001:db8::/32"))
+
+    def test_iptables(self):
+        ruleset = Ruleset(["1.1.1.1", "muni.cz"], "147.251.0.0/16")
+
+        self.assertFalse(ruleset.uses_ipset)
+        self.assertEqual(ruleset.iptables(), "\n".join([
+            "*filter",
+            ":INPUT ACCEPT [0:0]",
+            ":FORWARD ACCEPT [0:0]",
+            ":OUTPUT ACCEPT [0:0]",
+            "-A INPUT -s 127.0.0.1/32 -j ACCEPT",
+            "-A INPUT -s 147.251.0.0/16 -p tcp -m conntrack --ctstate NEW -m tcp --dport 22 -j ACCEPT",
+            "-A INPUT -s 1.1.1.1 -p tcp -m conntrack --ctstate NEW -j ACCEPT",
+            "-A INPUT -s muni.cz -p tcp -m conntrack --ctstate NEW -j ACCEPT",
+            "-A INPUT -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT",
+            "-A INPUT -j REJECT --reject-with icmp-port-unreachable",
+            "COMMIT"]) + "\n")
+        self.assertEqual(ruleset.ipset(), "")
+
+    def test_no_attacker(self):
+        self.assertRaises(ValueError, Ruleset, ["1.1.1.1"], None)
+        self.assertRaises(ValueError, Ruleset, [], "")
+
+    def test_ipset(self):
+        sources = ["10.0.0.{}".format(i) for i in range(Ruleset.ipset_threshold)] + ["muni.cz"]
+        ruleset = Ruleset(sources, "147.251.0.0/16")
+
+        rules = ruleset.iptables()
+        ipset = ruleset.ipset().splitlines()
+
+        self.assertTrue(ruleset.uses_ipset)
+        self.assertIn("-A INPUT -p tcp -m conntrack --ctstate NEW -m set --match-set rtib_allow src -j ACCEPT", rules)
+        self.assertIn("-A INPUT -s muni.cz -p tcp -m conntrack --ctstate NEW -j ACCEPT", rules)  # names stay rules
+        self.assertNotIn("-s 10.0.0.1 ", rules)
+        self.assertEqual(ipset[:3], ["create rtib_allow hash:net family inet -exist",
+                                     "create rtib_allow_new hash:net family inet -exist",
+                                     "flush rtib_allow_new"])
+        self.assertEqual(len([line for line in ipset if line.startswith("add rtib_allow_new ")]),
+                         Ruleset.ipset_threshold)
+        self.assertEqual(ipset[-2:], ["swap rtib_allow_new rtib_allow", "destroy rtib_allow_new"])
+
+
+if __name__ == '__main__':
+    unittest.main()
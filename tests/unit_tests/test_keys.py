@@ -0,0 +1,52 @@
+import os
+import stat
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from keys import KeyStore, generate_key, public_key
+
+
+class TestKeys(unittest.TestCase):
+    def test_generate_key(self):
+        with tempfile.TemporaryDirectory() as key_dir:
+            path = os.path.join(key_dir, "c2_0")
+            public = generate_key(path)
+
+            self.assertTrue(public.startswith("ssh-ed25519 "))
+            self.assertTrue(public.endswith(" c2_0"))
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            self.assertEqual(stat.S_IMODE(os.stat(path + ".pub").st_mode), 0o644)
+            self.assertEqual(public_key(path).split()[:2], public.split()[:2])
+            self.assertEqual(sorted(os.listdir(key_dir)), ["c2_0", "c2_0.pub"])  # no temporary files left
+
+    def test_generate_key_unknown_type(self):
+        with tempfile.TemporaryDirectory() as key_dir:
+            self.assertRaises(ValueError, generate_key, os.path.join(key_dir, "c2_0"), "dsa")
+        self.assertRaises(ValueError, KeyStore, key_type="dsa")
+
+    def test_ensure(self):
+        with tempfile.TemporaryDirectory() as key_dir:
+            store = KeyStore(os.path.join(key_dir, "ssh_keys"), max_workers=2)
+            keys = store.ensure({"c2": 2, "redirector": 1})
+
+            self.assertEqual(list(keys), ["c2", "redirector"])
+            self.assertEqual(len(keys.get("c2")), 2)
+            self.assertNotEqual(keys.get("c2")[0], keys.get("c2")[1])
+            self.assertEqual(stat.S_IMODE(os.stat(store.directory).st_mode), 0o700)
+            self.assertTrue(os.path.isfile(store.path("redirector", 0)))
+
+            with patch("keys.generate_key") as mock_generate:  # existing keys are reused
+                self.assertEqual(store.ensure({"c2": 2, "redirector": 1}), keys)
+                mock_generate.assert_not_called()
+
+    def test_ensure_legacy_key(self):
+        with tempfile.TemporaryDirectory() as key_dir:
+            store = KeyStore(key_dir)
+            public = generate_key(store.path("c2", 0), "rsa")
+            os.remove(store.path("c2", 0) + ".pub")  # keys of older versions had no public key file
+
+            keys = store.ensure({"c2": 1})
+
+            self.assertEqual(keys.get("c2")[0].split()[:2], public.split()[:2])
+            self.assertTrue(os.path.isfile(store.path("c2", 0) + ".pub"))
@@ -1,19 +1,23 @@
 import unittest
 import yaml
 import os
+import tempfile
+import configparser
 from unittest.mock import MagicMock, patch, call
 
 from manager import Manager
-from exceptions import AnsibleError
+from model import Infrastructure
+from exceptions import AnsibleError, UnresolvedReferenceError
+from events import AnsibleEvent, parse_ansible_event
 
 
 class TestManager(unittest.TestCase):
     def setUp(self):
-        self.manager = Manager({"infrastructure": {}})
+        self.manager = Manager(Infrastructure({"infrastructure": {}}))
 
     def test_generate_playbook(self):
         with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
-            self.manager.infrastructure_description = yaml.safe_load(description_file).get("infrastructure")
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
 
         with open("tests/unit_tests/expected_playbook.yaml") as playbook_file:
             playbook = playbook_file.read()
@@ -25,7 +29,7 @@ class TestManager(unittest.TestCase):
 
     def test_get_role_variables(self):
         with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
-            self.manager.infrastructure_description = yaml.safe_load(description_file).get("infrastructure")
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
 
         ret = self.manager._Manager__get_role_variables("interactive_c2_redirector")
 
@@ -34,7 +38,7 @@ class TestManager(unittest.TestCase):
 
     def test_add_variables_to_inventory(self):
         with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
-            self.manager.infrastructure_description = yaml.safe_load(description_file).get("infrastructure")
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
 
         self.manager.inventory_path = "tests/unit_tests/expected_hosts_post_orchestration.yaml"
 
@@ -52,45 +56,276 @@ class TestManager(unittest.TestCase):
             new_hosts.write(old_hosts)
             new_hosts.truncate()
 
-    @patch("manager.subprocess.run")
-    def test_run_ansible(self, mock_run):
-        fake_process = MagicMock()
-        fake_process.returncode = 0
-        mock_run.return_value = fake_process
+    @patch("manager.EventStream")
+    def test_run_ansible(self, mock_stream):
+        mock_stream.return_value.__iter__.return_value = iter([])
+        mock_stream.return_value.returncode = 0
         env = os.environ.copy()
         env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
         env["ANSIBLE_ROLES_PATH"] = os.getcwd() + "/../roles"
         env["ANSIBLE_PYTHON_INTERPRETER"] = "/usr/bin/python3"
+        env["ANSIBLE_CONFIG"] = os.getcwd() + "/ansible.cfg"
+        env["ANSIBLE_CALLBACK_PLUGINS"] = os.getcwd() + "/../callback_plugins"
+        env["ANSIBLE_STDOUT_CALLBACK"] = "rtib_events"
         self.manager.inventory_path = "hosts.yaml"
 
         self.manager._Manager__run_ansible()
 
-        mock_run.assert_called_once_with("ansible-playbook playbook.yaml -i \"hosts.yaml\"", shell=True, env=env,
-                                         capture_output=True)
+        mock_stream.assert_called_once_with("ansible-playbook playbook.yaml -i \"hosts.yaml\"", parse_ansible_event,
+                                            env=env, cwd=".", shell=True)
 
-    @patch("manager.subprocess.run")
-    def test_run_ansible_failed(self, mock_run):
-        fake_process = MagicMock()
-        fake_process.returncode = 1
-        mock_run.return_value = fake_process
-        env = os.environ.copy()
-        env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
-        env["ANSIBLE_ROLES_PATH"] = os.getcwd() + "/../roles"
-        env["ANSIBLE_PYTHON_INTERPRETER"] = "/usr/bin/python3"
+    @patch("manager.EventStream")
+    def test_run_ansible_limit(self, mock_stream):
+        mock_stream.return_value.__iter__.return_value = iter([])
+        mock_stream.return_value.returncode = 0
         self.manager.inventory_path = "hosts.yaml"
 
-        with self.assertRaises(AnsibleError):
+        self.manager._Manager__run_ansible(["c2", "redirector"], ".pipeline/c2.yaml")
+
+        self.assertEqual(mock_stream.call_args[0][0],
+                         "ansible-playbook playbook.yaml -i \".pipeline/c2.yaml\" --limit \"c2,redirector\"")
+
+    @patch("manager.EventStream")
+    def test_run_ansible_failed(self, mock_stream):
+        mock_stream.return_value.__iter__.return_value = iter([
+            AnsibleEvent("task_start", play="c2", task="install apache2"),
+            AnsibleEvent("task_ok", host="1.2.3.4", play="c2", task="install apache2", duration=2.5),
+            AnsibleEvent("task_failed", host="5.6.7.8", play="c2", task="install apache2", message="No package")])
+        mock_stream.return_value.returncode = 2
+        mock_stream.return_value.output.return_value = ""
+        self.manager.inventory_path = "hosts.yaml"
+
+        with self.assertRaises(AnsibleError) as err:
             self.manager._Manager__run_ansible()
 
-            mock_run.assert_called_once_with("ansible-playbook playbook.yaml -i \"hosts.yaml\"", shell=True, env=env,
-                                             capture_output=True)
+        self.assertEqual(err.exception.args[1], "5.6.7.8 | install apache2 | No package")
+
+    @patch("manager.EventStream")
+    @patch("manager.print")
+    def test_run_ansible_verbose(self, mock_print, mock_stream):
+        mock_stream.return_value.__iter__.return_value = iter([
+            AnsibleEvent("play_start", play="c2"),
+            AnsibleEvent("task_changed", host="1.2.3.4", play="c2", task="install apache2", duration=2.5)])
+        mock_stream.return_value.returncode = 0
+        self.manager.inventory_path = "hosts.yaml"
+        self.manager.verbose = True
+
+        self.manager._Manager__run_ansible()
+
+        mock_print.assert_has_calls([call("PLAY [c2]"), call("CHANGED: [1.2.3.4] (2.5s)")])
 
     @patch("manager.Manager._Manager__generate_playbook")
     @patch("manager.Manager._Manager__add_variables_to_inventory")
+    @patch("manager.Manager._Manager__generate_rulesets", MagicMock())
+    @patch("manager.Manager._Manager__generate_config", MagicMock())
     @patch("manager.Manager._Manager__run_ansible")
+    @patch("manager.Manager._Manager__host_hashes", MagicMock(return_value={"c2": {"1.2.3.4": "hash"}}))
+    @patch("manager.Manager._Manager__read_ledger", MagicMock(return_value={}))
+    @patch("manager.Manager._Manager__write_ledger", MagicMock())
     def test_manage(self, mock_run, mock_add_variables, mock_generate_playbook):
         self.manager.manage()
 
         mock_run.assert_called_once()
         mock_add_variables.assert_called_once()
         mock_generate_playbook.assert_called_once()
+
+    @patch("manager.Manager._Manager__generate_playbook")
+    @patch("manager.Manager._Manager__add_variables_to_inventory")
+    @patch("manager.Manager._Manager__generate_rulesets", MagicMock())
+    @patch("manager.Manager._Manager__generate_config", MagicMock())
+    @patch("manager.Manager._Manager__run_ansible")
+    @patch("manager.Manager._Manager__host_hashes")
+    @patch("manager.Manager._Manager__read_ledger", MagicMock(return_value={}))
+    @patch("manager.Manager._Manager__write_ledger", MagicMock())
+    def test_manage_scheduled(self, mock_hashes, mock_run, mock_add_variables, mock_generate_playbook):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        mock_hashes.return_value = {name: {name + "_host": "hash"} for name in self.manager.infrastructure.names}
+        self.manager.max_concurrency = 2
+
+        self.manager.manage()
+
+        self.assertEqual(mock_run.call_count, 4)
+        mock_run.assert_any_call(["interactive_c2"])
+        self.assertEqual(self.manager.critical_path[0][-1][-10:], "redirector")
+
+    @patch("manager.Manager._Manager__generate_playbook", MagicMock())
+    @patch("manager.Manager._Manager__add_variables_to_inventory", MagicMock())
+    @patch("manager.Manager._Manager__generate_rulesets", MagicMock())
+    @patch("manager.Manager._Manager__generate_config", MagicMock())
+    @patch("manager.Manager._Manager__run_ansible")
+    @patch("manager.Manager._Manager__host_hashes")
+    @patch("manager.Manager._Manager__read_ledger")
+    @patch("manager.Manager._Manager__write_ledger")
+    def test_manage_ledger(self, mock_write_ledger, mock_read_ledger, mock_hashes, mock_run):
+        mock_hashes.return_value = {"c2": {"1.1.1.1": "a", "2.2.2.2": "b"}, "redirector": {"3.3.3.3": "c"}}
+
+        # nothing changed
+        mock_read_ledger.return_value = {"1.1.1.1": "a", "2.2.2.2": "b", "3.3.3.3": "c"}
+        ret = self.manager.manage()
+        mock_run.assert_not_called()
+        self.assertEqual(ret, {"configured_hosts": [], "critical_path": None})
+
+        # one host of a group changed
+        mock_read_ledger.return_value = {"1.1.1.1": "a", "2.2.2.2": "old", "3.3.3.3": "c"}
+        self.manager.manage()
+        mock_run.assert_called_once_with(["2.2.2.2"])
+        mock_write_ledger.assert_called_with({"1.1.1.1": "a", "2.2.2.2": "b", "3.3.3.3": "c"})
+
+        # whole group changed
+        mock_run.reset_mock()
+        mock_read_ledger.return_value = {"1.1.1.1": "a", "2.2.2.2": "b"}
+        self.manager.manage()
+        mock_run.assert_called_once_with(["redirector"])
+
+        # forced run configures everything
+        mock_run.reset_mock()
+        mock_read_ledger.return_value = {"1.1.1.1": "a", "2.2.2.2": "b", "3.3.3.3": "c"}
+        ret = self.manager.manage(force=True)
+        mock_run.assert_called_once_with()
+        self.assertEqual(ret.get("configured_hosts"), ["1.1.1.1", "2.2.2.2", "3.3.3.3"])
+        self.assertEqual(self.manager.configured_hosts, ["1.1.1.1", "2.2.2.2", "3.3.3.3"])
+
+    @patch("manager.Manager._Manager__generate_playbook", MagicMock())
+    @patch("manager.Manager._Manager__add_variables_to_inventory", MagicMock())
+    @patch("manager.Manager._Manager__generate_rulesets", MagicMock())
+    @patch("manager.Manager._Manager__generate_config", MagicMock())
+    @patch("manager.Manager._Manager__run_ansible")
+    @patch("manager.Manager._Manager__host_hashes", MagicMock(return_value={"c2": {"1.1.1.1": "a"}}))
+    @patch("manager.Manager._Manager__read_ledger", MagicMock(return_value={}))
+    @patch("manager.Manager._Manager__write_ledger")
+    def test_manage_failed_not_recorded(self, mock_write_ledger, mock_run):
+        mock_run.side_effect = AnsibleError("ansible error")
+
+        with self.assertRaises(AnsibleError):
+            self.manager.manage()
+
+        mock_write_ledger.assert_not_called()
+
+    def test_ansible_config(self):
+        self.manager.infrastructure = Infrastructure({"infrastructure": {"name": "engagement_54", "global_arguments": {
+            "ansible": {"defaults": {"fact_caching_timeout": 600}, "ssh_connection": {"pipelining": False}}}}})
+
+        config = self.manager._Manager__ansible_config(120)
+
+        self.assertEqual(config.get("defaults", "forks"), "50")
+        self.assertEqual(config.get("defaults", "gathering"), "smart")
+        self.assertEqual(config.get("defaults", "fact_caching"), "jsonfile")
+        self.assertEqual(config.get("defaults", "fact_caching_timeout"), "600")
+        self.assertEqual(config.get("ssh_connection", "pipelining"), "False")
+        self.assertIn("ControlPersist", config.get("ssh_connection", "ssh_args"))
+        self.assertEqual(config.get("ssh_connection", "control_path_dir"), "~/.ansible/cp/engagement_54")
+        self.assertEqual(self.manager._Manager__ansible_config(3).get("defaults", "forks"), "3")
+
+    def test_generate_config(self):
+        self.manager.infrastructure = Infrastructure({"infrastructure": {"name": "engagement_54"}})
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                self.manager._Manager__generate_config(4)
+                mtime = os.stat("ansible.cfg").st_mtime_ns
+                self.manager._Manager__generate_config(4)
+                self.assertEqual(os.stat("ansible.cfg").st_mtime_ns, mtime)  # unchanged file is not rewritten
+
+                config = configparser.ConfigParser()
+                config.read("ansible.cfg")
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(config.get("defaults", "forks"), "4")
+        self.assertEqual(config.get("defaults", "fact_caching_connection"), os.path.join(tmp_dir, ".facts"))
+        self.assertEqual(config.get("ssh_connection", "control_path", vars={"directory": "/cp"}), "/cp/%C")
+
+    def test_unresolved_references(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        with open("tests/unit_tests/expected_hosts_post_orchestration.yaml") as hosts_file:
+            inventory = yaml.safe_load(hosts_file)
+        del inventory.get("all").get("children")["interactive_c2"]  # module not applied yet
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                with open("hosts.yaml", "w") as hosts_file:
+                    yaml.safe_dump(inventory, hosts_file)
+                self.manager.inventory_path = "hosts.yaml"
+                with patch("manager.Manager._Manager__generate_playbook", MagicMock()):
+                    self.manager.prepare(groups=["short_haul_c2"])  # other groups are not checked
+                    with self.assertRaises(UnresolvedReferenceError) as err:
+                        self.manager.prepare()
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(self.manager.unresolved, {"interactive_c2_redirector": ["interactive_c2"]})
+        self.assertIn("interactive_c2_redirector references interactive_c2", str(err.exception))
+
+    def test_rulesets(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        with open("tests/unit_tests/expected_hosts.yaml") as hosts_file:
+            inventory = yaml.safe_load(hosts_file)
+
+        rulesets = self.manager._Manager__rulesets(inventory)
+
+        self.assertEqual(rulesets.get("interactive_c2").sources, ["52.47.210.168"])
+        self.assertEqual(rulesets.get("interactive_c2").attacker, "147.251.0.0/16")
+        self.assertEqual(rulesets.get("short_haul_c2_redirector").sources, ["147.251.0.0/16"])
+
+        inventory.get("all").get("vars").pop("attacker")  # the firewall would lock Ansible out
+        with self.assertRaises(ValueError) as err:
+            self.manager._Manager__rulesets(inventory)
+        self.assertIn("attacker address is missing", str(err.exception))
+
+    def test_generate_rulesets(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        with open("tests/unit_tests/expected_hosts.yaml") as hosts_file:
+            inventory = yaml.safe_load(hosts_file)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                os.makedirs("firewall")
+                open("firewall/1.1.1.1.rules", "w").close()  # host no longer in the inventory
+                self.manager._Manager__generate_rulesets(inventory)
+                files = sorted(os.listdir("firewall"))
+                with open("firewall/78.128.250.194.rules") as rules_file:
+                    rules = rules_file.read()
+                with open("firewall/78.128.250.194.ipset") as ipset_file:
+                    ipset = ipset_file.read()
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(len(files), 8)
+        self.assertNotIn("1.1.1.1.rules", files)
+        self.assertIn("-A INPUT -s 52.47.210.168 -p tcp -m conntrack --ctstate NEW -j ACCEPT", rules)
+        self.assertEqual(ipset, "")
+
+    def test_host_hashes(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.manager.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        self.manager.inventory_path = "tests/unit_tests/expected_hosts.yaml"
+
+        ret = self.manager._Manager__host_hashes()
+        limited = self.manager._Manager__host_hashes(["interactive_c2"])
+
+        self.assertEqual(set(ret), {"interactive_c2", "interactive_c2_redirector",
+                                    "short_haul_c2", "short_haul_c2_redirector"})
+        self.assertEqual(limited, {"interactive_c2": ret.get("interactive_c2")})
+        self.assertEqual(len({digest for hosts in ret.values() for digest in hosts.values()}), 4)
+
+        with patch("manager.Manager._Manager__role_hash", MagicMock(side_effect=lambda role: role + " changed")):
+            changed = self.manager._Manager__host_hashes(["interactive_c2"])
+        self.assertNotEqual(changed, limited)
+
+        with patch("manager.yaml.safe_load", MagicMock(side_effect=lambda file: self.__moved_redirector(file))):
+            moved = self.manager._Manager__host_hashes(["interactive_c2"])
+        self.assertNotEqual(moved, limited)  # the resolved address changed
+
+    @staticmethod
+    def __moved_redirector(file):
+        inventory = yaml.load(file, Loader=yaml.SafeLoader)
+        inventory.get("all").get("children").get("interactive_c2").get("vars").update({"allow_from": ["52.47.210.169"]})
+        return inventory
@@ -0,0 +1,99 @@
+import unittest
+import yaml
+
+from model import Infrastructure, references, resolve_references, diff
+
+
+class TestInfrastructure(unittest.TestCase):
+    def setUp(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.infrastructure = Infrastructure(yaml.safe_load(description_file))
+
+    def test_instances(self):
+        self.assertEqual(self.infrastructure.name, "engagement_54")
+        self.assertEqual(len(self.infrastructure), 4)
+        self.assertEqual(list(self.infrastructure.names), ["interactive_c2_redirector", "interactive_c2",
+                                                          "short_haul_c2_redirector", "short_haul_c2"])
+        instance = self.infrastructure.get("interactive_c2")
+        self.assertEqual((instance.role, instance.provider, instance.path),
+                         ("c2_server", "openstack", "infrastructure.instances[1]"))
+        self.assertIn("short_haul_c2", self.infrastructure)
+        self.assertIsNone(self.infrastructure.get("unknown"))
+
+    def test_role_arguments(self):
+        instance = self.infrastructure.get("interactive_c2")
+
+        self.assertEqual(instance.role_arguments, {"accept_from": ["interactive_c2_redirector"],
+                                                   "ansible_user": "debian"})
+        self.assertEqual(instance.resolved_role_arguments, {"attacker": "147.251.0.0/16",
+                                                            "accept_from": ["interactive_c2_redirector"],
+                                                            "ansible_user": "debian"})
+
+    def test_provider_arguments(self):
+        infrastructure = Infrastructure({"infrastructure": {
+            "global_arguments": {"provider": {"region": "eu-central-1", "size": "t2.micro"}},
+            "instances": [{"name": "c2", "arguments": {"provider": {"size": "t2.large"}}}, {"name": "redirector"}]}})
+
+        self.assertEqual(infrastructure.get("c2").resolved_provider_arguments,
+                         {"region": "eu-central-1", "size": "t2.large"})
+        self.assertEqual(infrastructure.get("redirector").resolved_provider_arguments,
+                         {"region": "eu-central-1", "size": "t2.micro"})
+        self.assertEqual(infrastructure.get("redirector").role_arguments, {})
+
+    def test_references(self):
+        ret = references({"redirect_to": "c2", "accept_from": ["10.0.0.0/8", "redirector"]},
+                         {"c2", "redirector", "other"})
+
+        self.assertEqual(ret, {"c2", "redirector"})
+        self.assertEqual(self.infrastructure.get("interactive_c2_redirector").references, {"interactive_c2"})
+
+    def test_resolve_references(self):
+        groups = {"c2": ["1.1.1.1", "1.1.1.2"], "redirector": ["2.2.2.2"], "empty": []}
+        names = {"c2", "redirector", "empty", "missing"}
+
+        ret = resolve_references({"redirect_to": "c2", "accept_from": ["redirector", "147.251.0.0/16", "c2",
+                                                                      "2.2.2.2", "muni.cz"]}, groups, names)
+        unresolved = resolve_references({"redirect_to": "missing", "accept_from": ["empty"]}, groups, names)
+
+        self.assertEqual(ret, ({"redirect_to_host": "1.1.1.1", "redirect_to_hosts": ["1.1.1.1", "1.1.1.2"],
+                                "allow_from": ["2.2.2.2", "147.251.0.0/16", "1.1.1.1", "1.1.1.2", "muni.cz"]}, []))
+        self.assertEqual(resolve_references({"redirect_to": "muni.cz"}, groups, names),
+                         ({"redirect_to_host": "muni.cz", "redirect_to_hosts": ["muni.cz"]}, []))
+        self.assertEqual(unresolved, ({"redirect_to_host": None, "redirect_to_hosts": [], "allow_from": []},
+                                      ["missing", "empty"]))
+        self.assertEqual(resolve_references({}, groups, names), ({}, []))
+
+    def test_referencing(self):
+        self.assertEqual(self.infrastructure.referencing("interactive_c2"), {"interactive_c2_redirector"})
+        self.assertEqual(self.infrastructure.referencing("short_haul_c2_redirector"), {"short_haul_c2"})
+        self.assertEqual(self.infrastructure.referencing("unknown"), set())
+
+    def test_diff(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            description = yaml.safe_load(description_file)
+        instances = description.get("infrastructure").get("instances")
+        instances[1].get("arguments").update({"provider": {"flavor": "standard.large"}})  # interactive_c2
+        instances[3].get("arguments").get("role").update({"ansible_user": "ubuntu"})  # short_haul_c2
+        instances.pop(2)  # short_haul_c2_redirector
+        instances.append({"name": "new_redirector", "role": "http_redirector", "provider": "aws"})
+
+        ret = diff(self.infrastructure, Infrastructure(description))
+
+        self.assertEqual(ret, {"added": {"new_redirector"}, "removed": {"short_haul_c2_redirector"},
+                               "apply": {"new_redirector", "interactive_c2"},
+                               "configure": {"new_redirector", "interactive_c2", "interactive_c2_redirector",
+                                             "short_haul_c2"}})
+        self.assertEqual(diff(self.infrastructure, self.infrastructure),
+                         {"added": set(), "removed": set(), "apply": set(), "configure": set()})
+
+    def test_malformed(self):
+        infrastructure = Infrastructure({"infrastructure": {"instances": [{"name": "c2", "arguments": []}, "x"]}})
+
+        self.assertEqual(list(infrastructure.names), ["c2"])
+        self.assertEqual(infrastructure.get("c2").resolved_role_arguments, {})
+        self.assertEqual(len(Infrastructure({"infrastructure": []})), 0)
+        self.assertEqual(len(Infrastructure(None)), 0)
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            self.infrastructure.get("interactive_c2").extra = 1
@@ -1,35 +1,94 @@
 import unittest
 import yaml
 import json
-from unittest.mock import MagicMock, patch, call
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY, MagicMock, patch, call
 
-from orchestrator import Orchestrator
+import python_terraform as tf
+
+from orchestrator import Orchestrator, init_hash, init_terraform, apply_terraform, plan_terraform, planned_changes
+from model import Infrastructure
 from exceptions import TerraformError
+from profiler import Profiler
+from events import TerraformEvent
 
 
+@patch("orchestrator.ParallelismController.save", MagicMock())
 class TestOrchestrator(unittest.TestCase):
     def setUp(self):
-        self.orchestrator = Orchestrator({"infrastructure": {}})
+        self.orchestrator = Orchestrator(Infrastructure({"infrastructure": {}}))
 
     def test_changed_infrastructure_added(self):
-        tf_output = "dummy out\nApply complete! Resources: 22 added, 0 changed, 0 destroyed. \ndummy out"
-        self.assertTrue(self.orchestrator._Orchestrator__changed_infrastructure(tf_output))
+        self.assertTrue(self.orchestrator._Orchestrator__changed_infrastructure({"create": 22}))
 
     def test_changed_infrastructure_changed(self):
-        tf_output = "dummy out\nApply complete! Resources: 0 added, 2 changed, 0 destroyed. \ndummy out"
-        self.assertTrue(self.orchestrator._Orchestrator__changed_infrastructure(tf_output))
+        self.assertTrue(self.orchestrator._Orchestrator__changed_infrastructure({"update": 2, "noop": 3}))
 
     def test_changed_infrastructure_destroyed(self):
-        tf_output = "dummy out\nApply complete! Resources: 0 added, 0 changed, 5 destroyed. \ndummy out"
-        self.assertTrue(self.orchestrator._Orchestrator__changed_infrastructure(tf_output))
+        self.assertTrue(self.orchestrator._Orchestrator__changed_infrastructure({"delete": 5}))
 
     def test_changed_infrastructure_not_changed(self):
-        tf_output = "dummy out\nApply complete! Resources: 0 added, 0 changed, 0 destroyed. \ndummy out"
-        self.assertFalse(self.orchestrator._Orchestrator__changed_infrastructure(tf_output))
+        self.assertFalse(self.orchestrator._Orchestrator__changed_infrastructure({"read": 1, "noop": 4}))
+        self.assertFalse(self.orchestrator._Orchestrator__changed_infrastructure({}))
 
-    def test_parse_description(self):
+    @patch("events.subprocess.Popen")
+    @patch("orchestrator.print")
+    def test_apply_terraform(self, mock_print, mock_popen):
+        with open("tests/unit_tests/terraform_apply.jsonl") as apply_file:
+            mock_popen.return_value.__enter__.return_value.stdout = apply_file
+            mock_popen.return_value.__enter__.return_value.returncode = 0
+            ret, actions, err = apply_terraform(tf.Terraform(working_dir="test"), ["module.c2"], verbose=True)
+
+        self.assertEqual(mock_popen.call_args[0][0], ["terraform", "apply", "-json", "-input=false",
+                                                      "-auto-approve", "-target=module.c2"])
+        self.assertEqual(mock_popen.call_args[1].get("cwd"), "test")
+        self.assertEqual(ret, 0)
+        self.assertEqual(actions, {"create": 3, "read": 1})
+        self.assertEqual(err, "")
+        mock_print.assert_any_call("module.c2.aws_instance.instance[0]: Creation complete after 32s [id=i-0a1b2c]")
+
+    @patch("events.subprocess.Popen")
+    def test_apply_terraform_profiled(self, mock_popen):
+        profiler = Profiler()
+        with open("tests/unit_tests/terraform_apply.jsonl") as apply_file:
+            mock_popen.return_value.__enter__.return_value.stdout = apply_file
+            mock_popen.return_value.__enter__.return_value.returncode = 0
+            apply_terraform(tf.Terraform(), profiler=profiler)
+
+        spans = {event.get("name"): event for event in profiler.events if event.get("ph") == "X"}
+        self.assertEqual(set(spans), {"terraform apply", "module.c2.data.aws_ami.debian",
+                                      "module.c2.tls_private_key.ssh_key[0]", "module.c2.aws_key_pair.keypair[0]",
+                                      "module.c2.aws_instance.instance[0]"})
+        self.assertEqual(spans.get("terraform apply").get("args"), {"targets": None, "create": 3, "read": 1})
+        self.assertAlmostEqual(spans.get("module.c2.data.aws_ami.debian").get("dur"), 1e6)
+        self.assertEqual(spans.get("module.c2.data.aws_ami.debian").get("args"),
+                         {"action": "read", "status": "apply_complete"})
+
+    @patch("events.subprocess.Popen")
+    def test_apply_terraform_failed(self, mock_popen):
+        mock_popen.return_value.__enter__.return_value.stdout = iter([
+            '{"@level":"info","@message":"Terraform 1.0.0","type":"version"}\n',
+            '{"@level":"error","@message":"Error: creating EC2 Instance","type":"diagnostic",'
+            '"diagnostic":{"severity":"error","summary":"creating EC2 Instance","detail":"UnauthorizedOperation",'
+            '"address":"module.c2.aws_instance.instance[0]"}}\n'])
+        mock_popen.return_value.__enter__.return_value.returncode = 1
+
+        ret, actions, err = apply_terraform(tf.Terraform())
+
+        self.assertEqual(ret, 1)
+        self.assertEqual(actions, {})
+        self.assertEqual(err, "creating EC2 Instance: UnauthorizedOperation")
+
+    @patch("orchestrator.KeyStore.ensure")
+    def test_parse_description(self, mock_ensure):
         with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
-            self.orchestrator.infrastructure_description = yaml.safe_load(description_file).get("infrastructure")
+            self.orchestrator.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        mock_ensure.side_effect = lambda totals: {
+            name: ["ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{} {}_{}".format(name.upper().replace("_", ""), name, i)
+                   for i in range(total)] for name, total in totals.items()}
 
         with open("tests/unit_tests/expected_main.tf.json") as main_tf:
             main_json = main_tf.read()
@@ -42,11 +101,13 @@ class TestOrchestrator(unittest.TestCase):
             handle = m()
             handle.write.assert_has_calls(
                 [call(main_json), call(outputs_json)])  # Check that correct files would be created
+        mock_ensure.assert_called_once_with({"interactive_c2_redirector": 1, "interactive_c2": 1,
+                                             "short_haul_c2_redirector": 1, "short_haul_c2": 1})
 
-    @patch("orchestrator.Orchestrator.terraform.output")
+    @patch("orchestrator.TerraformState.outputs")
     def test_create_inventory(self, mock_tf_output):
         with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
-            self.orchestrator.infrastructure_description = yaml.safe_load(description_file).get("infrastructure")
+            self.orchestrator.infrastructure = Infrastructure(yaml.safe_load(description_file))
 
         with open("tests/unit_tests/expected_hosts_post_orchestration.yaml") as inventory_file:
             hosts = inventory_file.read()
@@ -61,26 +122,27 @@ class TestOrchestrator(unittest.TestCase):
             handle = m()
             handle.write.assert_has_calls([call(hosts)])  # Check that expected inventory file would be created
 
-    @patch("orchestrator.Orchestrator.terraform.state_cmd")
-    def test_list_resources(self, mock_tf_state):
+    def test_list_resources(self):
         with open("tests/unit_tests/terraform_state_out") as tf_state_file:
             tf_state = tf_state_file.read()
 
-        tf_state_list = tf_state.split("\n")
-        mock_tf_state.return_value = (0, tf_state, None)
+        tf_state_list = [resource for resource in tf_state.split("\n") if resource]
 
-        ret = self.orchestrator._Orchestrator__list_resources()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shutil.copy("tests/unit_tests/terraform_state.json", os.path.join(tmp_dir, "terraform.tfstate"))
+            orchestrator = Orchestrator(Infrastructure({"infrastructure": {}}), working_dir=tmp_dir)
+            ret = orchestrator._Orchestrator__list_resources()
         self.assertEqual(ret, tf_state_list)
 
     @patch("orchestrator.Orchestrator._Orchestrator__parse_description")
     @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
     @patch("orchestrator.Orchestrator._Orchestrator__changed_infrastructure")
-    @patch("orchestrator.Orchestrator.terraform.init")
-    @patch("orchestrator.Orchestrator.terraform.apply")
+    @patch("orchestrator.Terraform.init")
+    @patch("orchestrator.apply_terraform")
     @patch("orchestrator.print")
     def test_orchestrate_infrastructure(self, mock_print, mock_apply, mock_init, mock_change_infra, mock_create_inv, mock_parse):
         mock_init.return_value = (0, None, None)
-        mock_apply.return_value = (0, "terraform out", None)
+        mock_apply.return_value = (0, {"create": 1}, "")
         mock_change_infra.return_value = True
         self.orchestrator.verbose = True
 
@@ -89,19 +151,133 @@ class TestOrchestrator(unittest.TestCase):
         self.assertTrue(ret)
         mock_parse.assert_called_once()
         mock_init.assert_called_once()
-        mock_apply.assert_called_once()
+        mock_apply.assert_called_once_with(self.orchestrator.terraform, None, True, self.orchestrator.profiler,
+                                           refresh=True, parallelism=None, on_event=ANY)
         mock_create_inv.assert_called_once()
-        mock_print.assert_called_with("terraform out")
+        mock_change_infra.assert_called_once_with({"create": 1})
+
+    def test_planned_changes(self):
+        plan = {"resource_changes": [
+            {"address": "module.c2.data.aws_ami.debian", "module_address": "module.c2",
+             "change": {"actions": ["read"]}},
+            {"address": "module.c2.aws_instance.instance[0]", "module_address": "module.c2",
+             "change": {"actions": ["delete", "create"]}},
+            {"address": "module.c2.aws_key_pair.keypair[0]", "module_address": "module.c2",
+             "change": {"actions": ["update"]}},
+            {"address": "module.redirector.aws_instance.instance[0]", "module_address": "module.redirector",
+             "change": {"actions": ["no-op"]}},
+            {"address": "module.old.aws_instance.instance[0]", "module_address": "module.old",
+             "change": {"actions": ["delete"]}}]}
+
+        self.assertEqual(planned_changes(plan), {"c2": ["replace", "update"], "old": ["delete"]})
+        self.assertEqual(planned_changes({"format_version": "1.0"}), {})
+
+    def test_plan_terraform(self):
+        terraform = MagicMock()
+        terraform.plan.return_value = (2, "", "")
+        terraform.cmd.return_value = (0, '{"resource_changes": []}', "")
+
+        self.assertEqual(plan_terraform(terraform, "rtib.tfplan", refresh=False), (0, {"resource_changes": []}, ""))
+        terraform.plan.assert_called_once_with(out="rtib.tfplan", refresh=False)
+        terraform.cmd.assert_called_once_with("show", "rtib.tfplan", json=tf.IsFlagged)
+
+        terraform.plan.return_value = (1, "", "terraform error")
+        self.assertEqual(plan_terraform(terraform, "rtib.tfplan"), (1, None, "terraform error"))
+
+    @patch("events.subprocess.Popen")
+    def test_apply_terraform_saved_plan(self, mock_popen):
+        mock_popen.return_value.__enter__.return_value.stdout = iter([])
+        mock_popen.return_value.__enter__.return_value.returncode = 0
+
+        apply_terraform(tf.Terraform(), ["module.c2"], plan_path="rtib.tfplan")
+        self.assertEqual(mock_popen.call_args[0][0], ["terraform", "apply", "-json", "-input=false",
+                                                      "-auto-approve", "rtib.tfplan"])
+
+        apply_terraform(tf.Terraform(), refresh=False)
+        self.assertEqual(mock_popen.call_args[0][0], ["terraform", "apply", "-json", "-input=false",
+                                                      "-auto-approve", "-refresh=false"])
+
+    @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
+    @patch("orchestrator.init_terraform")
+    @patch("orchestrator.plan_terraform")
+    @patch("orchestrator.apply_terraform")
+    def test_saved_plan(self, mock_apply, mock_plan, mock_init, mock_create_inv):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.orchestrator.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        mock_init.return_value = (0, "", "")
+        mock_apply.return_value = (0, {"create": 1}, "")
+
+        def plan(terraform, plan_path, refresh, profiler):
+            with open(plan_path, "w") as plan_file:
+                plan_file.write("binary plan")
+            return 0, {"resource_changes": [{"module_address": "module.interactive_c2",
+                                             "change": {"actions": ["create"]}}]}, ""
+        mock_plan.side_effect = plan
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "engagement"))
+            shutil.copytree("providers", os.path.join(tmp_dir, "providers"))
+            os.chdir(os.path.join(tmp_dir, "engagement"))
+            try:
+                self.orchestrator.refresh = False
+                self.assertEqual(self.orchestrator.plan_infrastructure(), {"interactive_c2": ["create"]})
+                mock_plan.assert_called_once_with(self.orchestrator.terraform, "rtib.tfplan", False,
+                                                  self.orchestrator.profiler)
+                with open("rtib.tfplan.json") as plan_file:
+                    self.assertEqual(json.load(plan_file).get("changes"), {"interactive_c2": ["create"]})
+
+                self.assertTrue(self.orchestrator.orchestrate_infrastructure())
+                self.assertTrue(self.orchestrator.applied_plan)
+                mock_apply.assert_called_once_with(self.orchestrator.terraform, verbose=False,
+                                                   profiler=self.orchestrator.profiler, plan_path="rtib.tfplan")
+                self.assertFalse(os.path.exists("rtib.tfplan"))
+                self.assertFalse(os.path.exists("rtib.tfplan.json"))
+
+                # a plan changing nothing is not applied at all
+                mock_plan.side_effect = None
+                mock_plan.return_value = (0, {"resource_changes": []}, "")
+                self.assertEqual(self.orchestrator.plan_infrastructure(), {})
+                with open("rtib.tfplan", "w") as plan_file:
+                    plan_file.write("binary plan")
+                self.assertFalse(self.orchestrator.orchestrate_infrastructure())
+                self.assertTrue(self.orchestrator.applied_plan)
+                mock_apply.assert_called_once()
+                self.assertFalse(os.path.exists("rtib.tfplan"))  # used once, like an applied plan
+                self.assertFalse(os.path.exists("rtib.tfplan.json"))
+
+                # the next orchestration refreshes and applies again, out-of-band changes are reconverged
+                self.orchestrator.orchestrate_infrastructure()
+                self.assertFalse(self.orchestrator.applied_plan)
+                self.assertEqual(mock_apply.call_count, 2)
+
+                # a stale plan is not applied
+                self.orchestrator.plan_infrastructure()
+                with open("rtib.tfplan", "w") as plan_file:
+                    plan_file.write("binary plan")
+                with open("terraform.tfstate", "w") as state_file:
+                    state_file.write('{"serial": 2}')
+                self.orchestrator.orchestrate_infrastructure()
+                self.assertFalse(self.orchestrator.applied_plan)
+                self.assertEqual(mock_apply.call_count, 3)
+                mock_apply.assert_called_with(self.orchestrator.terraform, None, False, self.orchestrator.profiler,
+                                              refresh=False, parallelism=ANY, on_event=ANY)
+            finally:
+                os.chdir(cwd)
+
+    def test_plan_sharded(self):
+        with self.assertRaises(ValueError):
+            Orchestrator(Infrastructure({"infrastructure": {}}), shard_by="instance").plan_infrastructure()
 
     @patch("orchestrator.Orchestrator._Orchestrator__parse_description")
     @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
     @patch("orchestrator.Orchestrator._Orchestrator__changed_infrastructure")
-    @patch("orchestrator.Orchestrator.terraform.init")
-    @patch("orchestrator.Orchestrator.terraform.apply")
+    @patch("orchestrator.Terraform.init")
+    @patch("orchestrator.apply_terraform")
     @patch("orchestrator.print")
     def test_orchestrate_infrastructure_init_failed(self, mock_print, mock_apply, mock_init, mock_change_infra, mock_create_inv, mock_parse):
         mock_init.return_value = (1, None, "terraform error")
-        mock_apply.return_value = (0, "terraform out", None)
+        mock_apply.return_value = (0, {}, "")
         mock_change_infra.return_value = True
 
         with self.assertRaises(TerraformError) as err:
@@ -113,12 +289,12 @@ class TestOrchestrator(unittest.TestCase):
     @patch("orchestrator.Orchestrator._Orchestrator__parse_description")
     @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
     @patch("orchestrator.Orchestrator._Orchestrator__changed_infrastructure")
-    @patch("orchestrator.Orchestrator.terraform.init")
-    @patch("orchestrator.Orchestrator.terraform.apply")
+    @patch("orchestrator.Terraform.init")
+    @patch("orchestrator.apply_terraform")
     @patch("orchestrator.print")
     def test_orchestrate_infrastructure_apply_failed(self, mock_print, mock_apply, mock_init, mock_change_infra, mock_create_inv, mock_parse):
         mock_init.return_value = (0, None, None)
-        mock_apply.return_value = (1, "terraform out", "terraform error")
+        mock_apply.return_value = (1, {}, "terraform error")
         mock_change_infra.return_value = True
 
         with self.assertRaises(TerraformError) as err:
@@ -127,7 +303,163 @@ class TestOrchestrator(unittest.TestCase):
             mock_init.assert_called_once()
             mock_apply.assert_called_once()
 
-    @patch("orchestrator.Orchestrator.terraform.destroy")
+    @patch("orchestrator.Orchestrator._Orchestrator__parse_description")
+    @patch("orchestrator.TerraformState.outputs")
+    @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
+    @patch("orchestrator.Terraform.init")
+    @patch("orchestrator.apply_terraform")
+    def test_orchestrate_modules(self, mock_apply, mock_init, mock_create_inv, mock_outputs, mock_parse):
+        self.orchestrator.infrastructure = Infrastructure({"infrastructure": {"instances": [
+            {"name": "c2"}, {"name": "redirector"}, {"name": "unchanged"}, {"name": "updated"}]}})
+        mock_init.return_value = (0, None, None)
+        outputs = {"unchanged": {"value": {"hosts": ["3.3.3.3"]}}, "updated": {"value": {"hosts": ["4.4.4.4"]}}}
+        mock_outputs.side_effect = lambda: dict(outputs)
+        mock_create_inv.side_effect = lambda tf_output_dict=None, merge=False: {
+            module: {"hosts": {output.get("value").get("hosts")[0]: {}}}
+            for module, output in (tf_output_dict or outputs).items()}
+        log = []
+
+        def event(event_type, module):
+            return TerraformEvent(event_type, resource="module.{}.instance[0]".format(module),
+                                  module="module." + module, action="create")
+
+        def apply_terraform(terraform, targets, verbose, profiler, refresh, parallelism, on_event):
+            for module in ("c2", "redirector", "updated"):
+                on_event(event("planned_change", module))
+            for module in ("c2", "redirector", "updated"):
+                on_event(event("apply_start", module))
+            outputs.update({"c2": {"value": {"hosts": ["1.1.1.1"]}}})  # written into the state
+            log.append("c2 applied")
+            on_event(event("apply_complete", "c2"))
+            log.append("updated applied")
+            on_event(event("apply_complete", "updated"))  # in-place update, the output did not change
+            outputs.update({"redirector": {"value": {"hosts": ["2.2.2.2"]}}})
+            log.append("redirector applied")
+            on_event(event("apply_complete", "redirector"))
+            log.append("apply done")
+            return 0, {"create": 2, "update": 1}, ""
+
+        mock_apply.side_effect = apply_terraform
+
+        ret = self.orchestrator.orchestrate_modules(lambda module, group: log.append((module, group)))
+
+        self.assertTrue(ret)
+        mock_apply.assert_called_once_with(self.orchestrator.terraform, None, False, self.orchestrator.profiler,
+                                           refresh=True, parallelism=None, on_event=ANY)
+        # modules are reported while the single apply still runs
+        self.assertEqual(log, [("unchanged", {"hosts": {"3.3.3.3": {}}}), "c2 applied",
+                               ("c2", {"hosts": {"1.1.1.1": {}}}), "updated applied", "redirector applied",
+                               ("redirector", {"hosts": {"2.2.2.2": {}}}), "apply done",
+                               ("updated", {"hosts": {"4.4.4.4": {}}})])
+        mock_create_inv.assert_any_call({"c2": {"value": {"hosts": ["1.1.1.1"]}}}, merge=True)
+
+    @patch("orchestrator.Orchestrator._Orchestrator__parse_description", MagicMock())
+    @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
+    @patch("orchestrator.Terraform.init")
+    @patch("orchestrator.apply_terraform")
+    def test_orchestrate_modules_partial_state(self, mock_apply, mock_init, mock_create_inv):
+        mock_init.return_value = (0, None, None)
+        mock_create_inv.side_effect = lambda tf_output_dict=None, merge=False: {
+            module: output.get("value") for module, output in (tf_output_dict or {}).items()}
+        state = {"version": 4, "outputs": {"c2": {"value": {"hosts": ["1.1.1.1"]}},
+                                           "redirector": {"value": {"hosts": ["2.2.2.2"]}}}}
+        log = []
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            orchestrator = Orchestrator(Infrastructure({"infrastructure": {"instances": [
+                {"name": "c2"}, {"name": "redirector"}]}}), working_dir=tmp_dir)
+            state_path = os.path.join(tmp_dir, "terraform.tfstate")
+
+            def event(event_type, module):
+                return TerraformEvent(event_type, resource="module.{}.instance[0]".format(module),
+                                      module="module." + module, action="create")
+
+            def apply_terraform(terraform, targets, verbose, profiler, refresh, parallelism, on_event):
+                for module in ("c2", "redirector"):
+                    on_event(event("planned_change", module))
+                    on_event(event("apply_start", module))
+                with open(state_path, "w") as state_file:
+                    state_file.write(json.dumps(state)[:40])  # truncated while Terraform rewrites it
+                on_event(event("apply_complete", "c2"))
+                log.append("c2 applied")
+                with open(state_path, "w") as state_file:
+                    json.dump(state, state_file)
+                on_event(event("apply_complete", "redirector"))
+                log.append("apply done")
+                return 0, {"create": 2}, ""
+
+            mock_apply.side_effect = apply_terraform
+
+            orchestrator.orchestrate_modules(lambda module, group: log.append((module, group)))
+
+        self.assertEqual(log, ["c2 applied", ("c2", {"hosts": ["1.1.1.1"]}),
+                               ("redirector", {"hosts": ["2.2.2.2"]}), "apply done"])
+
+    @patch("orchestrator.Orchestrator._Orchestrator__parse_description")
+    @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
+    @patch("orchestrator.Terraform.init")
+    @patch("orchestrator.apply_terraform")
+    def test_orchestrate_modules_apply_failed(self, mock_apply, mock_init, mock_create_inv, mock_parse):
+        self.orchestrator.infrastructure = Infrastructure({"infrastructure": {"instances": [{"name": "c2"},
+                                                                                         {"name": "redirector"}]}})
+        mock_init.return_value = (0, None, None)
+        mock_apply.return_value = (1, {}, "terraform error")
+        on_module_ready = MagicMock()
+
+        with self.assertRaises(TerraformError):
+            self.orchestrator.orchestrate_modules(on_module_ready)
+
+        mock_apply.assert_called_once()
+        on_module_ready.assert_not_called()
+
+    def test_init_terraform_cached(self):
+        terraform = MagicMock()
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "providers", "aws"))
+            with open(os.path.join(tmp_dir, "providers", "aws", "main.tf"), "w") as main_tf:
+                main_tf.write("resource {}")
+            os.makedirs(os.path.join(tmp_dir, "test", ".terraform"))
+            os.chdir(os.path.join(tmp_dir, "test"))
+            try:
+                with open("main.tf.json", "w") as main_tf_json:
+                    json.dump({"module": {"c2": {"source": "../providers/aws", "name": "c2"}}}, main_tf_json)
+                terraform.init.return_value = (0, "init out", "")
+
+                self.assertEqual(init_terraform(terraform), (0, "init out", ""))
+                terraform.init.assert_called_once_with(plugin_dir=None)
+
+                # module arguments do not require init
+                with open("main.tf.json", "w") as main_tf_json:
+                    json.dump({"module": {"c2": {"source": "../providers/aws", "name": "c2", "total": 2}}},
+                              main_tf_json)
+                self.assertEqual(init_terraform(terraform)[0], 0)
+                terraform.init.assert_called_once()
+
+                # changed provider module or lock file requires init
+                with open("../providers/aws/main.tf", "a") as main_tf:
+                    main_tf.write("resource {}")
+                init_terraform(terraform)
+                with open(".terraform.lock.hcl", "w") as lock_file:
+                    lock_file.write("provider {}")
+                init_terraform(terraform, plugin_dir="/mirror")
+                self.assertEqual(terraform.init.call_count, 3)
+                terraform.init.assert_called_with(plugin_dir="/mirror")
+
+                # added module with an already used source requires init
+                hash_before = init_hash()
+                with open("main.tf.json", "w") as main_tf_json:
+                    json.dump({"module": {"c2": {"source": "../providers/aws", "name": "c2", "total": 2},
+                                          "redirector": {"source": "../providers/aws", "name": "redirector"}}},
+                              main_tf_json)
+                self.assertNotEqual(init_hash(), hash_before)
+                init_terraform(terraform)
+                self.assertEqual(terraform.init.call_count, 4)
+            finally:
+                os.chdir(cwd)
+
+    @patch("orchestrator.Terraform.destroy")
     @patch("orchestrator.print")
     @patch("shutil.rmtree", MagicMock())
     def test_destroy_infrastructure(self, mock_print, mock_destroy):
@@ -138,7 +470,7 @@ class TestOrchestrator(unittest.TestCase):
 
         mock_print.assert_called_with("terraform out")
 
-    @patch("orchestrator.Orchestrator.terraform.destroy")
+    @patch("orchestrator.Terraform.destroy")
     @patch("shutil.rmtree", MagicMock())
     def test_destroy_infrastructure_failed(self, mock_destroy):
         mock_destroy.return_value = (1, "terraform out", "terraform error")
@@ -147,14 +479,269 @@ class TestOrchestrator(unittest.TestCase):
             self.orchestrator.destroy_infrastructure()
             self.assertEquals(err.exception, "terraform error")
 
-    @patch("orchestrator.Orchestrator.orchestrate_infrastructure", MagicMock)
-    @patch("orchestrator.Orchestrator.terraform.taint")
-    @patch("orchestrator.Orchestrator._Orchestrator__list_resources")
-    def test_rebuild_instance(self, mock_list_resources, mock_taint):
-        mock_list_resources.return_value = ["module.testinstance.dummytext", "module.testinstance2.dummytext"]
+    @patch("orchestrator.Orchestrator._Orchestrator__parse_description", MagicMock())
+    @patch("orchestrator.init_terraform", MagicMock(return_value=(0, None, None)))
+    @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
+    @patch("orchestrator.TerraformState.outputs")
+    @patch("orchestrator.apply_terraform")
+    @patch("orchestrator.Terraform.taint", create=True)
+    @patch("orchestrator.TerraformState.resources")
+    def test_rebuild_instance(self, mock_resources, mock_taint, mock_apply, mock_output, mock_create_inv):
+        self.orchestrator.infrastructure = Infrastructure({"infrastructure": {"instances": [
+            {"name": "testinstance"}, {"name": "testinstance2"}]}})
+        mock_resources.return_value = ["data.aws_ami.debian", "module.testinstance.dummytext",
+                                       "module.testinstance2.dummytext"]
+        mock_apply.return_value = (0, {"create": 2}, "")
+        mock_output.return_value = {"testinstance": {"value": {"hosts": ["1.2.3.4"]}},
+                                    "testinstance2": {"value": {"hosts": ["5.6.7.8"]}}}
 
         self.orchestrator.rebuild_instance("testinstance")
 
         mock_taint.assert_called_once_with("module.testinstance.dummytext")
+        mock_apply.assert_called_once_with(self.orchestrator.terraform, ["module.testinstance"], False,
+                                           self.orchestrator.profiler, refresh=True, parallelism=None, on_event=ANY)
+        mock_create_inv.assert_called_once_with({"testinstance": {"value": {"hosts": ["1.2.3.4"]}}}, merge=True)
+
+        mock_output.return_value = {}
+        with self.assertRaises(TerraformError):
+            self.orchestrator.rebuild_instance("testinstance")
+
+    @patch("orchestrator.apply_terraform")
+    @patch("orchestrator.TerraformState.resources")
+    def test_rebuild_unknown_instance(self, mock_resources, mock_apply):
+        with self.assertRaises(ValueError):
+            self.orchestrator.rebuild_instance("typo")
 
+        mock_resources.assert_not_called()
+        mock_apply.assert_not_called()
 
+    @patch("orchestrator.Orchestrator._Orchestrator__parse_description", MagicMock())
+    @patch("orchestrator.init_terraform", MagicMock(return_value=(0, None, None)))
+    @patch("orchestrator.Orchestrator._Orchestrator__create_inventory")
+    @patch("orchestrator.TerraformState.outputs")
+    @patch("orchestrator.apply_terraform")
+    def test_orchestrate_instances(self, mock_apply, mock_output, mock_create_inv):
+        mock_apply.return_value = (0, {"create": 1, "delete": 1}, "")
+        mock_output.return_value = {"testinstance": {"value": {"hosts": ["1.2.3.4"]}},
+                                    "testinstance2": {"value": {"hosts": ["5.6.7.8"]}}}
+
+        ret = self.orchestrator.orchestrate_instances(["testinstance"], ["removed"])
+
+        self.assertTrue(ret)
+        mock_apply.assert_called_once_with(self.orchestrator.terraform, ["module.testinstance", "module.removed"],
+                                           False, self.orchestrator.profiler, refresh=True, parallelism=None,
+                                           on_event=ANY)
+        mock_create_inv.assert_called_once_with({"testinstance": {"value": {"hosts": ["1.2.3.4"]}}}, merge=True,
+                                                removed=["removed"])
+
+        mock_apply.reset_mock()
+        self.assertFalse(self.orchestrator.orchestrate_instances([]))
+        mock_apply.assert_not_called()
+
+    @patch("orchestrator.TerraformState.outputs")
+    def test_create_inventory_merge(self, mock_tf_output):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            orchestrator = Orchestrator(Infrastructure({"infrastructure": {}}), working_dir=tmp_dir)
+            with open(os.path.join(tmp_dir, "hosts.yaml"), "w") as hosts_file:
+                hosts_file.write(yaml.safe_dump({"all": {"children": {
+                    "c2": {"hosts": {"1.1.1.1": {}}, "vars": {"ansible_user": "debian"}},
+                    "redirector": {"hosts": {"2.2.2.2": {}}, "vars": {}},
+                    "removed": {"hosts": {"4.4.4.4": {}}, "vars": {}}}}}))
+
+            orchestrator._Orchestrator__create_inventory({"redirector": {"value": {"hosts": ["3.3.3.3"]}}}, merge=True)
+            orchestrator._Orchestrator__create_inventory({}, merge=True, removed=["removed", "unknown"])
+
+            with open(os.path.join(tmp_dir, "hosts.yaml")) as hosts_file:
+                children = yaml.safe_load(hosts_file).get("all").get("children")
+
+        mock_tf_output.assert_not_called()
+        self.assertEqual(list(children), ["c2", "redirector"])
+        self.assertEqual(children.get("c2"), {"hosts": {"1.1.1.1": {}}, "vars": {"ansible_user": "debian"}})
+        self.assertEqual(children.get("redirector"),
+                         {"hosts": {"3.3.3.3": {"ansible_ssh_private_key_file": "ssh_keys/redirector_0"}}, "vars": {}})
+
+    @patch("orchestrator.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("orchestrator.destroy_shard")
+    @patch("orchestrator.apply_shard")
+    def test_orchestrate_shards(self, mock_apply_shard, mock_destroy_shard):
+        def apply_shard(shard_dir, plugin_dir, verbose, profile, parallelism, delay, env):
+            module = os.path.basename(shard_dir)
+            return (0, {"create": 3}, "",
+                    {module: {"value": {"hosts": ["10.0.0.{}".format(len(module))]}}}, [], 1.0)
+
+        mock_apply_shard.side_effect = apply_shard
+        mock_destroy_shard.return_value = (0, "Destroy complete!", "")
+        description = {"infrastructure": {"name": "test", "instances": [
+            {"name": "c2", "role": "c2_server", "provider": "aws"},
+            {"name": "redirector", "role": "pipe_redirector", "provider": "aws"}]}}
+        orchestrator = Orchestrator(Infrastructure(description), shard_by="instance")
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "providers", "aws"))
+            with open(os.path.join(tmp_dir, "providers", "aws", "main.tf"), "w") as main_tf:
+                main_tf.write("resource {}")
+            os.makedirs(os.path.join(tmp_dir, "test", "ssh_keys"))
+            os.chdir(os.path.join(tmp_dir, "test"))
+            try:
+                self.assertTrue(orchestrator.orchestrate_infrastructure())
+                with open("shards/c2/main.tf.json") as main_tf_json:
+                    self.assertEqual(json.load(main_tf_json).get("module").get("c2").get("source"),
+                                     "../../../providers/aws")
+                with open("hosts.yaml") as hosts_file:
+                    children = yaml.safe_load(hosts_file).get("all").get("children")
+                self.assertEqual(list(children.get("redirector").get("hosts")), ["10.0.0.10"])
+                self.assertEqual(mock_apply_shard.call_count, 2)
+
+                # unchanged shards are not applied again
+                self.assertFalse(orchestrator.orchestrate_infrastructure())
+                self.assertEqual(mock_apply_shard.call_count, 2)
+
+                # shards of removed instances are destroyed
+                description.get("infrastructure").get("instances").pop()
+                orchestrator.infrastructure = Infrastructure(description)
+                self.assertTrue(orchestrator.orchestrate_infrastructure())
+                mock_destroy_shard.assert_called_once_with("shards/redirector", {})
+                self.assertFalse(os.path.exists("shards/redirector"))
+                with open("hosts.yaml") as hosts_file:
+                    self.assertEqual(list(yaml.safe_load(hosts_file).get("all").get("children")), ["c2"])
+            finally:
+                os.chdir(cwd)
+
+    @patch("orchestrator.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("orchestrator.apply_shard")
+    def test_orchestrate_shards_failed(self, mock_apply_shard):
+        mock_apply_shard.return_value = (1, {}, "terraform error", None, [], 1.0)
+        description = {"infrastructure": {"name": "test", "instances": [
+            {"name": "c2", "role": "c2_server", "provider": "aws"}]}}
+        orchestrator = Orchestrator(Infrastructure(description), shard_by="provider")
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "providers", "aws"))
+            os.makedirs(os.path.join(tmp_dir, "test"))
+            os.chdir(os.path.join(tmp_dir, "test"))
+            try:
+                with self.assertRaises(TerraformError) as err:
+                    orchestrator.orchestrate_infrastructure()
+                self.assertIn("shards/aws: terraform error", str(err.exception))
+                self.assertFalse(os.path.exists("shards/aws/.applied"))
+            finally:
+                os.chdir(cwd)
+
+    @patch("orchestrator.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("orchestrator.apply_shard")
+    def test_orchestrate_shards_throttled(self, mock_apply_shard):
+        outputs = {"c2": {"value": {"hosts": ["10.0.0.1"]}}}
+        mock_apply_shard.side_effect = [(1, {"create": 1}, "Error: RequestLimitExceeded", None, [], 30.0),
+                                        (0, {"create": 1}, "", outputs, [], 30.0)]
+        description = {"infrastructure": {"name": "test", "instances": [
+            {"name": "c2", "role": "c2_server", "provider": "aws"}]}}
+        orchestrator = Orchestrator(Infrastructure(description), shard_by="provider")
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "providers", "aws"))
+            os.makedirs(os.path.join(tmp_dir, "test"))
+            os.chdir(os.path.join(tmp_dir, "test"))
+            try:
+                self.assertTrue(orchestrator.orchestrate_infrastructure())
+                self.assertTrue(os.path.exists("shards/aws/.applied"))
+            finally:
+                os.chdir(cwd)
+
+        mock_apply_shard.assert_has_calls([call("shards/aws", None, False, False, 10, 0.0, {}),
+                                           call("shards/aws", None, False, False, 5, orchestrator.retry_delay, {})])
+        self.assertEqual(orchestrator.parallelism.parallelism("aws"), 7)
+
+    @patch("orchestrator.Orchestrator._Orchestrator__parse_description", MagicMock())
+    @patch("orchestrator.init_terraform", MagicMock(return_value=(0, None, None)))
+    @patch("orchestrator.Orchestrator._Orchestrator__create_inventory", MagicMock())
+    @patch("orchestrator.time.sleep")
+    @patch("orchestrator.apply_terraform")
+    def test_orchestrate_infrastructure_throttled(self, mock_apply, mock_sleep):
+        self.orchestrator.infrastructure = Infrastructure({"infrastructure": {"instances": [
+            {"name": "c2", "provider": "aws"}, {"name": "redirector", "provider": "aws"},
+            {"name": "server", "provider": "openstack"}]}})
+        attempts = [[TerraformEvent("apply_complete", resource="module.c2.aws_instance.instance[0]",
+                                    module="module.c2", action="create"),
+                     TerraformEvent("apply_complete", resource="module.server.openstack_compute_instance_v2.instance[0]",
+                                    module="module.server", action="create"),
+                     TerraformEvent("diagnostic", level="error", resource="module.redirector.aws_instance.instance[0]",
+                                    message="creating EC2 Instance: RequestLimitExceeded: Request limit exceeded.")],
+                    [TerraformEvent("apply_complete", resource="module.redirector.aws_instance.instance[0]",
+                                    module="module.redirector", action="create")]]
+
+        def apply(terraform, targets, verbose, profiler, refresh, parallelism, on_event):
+            events = attempts.pop(0)
+            for event in events:
+                on_event(event)
+            if any(event.level == "error" for event in events):
+                return 1, {"create": 2}, "RequestLimitExceeded"
+            return 0, {"create": 1}, ""
+        mock_apply.side_effect = apply
+
+        self.assertTrue(self.orchestrator.orchestrate_infrastructure())
+
+        self.assertEqual(mock_apply.call_args_list[0][0][1], None)
+        self.assertEqual(mock_apply.call_args_list[0][1].get("parallelism"), 10)
+        self.assertEqual(mock_apply.call_args_list[1][0][1], ["module.redirector"])  # only the failed module
+        self.assertEqual(mock_apply.call_args_list[1][1].get("parallelism"), 5)
+        mock_sleep.assert_called_once_with(self.orchestrator.retry_delay)
+        self.assertEqual(self.orchestrator.parallelism.parallelism("aws"), 7)
+        self.assertEqual(self.orchestrator.parallelism.parallelism("openstack"), 12)
+
+    @patch("orchestrator.Orchestrator._Orchestrator__parse_description", MagicMock())
+    @patch("orchestrator.init_terraform", MagicMock(return_value=(0, None, None)))
+    @patch("orchestrator.time.sleep")
+    @patch("orchestrator.apply_terraform")
+    def test_orchestrate_infrastructure_not_retried(self, mock_apply, mock_sleep):
+        self.orchestrator.infrastructure = Infrastructure({"infrastructure": {"instances": [
+            {"name": "c2", "provider": "aws"}]}})
+        mock_apply.return_value = (1, {}, "InvalidAMIID.NotFound")
+
+        with self.assertRaises(TerraformError):
+            self.orchestrator.orchestrate_infrastructure()
+        mock_apply.assert_called_once()
+        mock_sleep.assert_not_called()
+
+        # throttling persisting after max_retries retries fails the apply
+        mock_apply.reset_mock()
+        mock_apply.side_effect = lambda *args, on_event, **kwargs: (
+            on_event(TerraformEvent("diagnostic", level="error", message="Throttling: Rate exceeded")),
+            (1, {}, "Throttling: Rate exceeded"))[1]
+        with self.assertRaises(TerraformError):
+            self.orchestrator.orchestrate_infrastructure()
+        self.assertEqual(mock_apply.call_count, self.orchestrator.max_retries + 1)
+        self.assertEqual([args[0][0] for args in mock_sleep.call_args_list], [5.0, 10.0, 20.0])
+
+    def test_unknown_shard_mode(self):
+        with self.assertRaises(ValueError):
+            Orchestrator({"infrastructure": {}}, shard_by="region")
+
+    @patch("orchestrator.TerraformState.outputs")
+    def test_working_dir(self, mock_tf_output):
+        mock_tf_output.return_value = {"c2": {"value": {"hosts": ["1.1.1.1"]}}}
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            orchestrators = [Orchestrator(Infrastructure({"infrastructure": {}}), plugin_cache_dir=os.path.join(
+                tmp_dir, "plugins"), working_dir=os.path.join(tmp_dir, name)) for name in ("range_1", "range_2")]
+            for orchestrator in orchestrators:
+                os.makedirs(orchestrator.working_dir)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(lambda orchestrator: orchestrator._Orchestrator__create_inventory(), orchestrators))
+
+            inventories = []
+            for name in ("range_1", "range_2"):
+                with open(os.path.join(tmp_dir, name, "hosts.yaml")) as hosts_file:
+                    inventories.append(yaml.safe_load(hosts_file))
+
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(inventories[0], inventories[1])
+        self.assertEqual(inventories[0].get("all").get("children").get("c2").get("hosts"),
+                         {"1.1.1.1": {"ansible_ssh_private_key_file": "ssh_keys/c2_0"}})
+        self.assertEqual(orchestrators[0].terraform.working_dir, os.path.join(tmp_dir, "range_1"))
+        self.assertEqual(orchestrators[0].terraform.environment().get("TF_PLUGIN_CACHE_DIR"),
+                         os.path.join(tmp_dir, "plugins"))
+        self.assertNotIn("TF_PLUGIN_CACHE_DIR", os.environ)
+        self.assertEqual(yaml.safe_dump(None), "null\n...\n")  # the global dumper is left untouched
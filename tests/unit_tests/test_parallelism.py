@@ -0,0 +1,60 @@
+import os
+import json
+import tempfile
+import unittest
+
+from parallelism import ParallelismController
+
+
+class TestParallelismController(unittest.TestCase):
+    def test_throttled(self):
+        self.assertTrue(ParallelismController.throttled("creating EC2 Instance: RequestLimitExceeded: Request limit "
+                                                        "exceeded."))
+        self.assertTrue(ParallelismController.throttled("Error: ThrottlingException: Rate exceeded"))
+        self.assertTrue(ParallelismController.throttled("Expected HTTP response code [200] but got 429"))
+        self.assertTrue(ParallelismController.throttled("OverLimit: Rate limit exceeded"))
+        self.assertTrue(ParallelismController.throttled("TooManyRequests: too many requests"))
+        self.assertFalse(ParallelismController.throttled("Quota exceeded for instances: Requested 1, but already "
+                                                         "used 10 of 10 instances"))
+        self.assertFalse(ParallelismController.throttled("Error waiting for instance (i-0a1b2c) to become ready: "
+                                                         "timeout while waiting for state to become 'ACTIVE'"))
+        self.assertFalse(ParallelismController.throttled("context deadline exceeded: request timed out"))
+        self.assertFalse(ParallelismController.throttled("RequestTimeout: Your socket connection to the server "
+                                                         "was not read from or written to within the timeout period"))
+        self.assertFalse(ParallelismController.throttled("503 Service Unavailable"))
+        self.assertFalse(ParallelismController.throttled("InvalidAMIID.NotFound: The image id does not exist"))
+        self.assertFalse(ParallelismController.throttled(None))
+
+    def test_record(self):
+        controller = ParallelismController(initial=10, minimum=1, maximum=13, step=2)
+
+        self.assertEqual(controller.parallelism("aws"), 10)
+        self.assertEqual(controller.record("aws", 30, 60.0, throttled=False), 12)
+        self.assertEqual(controller.record("aws", 30, 60.0, throttled=False), 13)
+        self.assertEqual(controller.record("aws", 0, 5.0, throttled=True), 6)
+        for _ in range(5):
+            controller.record("aws", 0, 5.0, throttled=True)
+        self.assertEqual(controller.parallelism("aws"), 1)
+        self.assertEqual(controller.parallelism("openstack"), 10)
+
+    def test_save(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                controller = ParallelismController()
+                controller.record("aws", 40, 120.0, throttled=True)
+                controller.save()
+                with open(ParallelismController.stats_path) as stats_file:
+                    stats = json.load(stats_file)
+
+                # the next run starts at the recorded budget
+                self.assertEqual(ParallelismController().parallelism("aws"), 5)
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(stats, {"aws": {"parallelism": 5, "resources_per_minute": 20.0, "throttled": 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import json
+import os
+import tempfile
+import yaml
+from unittest.mock import MagicMock, patch, call
+
+from pipeline import Pipeline
+from manager import Manager
+from model import Infrastructure
+from exceptions import AnsibleError
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            infrastructure = Infrastructure(yaml.safe_load(description_file))
+
+        self.orchestrator = MagicMock()
+        self.orchestrator.infrastructure = infrastructure
+        self.orchestrator.inventory_lock = MagicMock()
+        self.manager = MagicMock(working_dir=".")
+        self.pipeline = Pipeline(self.orchestrator, self.manager, max_workers=2)
+
+        def orchestrate_modules(on_module_ready):
+            for name in infrastructure.names:
+                on_module_ready(name, {"hosts": {}, "vars": {}})
+            return True
+
+        self.orchestrator.orchestrate_modules.side_effect = orchestrate_modules
+
+    def test_dependencies(self):
+        ret = self.pipeline._Pipeline__dependencies("interactive_c2_redirector")
+        self.assertEqual(ret, {"interactive_c2"})
+
+        ret = self.pipeline._Pipeline__dependencies("short_haul_c2")
+        self.assertEqual(ret, {"short_haul_c2_redirector"})
+
+    @patch("pipeline.ReadinessProber")
+    @patch("manager.Manager.prepare", MagicMock())
+    @patch("manager.Manager._Manager__run_ansible")
+    @patch("manager.Manager._Manager__host_hashes")
+    def test_run(self, mock_hashes, mock_run, mock_prober):
+        mock_hashes.side_effect = lambda limit, inventory_path: {group: {group + "_host": "hash"} for group in limit}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manager = Manager(self.orchestrator.infrastructure, working_dir=tmp_dir)
+            pipeline = Pipeline(self.orchestrator, manager, max_workers=2)
+            ret = pipeline.run()
+            with open(os.path.join(tmp_dir, ".ledger.json")) as ledger_file:
+                ledger = json.load(ledger_file)
+
+            self.assertEqual(set(ret), {"interactive_c2_redirector", "interactive_c2",
+                                        "short_haul_c2_redirector", "short_haul_c2"})
+            for timing in ret.values():
+                self.assertLessEqual(timing.get("applied"), timing.get("ready"))
+                self.assertLessEqual(timing.get("ready"), timing.get("configured"))
+            mock_run.assert_has_calls([
+                call(["interactive_c2"], os.path.join(tmp_dir, ".pipeline", "interactive_c2.yaml")),
+                call(["short_haul_c2"], os.path.join(tmp_dir, ".pipeline", "short_haul_c2.yaml"))], any_order=True)
+            self.assertEqual(mock_run.call_count, 4)
+            mock_prober.return_value.wait.assert_any_call(["interactive_c2_redirector"])
+            # configured hosts are skipped by the next manage
+            self.assertEqual(ledger, {module + "_host": "hash" for module in ret})
+
+    @patch("pipeline.os.makedirs", MagicMock())
+    @patch("pipeline.ReadinessProber")
+    def test_run_waits_for_dependencies(self, mock_prober):
+        submitted = []
+
+        def orchestrate_modules(on_module_ready):
+            for module in ["interactive_c2_redirector", "interactive_c2"]:
+                on_module_ready(module, {"hosts": {}, "vars": {}})
+                submitted.append(set(self.pipeline._Pipeline__submitted))
+            return True
+
+        self.orchestrator.orchestrate_modules.side_effect = orchestrate_modules
+
+        self.pipeline.run()
+
+        # redirector references the C2 server, so it cannot be configured before the server is applied
+        self.assertEqual(submitted, [set(), {"interactive_c2_redirector", "interactive_c2"}])
+
+    @patch("pipeline.os.makedirs", MagicMock())
+    @patch("pipeline.ReadinessProber")
+    def test_run_failed(self, mock_prober):
+        self.manager.run.side_effect = AnsibleError("ansible error")
+
+        with self.assertRaises(AnsibleError):
+            self.pipeline.run()
@@ -0,0 +1,77 @@
+import unittest
+import json
+import os
+import tempfile
+import threading
+
+from profiler import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def test_span_nested(self):
+        profiler = Profiler()
+
+        with profiler.span("apply", "terraform", targets=["module.c2"]) as span_args:
+            with profiler.span("inventory", "orchestrator"):
+                pass
+            span_args.update({"create": 3})
+
+        spans = [event for event in profiler.events if event.get("ph") == "X"]
+        self.assertEqual([span.get("name") for span in spans], ["inventory", "apply"])
+        inner, outer = spans
+        self.assertEqual(outer.get("args"), {"targets": ["module.c2"], "create": 3})
+        self.assertEqual(inner.get("tid"), outer.get("tid"))
+        self.assertGreaterEqual(inner.get("ts"), outer.get("ts"))
+        self.assertLessEqual(inner.get("ts") + inner.get("dur"), outer.get("ts") + outer.get("dur"))
+
+    def test_span_failed(self):
+        profiler = Profiler()
+
+        with self.assertRaises(ValueError):
+            with profiler.span("validate"):
+                raise ValueError()
+
+        self.assertEqual([event.get("name") for event in profiler.events], ["thread_name", "validate"])
+
+    def test_add_tracks(self):
+        profiler = Profiler()
+
+        profiler.add("install apache2", "ansible", 100.0, 2.5, "1.2.3.4", play="c2")
+        profiler.add("copy config", "ansible", 102.5, 0.5, "1.2.3.4", play="c2")
+        profiler.add("install apache2", "ansible", 100.0, 3.0, "5.6.7.8", play="c2")
+
+        tracks = {event.get("tid"): event.get("args").get("name") for event in profiler.events
+                  if event.get("ph") == "M"}
+        self.assertEqual(sorted(tracks.values()), ["1.2.3.4", "5.6.7.8"])
+        spans = [event for event in profiler.events if event.get("ph") == "X"]
+        self.assertEqual(tracks.get(spans[1].get("tid")), "1.2.3.4")
+        self.assertEqual((spans[1].get("ts"), spans[1].get("dur")), (102.5e6, 0.5e6))
+        self.assertNotIn(threading.get_ident(), tracks)
+
+    def test_disabled(self):
+        profiler = Profiler(enabled=False)
+
+        with profiler.span("validate") as span_args:
+            span_args.update({"instances": 3})
+        profiler.add("install apache2", "ansible", 100.0, 2.5, "1.2.3.4")
+        profiler.extend([{"name": "apply shard", "ph": "X"}])
+
+        self.assertEqual(profiler.events, [])
+
+    def test_write(self):
+        profiler = Profiler()
+        with profiler.span("validate"):
+            pass
+        profiler.extend([{"name": "apply shard", "ph": "X", "ts": 1.0, "dur": 1.0, "pid": 1, "tid": 1}])
+
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            profiler.write(path)
+            with open(path) as trace_file:
+                trace = json.load(trace_file)
+        finally:
+            os.remove(path)
+
+        self.assertEqual([event.get("name") for event in trace.get("traceEvents")],
+                         ["thread_name", "validate", "apply shard"])
@@ -0,0 +1,106 @@
+import unittest
+import socket
+import tempfile
+import threading
+import yaml
+import os
+from unittest.mock import patch
+
+from readiness import ReadinessProber
+from exceptions import ReadinessError
+
+
+class FakeSSHServer:
+    def __init__(self, banner=b"SSH-2.0-OpenSSH_8.4\r\n"):
+        self.banner = banner
+        self.socket = socket.socket()
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen()
+        self.port = self.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return
+            connection.sendall(self.banner)
+            connection.close()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)  # wakes up the blocked accept()
+        except OSError:
+            pass
+        self.socket.close()
+        self.thread.join()
+
+
+class TestReadinessProber(unittest.TestCase):
+    def setUp(self):
+        inventory = {"all": {"children": {
+            "c2": {"hosts": {"127.0.0.1": {"ansible_ssh_private_key_file": "ssh_keys/c2_0"}}, "vars": {}},
+            "redirector": {"hosts": {"127.0.0.2": {"ansible_ssh_private_key_file": "ssh_keys/redirector_0"}},
+                           "vars": {}}}}}
+        fd, self.inventory_path = tempfile.mkstemp(suffix=".yaml")
+        with os.fdopen(fd, "w") as inventory_file:
+            inventory_file.write(yaml.safe_dump(inventory))
+
+    def tearDown(self):
+        os.remove(self.inventory_path)
+
+    def test_wait_banner(self):
+        server = FakeSSHServer()
+        try:
+            prober = ReadinessProber(self.inventory_path, timeout=5, interval=0.1, port=server.port)
+            ret = prober.wait(["c2"])
+        finally:
+            server.close()
+
+        self.assertEqual(list(ret), ["127.0.0.1"])
+        self.assertLess(ret.get("127.0.0.1"), 5)
+
+    def test_wait_port(self):
+        server = FakeSSHServer(banner=b"")
+        try:
+            prober = ReadinessProber(self.inventory_path, timeout=5, interval=0.1, mode="port", port=server.port)
+            ret = prober.wait(["c2"])
+        finally:
+            server.close()
+
+        self.assertIn("127.0.0.1", ret)
+
+    def test_wait_wrong_banner(self):
+        server = FakeSSHServer(banner=b"HTTP/1.1 400 Bad Request\r\n")
+        try:
+            prober = ReadinessProber(self.inventory_path, timeout=0.5, interval=0.1, port=server.port)
+            with self.assertRaises(ReadinessError):
+                prober.wait(["c2"])
+        finally:
+            server.close()
+
+    def test_wait_not_reachable(self):
+        closed_socket = socket.socket()
+        closed_socket.bind(("127.0.0.1", 0))
+        port = closed_socket.getsockname()[1]
+        closed_socket.close()
+        prober = ReadinessProber(self.inventory_path, timeout=0.5, interval=0.1, port=port)
+
+        with self.assertRaises(ReadinessError) as err:
+            prober.wait()
+
+        self.assertIn("127.0.0.1 (c2)", str(err.exception))
+        self.assertIn("127.0.0.2 (redirector)", str(err.exception))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            ReadinessProber(self.inventory_path, mode="ping")
+
+    @patch("readiness.shutil.which", return_value=None)
+    def test_keyscan_not_installed(self, mock_which):
+        with self.assertRaises(ValueError):
+            ReadinessProber(self.inventory_path, mode="keyscan")
+
+        mock_which.assert_called_once_with("ssh-keyscan")
@@ -0,0 +1,155 @@
+import os
+import asyncio
+import unittest
+
+from redirector import Backend, BackendPool, Redirector, parse_listener
+
+
+class EchoBackend:
+    """
+    Echo server on localhost prefixing replies with its name.
+    """
+    def __init__(self, name: bytes) -> None:
+        self.name = name
+        self.server = None
+        self.port = None
+
+    async def start(self, port: int = 0) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        data = await reader.read()
+        writer.write(self.name + b":" + data)
+        await writer.drain()
+        writer.close()
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+
+async def request(port: int, data: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(data)
+    writer.write_eof()
+    reply = await reader.read()
+    writer.close()
+    return reply
+
+
+class TestBackendPool(unittest.TestCase):
+    def test_round_robin(self):
+        pool = BackendPool(["a", "b", "c"])
+
+        self.assertEqual([pool.choose().host for _ in range(4)], ["a", "b", "c", "a"])
+
+    def test_least_connections(self):
+        pool = BackendPool(["a", "b"], "least-connections")
+        pool.backends[0].active = 2
+
+        self.assertEqual(pool.choose().host, "b")
+
+    def test_unhealthy_skipped(self):
+        pool = BackendPool(["a", "b"])
+        pool.backends[0].healthy = False
+
+        self.assertEqual({pool.choose().host for _ in range(4)}, {"b"})
+        pool.backends[1].healthy = False
+        self.assertEqual({pool.choose().host for _ in range(4)}, {"a", "b"})  # all unhealthy, all used
+        self.assertEqual(pool.choose(pool.backends[:1]).host, "b")
+        self.assertIsNone(pool.choose(pool.backends))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            BackendPool(["a"], "random")
+        with self.assertRaises(ValueError):
+            BackendPool([])
+
+    def test_parse_listener(self):
+        self.assertEqual(parse_listener("80"), (80, 80))
+        self.assertEqual(parse_listener("8443:443"), (8443, 443))
+
+    def test_backend_repr(self):
+        self.assertIn("'a'", repr(Backend("a")))
+
+
+class TestRedirector(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # both backends listen on the same port of different loopback addresses, like hosts of one module
+        self.backends = [EchoBackend(b"one"), EchoBackend(b"two")]
+        await self.backends[0].start()
+        self.backends[1].server = await asyncio.start_server(self.backends[1].handle, "127.0.0.2",
+                                                             self.backends[0].port)
+        self.port = self.backends[0].port
+
+    async def asyncTearDown(self):
+        for backend in self.backends:
+            await backend.stop()
+
+    async def redirect(self, splice: bool):
+        redirector = Redirector([(0, self.port), (0, self.port)], BackendPool(["127.0.0.1", "127.0.0.2"]),
+                                bind="127.0.0.1", health_interval=0, splice=splice)
+        await redirector.start()
+        try:
+            first, second = (address[1] for address in redirector.addresses)
+            replies = [await request(first, b"beacon"), await request(second, b"beacon" * 100000)]
+        finally:
+            await redirector.close()
+        return redirector, replies
+
+    async def test_copy(self):
+        redirector, replies = await self.redirect(splice=False)
+
+        self.assertEqual(replies, [b"one:beacon", b"two:" + b"beacon" * 100000])  # round-robin over all ports
+        self.assertEqual(redirector.transferred, 2 * len(b"beacon") * 100001 + len(b"one:two:"))
+        self.assertEqual(redirector.stats().get("backends").get("127.0.0.1").get("connections"), 1)
+
+    @unittest.skipUnless(hasattr(os, "splice"), "splice(2) is not available")
+    async def test_splice(self):
+        _, replies = await self.redirect(splice=True)
+
+        self.assertEqual(replies, [b"one:beacon", b"two:" + b"beacon" * 100000])
+
+    async def test_health_check(self):
+        await self.backends[1].stop()
+        self.backends[1].server = await asyncio.start_server(lambda r, w: None, "127.0.0.3", 0)  # torn down later
+        redirector = Redirector([(0, self.port)], BackendPool(["127.0.0.1", "127.0.0.2"]), bind="127.0.0.1",
+                                health_interval=0.05)
+        await redirector.start()
+        try:
+            await asyncio.sleep(0.1)
+            replies = {await request(redirector.addresses[0][1], b"x") for _ in range(4)}
+        finally:
+            await redirector.close()
+
+        self.assertEqual(replies, {b"one:x"})
+        self.assertFalse(redirector.pool.backends[1].healthy)
+
+    async def test_failed_connect(self):
+        redirector = Redirector([(0, self.port)], BackendPool(["127.0.0.3"]), bind="127.0.0.1", health_interval=0)
+        await redirector.start()
+        try:
+            reply = await request(redirector.addresses[0][1], b"")
+        finally:
+            await redirector.close()
+
+        self.assertEqual(reply, b"")
+        self.assertFalse(redirector.pool.backends[0].healthy)
+
+    async def test_failover(self):
+        redirector = Redirector([(0, self.port)], BackendPool(["127.0.0.3", "127.0.0.1"]), bind="127.0.0.1",
+                                health_interval=0)
+        await redirector.start()
+        try:
+            reply = await request(redirector.addresses[0][1], b"beacon")
+        finally:
+            await redirector.close()
+
+        self.assertEqual(reply, b"one:beacon")  # refused by the first backend, served by the second
+        self.assertFalse(redirector.pool.backends[0].healthy)
+        self.assertEqual(redirector.stats().get("backends").get("127.0.0.1").get("connections"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import asyncio
+import unittest
+
+from benchmarks.redirectors import benchmark, compare, percentile
+
+
+class TestRedirectorsBenchmark(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([3], 0.99), 3)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_compare(self):
+        baseline = [{"engine": "rtib", "protocol": "tcp", "requests_per_second": 100, "latency_ms": {"p99": 10}},
+                    {"engine": "socat", "protocol": "tcp", "skipped": "not installed"}]
+        results = [{"engine": "rtib", "protocol": "tcp", "requests_per_second": 150, "latency_ms": {"p99": 5}},
+                   {"engine": "socat", "protocol": "tcp", "requests_per_second": 50, "latency_ms": {"p99": 5}}]
+
+        self.assertEqual(compare(results, baseline), ["rtib tcp: +50.0% requests/s, -50.0% p99 latency"])
+
+    def test_benchmark(self):
+        results = asyncio.run(benchmark(["rtib-copy"], ["tcp", "http"], concurrency=2, duration=0.2,
+                                        payload_size=64, connections=4))
+
+        self.assertEqual([(result.get("engine"), result.get("protocol")) for result in results],
+                         [("rtib-copy", "tcp"), ("rtib-copy", "http")])
+        self.assertTrue(all(result.get("requests") > 0 and result.get("errors") == 0 for result in results))
+        self.assertLessEqual(results[0].get("latency_ms").get("p50"), results[0].get("latency_ms").get("p99"))
+
+
+if __name__ == '__main__':
+    unittest.main()
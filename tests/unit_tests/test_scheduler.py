@@ -0,0 +1,74 @@
+import unittest
+import threading
+import yaml
+
+from scheduler import Scheduler
+from model import Infrastructure
+from exceptions import AnsibleError, DependencyCycleError
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            self.infrastructure = Infrastructure(yaml.safe_load(description_file))
+        self.scheduler = Scheduler(self.infrastructure, max_concurrency=4)
+
+    def test_dependencies(self):
+        self.assertEqual(self.scheduler.dependencies, {"interactive_c2_redirector": {"interactive_c2"},
+                                                       "interactive_c2": set(),
+                                                       "short_haul_c2_redirector": {"short_haul_c2"},
+                                                       "short_haul_c2": set()})
+
+    def test_waves(self):
+        self.assertEqual(self.scheduler.waves(), [["interactive_c2", "short_haul_c2"],
+                                                  ["interactive_c2_redirector", "short_haul_c2_redirector"]])
+
+    def test_waves_limited(self):
+        self.assertEqual(self.scheduler.waves(["interactive_c2_redirector"]), [["interactive_c2_redirector"]])
+
+    def test_waves_cycle(self):
+        description = {"infrastructure": {"instances": [{"name": "a", "arguments": {"role": {"redirect_to": "b"}}},
+                                                        {"name": "b", "arguments": {"role": {"redirect_to": "a"}}},
+                                                        {"name": "c"}]}}
+        scheduler = Scheduler(Infrastructure(description))
+
+        with self.assertRaises(DependencyCycleError) as err:
+            scheduler.waves()
+
+        self.assertIn("a, b", str(err.exception))
+
+    def test_run(self):
+        lock = threading.Lock()
+        finished = []
+
+        def run_play(play):
+            with lock:
+                self.assertTrue(self.scheduler.dependencies.get(play) <= set(finished))
+                finished.append(play)
+
+        ret = self.scheduler.run(run_play)
+
+        self.assertEqual(set(ret), {"interactive_c2_redirector", "interactive_c2",
+                                    "short_haul_c2_redirector", "short_haul_c2"})
+
+    def test_run_failed(self):
+        finished = []
+
+        def run_play(play):
+            if play == "interactive_c2":
+                raise AnsibleError("ansible error")
+            finished.append(play)
+
+        with self.assertRaises(AnsibleError):
+            self.scheduler.run(run_play)
+
+        self.assertNotIn("interactive_c2_redirector", finished)
+        self.assertIn("short_haul_c2_redirector", finished)
+
+    def test_critical_path(self):
+        durations = {"interactive_c2_redirector": 1.0, "interactive_c2": 5.0,
+                     "short_haul_c2_redirector": 3.0, "short_haul_c2": 2.0}
+
+        ret = self.scheduler.critical_path(durations)
+
+        self.assertEqual(ret, (["interactive_c2", "interactive_c2_redirector"], 6.0))
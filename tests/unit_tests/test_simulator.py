@@ -0,0 +1,78 @@
+import os
+import socket
+import tempfile
+import unittest
+
+from benchmarks.simulator import Scenario, Simulation, SSHSimulator, allocate_addresses
+from model import Infrastructure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DESCRIPTION = os.path.join(ROOT, "example_infrastructure.yaml")
+
+
+class TestSimulator(unittest.TestCase):
+    def test_scenario(self):
+        scenario = Scenario({"jitter": 0.5, "modules": {"default": {"task_latency": 2.0},
+                                                        "c2": {"apply_latency": 3.0}}}, "/tmp")
+
+        self.assertEqual(scenario.description_path, "/tmp/example_infrastructure.yaml")
+        self.assertEqual(scenario.module("c2").get("apply_latency"), 3.0)
+        self.assertEqual(scenario.module("c2").get("task_latency"), 2.0)
+        self.assertEqual(scenario.module("redirector").get("apply_latency"), 1.0)
+        self.assertEqual(scenario.latency(1.0, "host", 1), scenario.latency(1.0, "host", 1))
+        self.assertTrue(0.5 <= scenario.latency(1.0, "host", 2) <= 1.5)
+        self.assertEqual(Scenario({}).latency(1.0, "host", 1), 1.0)
+
+    def test_allocate_addresses(self):
+        instances = [{"name": "instance_{}".format(i), "role": "c2_server", "provider": "aws",
+                      "arguments": {"provider": {"total": 2}}} for i in range(300)]
+        addresses = allocate_addresses(Infrastructure({"infrastructure": {"name": "test", "instances": instances}}))
+
+        self.assertEqual(addresses.get("instance_0"), ["127.1.0.1", "127.1.0.2"])
+        self.assertEqual(addresses.get("instance_299"), ["127.2.43.1", "127.2.43.2"])
+
+    @staticmethod
+    def write_scenario(content):
+        scenario_file = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+        with scenario_file:
+            scenario_file.write("description: {}\n".format(DESCRIPTION) + content)
+        return scenario_file.name
+
+    @staticmethod
+    def banner(host, port):
+        with socket.create_connection((host, port), timeout=5) as connection:
+            return connection.recv(64)
+
+    def test_run(self):
+        path = self.write_scenario("modules:\n  default: {apply_latency: 0.05, task_latency: 0.01}\n")
+        try:
+            with Simulation(path, ssh_port=22022) as simulation:
+                first = simulation.run()
+                self.assertEqual(first.get("returncode"), 0, first.get("output"))
+                self.assertIn("CONFIGURATION MANAGEMENT DONE", first.get("output"))
+                self.assertEqual(set(simulation.state.read("applied.json")), {instance.name for instance in simulation.infrastructure})
+
+                with SSHSimulator(simulation.state, simulation.scenario, simulation.state.read("addresses.json"),
+                                  22022):
+                    self.assertTrue(self.banner("127.1.0.1", 22022).startswith(b"SSH-"))
+
+                second = simulation.run()
+                self.assertEqual(second.get("returncode"), 0, second.get("output"))
+                self.assertIn("ALL HOSTS UP TO DATE, NOTHING TO CONFIGURE", second.get("output"))
+        finally:
+            os.remove(path)
+
+    def test_run_failed_task(self):
+        path = self.write_scenario("modules:\n  default: {apply_latency: 0.05, task_latency: 0.01}\n"
+                                   "  interactive_c2: {fail_task: 1}\n")
+        try:
+            with Simulation(path, ssh_port=22023) as simulation:
+                result = simulation.run()
+            self.assertNotEqual(result.get("returncode"), 0)
+            self.assertIn("Simulated failure of task 1", "\n".join(result.get("output")))
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
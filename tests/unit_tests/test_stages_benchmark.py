@@ -0,0 +1,48 @@
+import unittest
+
+from benchmarks.stages import benchmark, generate_description, generate_outputs, regressions
+from model import Infrastructure
+from validator import Validator
+
+
+class TestStagesBenchmark(unittest.TestCase):
+    def test_generate_description(self):
+        description = generate_description(30, argument_size=2, total=3)
+        infrastructure = Infrastructure(description)
+
+        self.assertEqual(len(infrastructure), 30)
+        self.assertEqual(Validator(infrastructure, providers_dir="providers", roles_dir="roles").errors(), [])
+        self.assertEqual(infrastructure.get("instance_1").references, {"instance_0"})
+        self.assertEqual(infrastructure.get("instance_3").references, {"instance_4"})
+        self.assertEqual(infrastructure.get("instance_5").provider_arguments,
+                         {"total": 3, "argument_0": 0, "argument_1": 1})
+
+    def test_generate_outputs(self):
+        outputs = generate_outputs(generate_description(300, total=2))
+
+        hosts = [host for output in outputs.values() for host in output.get("value").get("hosts")]
+        self.assertEqual(len(outputs), 300)
+        self.assertEqual(len(set(hosts)), 600)
+
+    def test_benchmark(self):
+        results = benchmark([10], repeat=1)
+
+        self.assertEqual(list(results), ["model", "validate", "parse description", "create inventory",
+                                         "add variables to inventory", "compile firewall rulesets",
+                                         "generate playbook", "host hashes"])
+        self.assertTrue(all(set(sizes.get("10")) == {"seconds", "peak_kb"} for sizes in results.values()))
+
+    def test_regressions(self):
+        baseline = {"validate": {"100": {"seconds": 0.1, "peak_kb": 100}, "10": {"seconds": 0.001, "peak_kb": 10}}}
+        results = {"validate": {"100": {"seconds": 0.15, "peak_kb": 110}, "10": {"seconds": 0.004, "peak_kb": 10},
+                                "1000": {"seconds": 1.0, "peak_kb": 1000}}}
+
+        problems = regressions(results, baseline, 0.2)
+
+        self.assertEqual(len(problems), 1)  # 10 instances are under the noise floor, 1000 have no baseline
+        self.assertIn("validate at 100 instances: seconds 0.1 -> 0.15 (+50%)", problems[0])
+        self.assertEqual(regressions(results, baseline, 0.6), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import MagicMock, patch
+
+from state import TerraformState
+
+
+class TestTerraformState(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, "terraform.tfstate")
+        shutil.copy("tests/unit_tests/terraform_state.json", self.state_path)
+        self.terraform = MagicMock()
+        self.state = TerraformState(self.terraform, self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_outputs(self):
+        with open("tests/unit_tests/terraform_output") as tf_out:
+            tf_out_json = json.load(tf_out)
+
+        ret = self.state.outputs()
+
+        self.assertEqual({module: output.get("value") for module, output in ret.items()},
+                         {module: output.get("value") for module, output in tf_out_json.items()})
+        self.terraform.output.assert_not_called()
+
+    def test_resources(self):
+        with open("tests/unit_tests/terraform_state_out") as tf_state_file:
+            tf_state_list = [resource for resource in tf_state_file.read().split("\n") if resource]
+
+        self.assertEqual(self.state.resources(), tf_state_list)
+        self.terraform.state_cmd.assert_not_called()
+
+    def test_resource_address_formats(self):
+        with open(self.state_path, "w") as state_file:
+            json.dump({"version": 4, "resources": [
+                {"mode": "data", "type": "aws_ami", "name": "debian", "instances": [{}]},
+                {"module": "module.c2", "mode": "managed", "type": "aws_instance", "name": "instance",
+                 "instances": [{"index_key": "a"}, {"index_key": 1}]}]}, state_file)
+
+        self.assertEqual(self.state.resources(), ['data.aws_ami.debian', 'module.c2.aws_instance.instance["a"]',
+                                                  'module.c2.aws_instance.instance[1]'])
+
+    def test_module_resources(self):
+        ret = self.state.module_resources("interactive_c2_redirector")
+
+        self.assertEqual(ret, ["module.interactive_c2_redirector.aws_instance.instance[0]",
+                               "module.interactive_c2_redirector.aws_key_pair.keypair[0]",
+                               "module.interactive_c2_redirector.tls_private_key.ssh_key[0]"])
+
+    def test_cache(self):
+        with patch("state.json.load", wraps=json.load) as mock_load:
+            self.state.outputs()
+            self.state.resources()
+            self.assertEqual(mock_load.call_count, 1)
+
+            with open(self.state_path, "w") as state_file:
+                json.dump({"version": 4, "outputs": {}, "resources": []}, state_file)
+
+            self.assertEqual(self.state.outputs(), {})
+            self.assertEqual(mock_load.call_count, 2)
+
+    def test_no_state(self):
+        os.remove(self.state_path)
+
+        self.assertEqual(self.state.outputs(), {})
+        self.assertEqual(self.state.resources(), [])
+
+    def test_remote_backend(self):
+        os.makedirs(os.path.join(self.tmp_dir, ".terraform"))
+        with open(os.path.join(self.tmp_dir, ".terraform", "terraform.tfstate"), "w") as backend_file:
+            json.dump({"version": 3, "backend": {"type": "s3", "config": {}}}, backend_file)
+        self.terraform.output.return_value = {"c2": {"value": {"hosts": ["1.2.3.4"]}}}
+        self.terraform.state_cmd.return_value = (0, "module.c2.aws_instance.instance[0]\n", "")
+
+        self.assertEqual(self.state.outputs(), {"c2": {"value": {"hosts": ["1.2.3.4"]}}})
+        self.assertEqual(self.state.resources(), ["module.c2.aws_instance.instance[0]"])
@@ -1,21 +1,23 @@
 import unittest
 import schema
+import yaml
 from unittest.mock import MagicMock
 from validator import Validator
+from model import Infrastructure
 
 
 class TestValidator(unittest.TestCase):
     def test_valid_complete_infrastructure(self):
         infrastructure_description = {
             "infrastructure": {"name": "test",
-                               "global_arguments": {"role": {"arg": "val"},
+                               "global_arguments": {"role": {"arg": "val", "attacker": "147.251.0.0/16"},
                                                     "provider": {"arg": "val"}},
                                "instances":
                                    [{"name": "test", "role": "test", "provider": "test",
                                      "arguments": {"role": {"arg": "val"}, "provider": {"arg": "val"}}},
                                     {"name": "test2", "role": "test2", "provider": "test2",
                                      "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
         validator.validate()
 
     def test_valid_missing_global_args(self):
@@ -23,22 +25,24 @@ class TestValidator(unittest.TestCase):
             "infrastructure": {"name": "test",
                                "instances":
                                    [{"name": "test", "role": "test", "provider": "test",
-                                     "arguments": {"role": {"arg": "val"}, "provider": {"arg": "val"}}},
+                                     "arguments": {"role": {"arg": "val", "attacker": "1.2.3.4"},
+                                                   "provider": {"arg": "val"}}},
                                     {"name": "test2", "role": "test2", "provider": "test2",
-                                     "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+                                     "arguments": {"role": {"arg2": "val2", "attacker": "1.2.3.4"},
+                                                   "provider": {"arg2": "val2"}}}]}}
+        validator = Validator(Infrastructure(infrastructure_description))
         validator.validate()
 
     def test_valid_missing_instance_args(self):
         infrastructure_description = {
             "infrastructure": {"name": "test",
-                               "global_arguments": {"role": {"arg": "val"},
+                               "global_arguments": {"role": {"arg": "val", "attacker": "147.251.0.0/16"},
                                                     "provider": {"arg": "val"}},
                                "instances":
                                    [{"name": "test", "role": "test", "provider": "test"},
                                     {"name": "test2", "role": "test2", "provider": "test2",
                                      "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
         validator.validate()
 
     def test_invalid_no_instances(self):
@@ -47,7 +51,7 @@ class TestValidator(unittest.TestCase):
                                "global_arguments": {"role": {"arg": "val"},
                                                     "provider": {"arg": "val"}},
                                "instances": []}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
         with self.assertRaises(schema.SchemaError):
             validator.validate()
 
@@ -62,7 +66,7 @@ class TestValidator(unittest.TestCase):
                                      "arguments": {"role": {"arg": "val"}, "provider": {"arg": "val"}}},
                                     {"name": "test2", "role": "test2", "provider": "test2",
                                      "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
         with self.assertRaises(schema.SchemaError):
             validator.validate()
 
@@ -76,7 +80,7 @@ class TestValidator(unittest.TestCase):
                                      "arguments": {"role": {"arg": "val"}, "provider": {"arg": "val"}}},
                                     {"name": "test2", "role": "test2", "provider": "test2",
                                      "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
         with self.assertRaises(schema.SchemaError):
             validator.validate()
 
@@ -91,7 +95,7 @@ class TestValidator(unittest.TestCase):
                                      "arguments": {"role": {"arg": "val"}, "provider": {"arg": "val"}}},
                                     {"name": "test2", "role": "test2", "provider": "test2",
                                      "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
         with self.assertRaises(schema.SchemaError):
             validator.validate()
 
@@ -105,7 +109,7 @@ class TestValidator(unittest.TestCase):
                                      "arguments": {"bad_arg": None, "role": {"arg": "val"}, "provider": {"arg": "val"}}},
                                     {"name": "test2", "role": "test2", "provider": "test2",
                                      "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
         with self.assertRaises(schema.SchemaError):
             validator.validate()
 
@@ -119,6 +123,86 @@ class TestValidator(unittest.TestCase):
                                      "arguments": {"role": {"arg": "val"}, "provider": {"arg": "val"}}},
                                     {"name": "test", "role": "test2", "provider": "test2",
                                      "arguments": {"role": {"arg2": "val2"}, "provider": {"arg2": "val2"}}}]}}
-        validator = Validator(infrastructure_description)
+        validator = Validator(Infrastructure(infrastructure_description))
+        with self.assertRaises(schema.SchemaError):
+            validator.validate()
+
+    def test_ansible_global_args(self):
+        infrastructure_description = {
+            "infrastructure": {"name": "test",
+                               "global_arguments": {"role": {"attacker": "147.251.0.0/16"},
+                                                    "ansible": {"defaults": {"forks": 20}}},
+                               "instances": [{"name": "test", "role": "test", "provider": "test"}]}}
+        Validator(Infrastructure(infrastructure_description)).validate()
+
+        infrastructure_description.get("infrastructure").get("global_arguments").update({"ansible": {"forks": 20}})
         with self.assertRaises(schema.SchemaError):
+            Validator(Infrastructure(infrastructure_description)).validate()
+
+    def test_errors_collected(self):
+        infrastructure_description = {
+            "infrastructure": {"name": "test",
+                               "global_arguments": {"role": {"attacker": "147.251.0.0/16",
+                                                             "accept_from": ["10.0.0.0/8", "vpn"]}},
+                               "instances":
+                                   [{"name": "c2 server", "role": "c2_server", "provider": "aws"},
+                                    {"name": "redirector", "role": "pipe_redirector", "provider": "azure",
+                                     "arguments": {"role": {"redirect_to": "c2", "accept_from": "0.0.0.0/0"}}},
+                                    {"name": "redirector", "provider": "aws", "size": "t2.micro",
+                                     "arguments": {"role": {"redirect_to": "redirector.example.com",
+                                                            "accept_from": ["redirector", "1.2.3.4", 5]}}}]}}
+        validator = Validator(Infrastructure(infrastructure_description), providers_dir="providers",
+                              roles_dir="roles")
+
+        errors = validator.errors()
+
+        self.assertEqual(sorted(errors), sorted([
+            "infrastructure.global_arguments.role.accept_from[1]: 'vpn' is neither a name of an instance nor an address",
+            "infrastructure.instances[0].name: Instance name cannot contain spaces",
+            "infrastructure.instances[1].provider: unknown provider 'azure', there is no directory providers/azure",
+            "infrastructure.instances[1].arguments.role.redirect_to: 'c2' is neither a name of an instance nor an address",
+            "infrastructure.instances[1].arguments.role.accept_from: must be a list",
+            "infrastructure.instances[2]: missing key 'role'",
+            "infrastructure.instances[2]: unexpected key 'size'",
+            "infrastructure.instances[2].name: instance name 'redirector' is already used by infrastructure.instances[1]",
+            "infrastructure.instances[2].arguments.role.accept_from[2]: must be a name of an instance or an address"]))
+        with self.assertRaises(schema.SchemaError) as err:
             validator.validate()
+        self.assertEqual(str(err.exception).count("\n"), len(errors) - 1)
+
+    def test_valid_example(self):
+        with open("tests/unit_tests/example_infrastructure.yaml") as description_file:
+            validator = Validator(Infrastructure(yaml.safe_load(description_file)), providers_dir="providers",
+                                  roles_dir="roles")
+
+        self.assertEqual(validator.errors(), [])
+
+    def test_missing_attacker(self):
+        infrastructure_description = {
+            "infrastructure": {"name": "test",
+                               "instances":
+                                   [{"name": "test", "role": "test", "provider": "test",
+                                     "arguments": {"role": {"attacker": "1.2.3.4"}}},
+                                    {"name": "test2", "role": "test2", "provider": "test2"}]}}
+
+        errors = Validator(Infrastructure(infrastructure_description)).errors()
+
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("infrastructure.instances[1].arguments.role: missing key 'attacker'"))
+
+    def test_large_description(self):
+        instances = [{"name": "instance_{}".format(i), "role": "pipe_redirector", "provider": "aws",
+                      "arguments": {"role": {"redirect_to": "instance_{}".format(i + 1),
+                                             "accept_from": ["147.251.0.0/16", "instance_{}".format(i - 1)]},
+                                    "provider": {"instance_type": "t2.micro"}}}
+                     for i in range(1, 10001)]
+        instances[-1].get("arguments").get("role").update({"redirect_to": "instance_1"})
+        instances[0].get("arguments").get("role").update({"accept_from": ["instance_10000"]})
+        infrastructure_description = {"infrastructure": {"name": "large", "instances": instances, "global_arguments": {
+            "role": {"attacker": "147.251.0.0/16"}}}}
+
+        validator = Validator(Infrastructure(infrastructure_description), providers_dir="providers",
+                              roles_dir="roles")
+        errors = validator.errors()
+
+        self.assertEqual(errors, [])
@@ -1,49 +1,215 @@
+import os
+import ipaddress
+
 from schema import Schema, And, Optional, SchemaError
 
+from profiler import Profiler
+from model import Infrastructure
+
 
 class Validator:
     """
     A class used for infrastructure description validation.
+
+    All problems are collected in a single pass over the instances, each reported with its path
+    in the description. Instance names, providers and roles are indexed once, so references between
+    instances are resolved in linear time.
     """
     global_schema = Schema({"infrastructure": dict})
     infrastructure_schema = Schema({"name": str,
                                     "instances": And(list, lambda l: len(l) > 0,
                                                      error="There must be at least one instance"),
                                     Optional("global_arguments"): dict})
-    arguments_schema = Schema({Optional("role"): dict,
-                               Optional("provider"): dict})
+    global_arguments_schema = Schema({Optional("role"): dict,
+                                      Optional("provider"): dict,
+                                      Optional("ansible"): {str: dict}})
 
-    instance_schema = Schema(
-        {"name": And(str, lambda name: " " not in name, error="Instance name cannot contain spaces"),
-         "role": str,
-         "provider": str,
-         Optional("arguments"): dict})
+    # instances are checked without Schema, it is too slow for descriptions of thousands of instances
+    instance_keys = {"name": str, "role": str, "provider": str}
+    argument_keys = ("role", "provider")
 
-    def __init__(self, infrastructure_description: dict) -> None:
+    def __init__(self, infrastructure: Infrastructure, profiler: Profiler = None, providers_dir: str = None,
+                 roles_dir: str = None) -> None:
         """
         Validator constructor.
 
-        :param infrastructure_description: dictionary containing infrastructure description
+        :param infrastructure: parsed infrastructure description, its raw description is validated
+        :param profiler: profiler recording the validation, nothing is recorded if None
+        :param providers_dir: directory with provider modules, providers are not checked if None
+        :param roles_dir: directory with Ansible roles, roles are not checked if None
         """
-        self.infrastructure_description = infrastructure_description
+        self.infrastructure = infrastructure
+        self.infrastructure_description = infrastructure.description
+        self.profiler = profiler or Profiler(enabled=False)
+        self.providers_dir = providers_dir
+        self.roles_dir = roles_dir
 
-    def validate(self) -> None:
+    @staticmethod
+    def __directories(path: str) -> set:
         """
-        Validates the infrastructure description.
+        Lists subdirectories of a directory.
+
+        :param path: path to the directory
+        :return: set of subdirectory names, empty if the directory does not exist
+        """
+        try:
+            return {entry.name for entry in os.scandir(path) if entry.is_dir()}
+        except OSError:
+            return set()
+
+    def __top_level_errors(self) -> list:
+        """
+        Validates everything but the instances.
+
+        :return: list of error messages
+        """
+        errors = []
+        try:
+            self.global_schema.validate(self.infrastructure_description)
+        except SchemaError as err:
+            return ["{}: {}".format("description", err)]
+
+        infrastructure = self.infrastructure_description.get("infrastructure")
+        try:
+            self.infrastructure_schema.validate(infrastructure)
+        except SchemaError as err:
+            errors.append("infrastructure: {}".format(err))
+        if infrastructure.get("global_arguments") is not None:
+            try:
+                self.global_arguments_schema.validate(infrastructure.get("global_arguments"))
+            except SchemaError as err:
+                errors.append("infrastructure.global_arguments: {}".format(err))
+        return errors
+
+    def __instance_errors(self, instance_dict, path: str) -> list:
+        """
+        Validates the structure of an instance description.
+
+        :param instance_dict: description of the instance
+        :param path: path of the instance in the description
+        :return: list of error messages
+        """
+        if not isinstance(instance_dict, dict):
+            return ["{}: instance must be a mapping".format(path)]
+
+        errors = []
+        for key, key_type in self.instance_keys.items():
+            if key not in instance_dict:
+                errors.append("{}: missing key '{}'".format(path, key))
+            elif not isinstance(instance_dict.get(key), key_type):
+                errors.append("{}.{}: must be a {}".format(path, key, key_type.__name__))
+        if isinstance(instance_dict.get("name"), str) and " " in instance_dict.get("name"):
+            errors.append("{}.name: Instance name cannot contain spaces".format(path))
+        for key in instance_dict.keys() - self.instance_keys.keys() - {"arguments"}:
+            errors.append("{}: unexpected key '{}'".format(path, key))
+
+        arguments = instance_dict.get("arguments")
+        if arguments is None:
+            return errors
+        if not isinstance(arguments, dict):
+            return errors + ["{}.arguments: must be a mapping".format(path)]
+        for key, value in arguments.items():
+            if key not in self.argument_keys:
+                errors.append("{}.arguments: unexpected key '{}'".format(path, key))
+            elif not isinstance(value, dict):
+                errors.append("{}.arguments.{}: must be a mapping".format(path, key))
+        return errors
 
-        :raises SchemaError: when schema validation fails
+    @staticmethod
+    def __is_address(value: str) -> bool:
         """
-        self.global_schema.validate(self.infrastructure_description)
-        self.infrastructure_schema.validate(self.infrastructure_description.get("infrastructure"))
-        if self.infrastructure_description.get("infrastructure").get("global_arguments") is not None:
-            self.arguments_schema.validate(self.infrastructure_description.get("infrastructure").get("global_arguments"))
+        Checks whether a reference is an address rather than a name of an instance.
 
-        for instance in self.infrastructure_description.get("infrastructure").get("instances"):
-            self.instance_schema.validate(instance)
-            if instance.get("arguments") is not None:
-                self.arguments_schema.validate(instance.get("arguments"))
+        :param value: value of "redirect_to" or an item of "accept_from"
+        :return: True for IP addresses, networks and DNS names, False otherwise
+        """
+        try:
+            ipaddress.ip_network(value, strict=False)
+            return True
+        except ValueError:
+            return "." in value
+
+    def __reference_errors(self, role_args: dict, path: str, addresses: dict) -> list:
+        """
+        Checks that "redirect_to" and "accept_from" role arguments are instance names or addresses.
+
+        :param role_args: role arguments of an instance, or global role arguments
+        :param path: path of the role arguments in the description
+        :param addresses: cache of __is_address results shared by all instances
+        :return: list of error messages
+        """
+        errors = []
+        values = []
+        if role_args.get("redirect_to") is not None:
+            values.append(("{}.redirect_to".format(path), role_args.get("redirect_to")))
+        if isinstance(role_args.get("accept_from"), list):
+            values.extend(("{}.accept_from[{}]".format(path, i), item)
+                          for i, item in enumerate(role_args.get("accept_from")))
+        elif role_args.get("accept_from") is not None:
+            errors.append("{}.accept_from: must be a list".format(path))
+
+        for item_path, item in values:
+            if not isinstance(item, str):
+                errors.append("{}: must be a name of an instance or an address".format(item_path))
+            elif item not in self.infrastructure:
+                if item not in addresses:
+                    addresses.update({item: self.__is_address(item)})
+                if not addresses.get(item):
+                    errors.append("{}: '{}' is neither a name of an instance nor an address".format(item_path, item))
+        return errors
+
+    def errors(self) -> list:
+        """
+        Collects all problems of the infrastructure description in a single pass.
+
+        :return: list of error messages prefixed with the path in the description, empty if the description is valid
+        """
+        with self.profiler.span("validate", "validator") as span_args:
+            with self.profiler.span("validate infrastructure", "validator"):
+                errors = self.__top_level_errors()
+            instances = (self.infrastructure_description.get("infrastructure") or {}).get("instances") \
+                if isinstance(self.infrastructure_description, dict) else None
+            if not isinstance(instances, list):
+                return errors
+
+            with self.profiler.span("validate instances", "validator", instances=len(instances)):
+                for i, instance_dict in enumerate(instances):
+                    errors.extend(self.__instance_errors(instance_dict, "infrastructure.instances[{}]".format(i)))
+
+            with self.profiler.span("validate references", "validator"):
+                providers = self.__directories(self.providers_dir) if self.providers_dir is not None else None
+                roles = self.__directories(self.roles_dir) if self.roles_dir is not None else None
+                first_paths = {}
+                addresses = {}
+                errors.extend(self.__reference_errors(self.infrastructure.global_role_arguments,
+                                                      "infrastructure.global_arguments.role", addresses))
+                for instance in self.infrastructure:
+                    if instance.name in first_paths:
+                        errors.append("{}.name: instance name '{}' is already used by {}".format(
+                            instance.path, instance.name, first_paths.get(instance.name)))
+                    first_paths.setdefault(instance.name, instance.path)
 
-        # check that instance names are unique
-        names = [instance.get("name") for instance in self.infrastructure_description.get("infrastructure").get("instances")]
-        if len(names) != len(set(names)):
-            raise SchemaError("Instance names must be unique")
+                    if providers is not None and isinstance(instance.provider, str) \
+                            and instance.provider not in providers:
+                        errors.append("{}.provider: unknown provider '{}', there is no directory {}".format(
+                            instance.path, instance.provider, os.path.join(self.providers_dir, instance.provider)))
+                    if roles is not None and isinstance(instance.role, str) and instance.role not in roles:
+                        errors.append("{}.role: unknown role '{}', there is no directory {}".format(
+                            instance.path, instance.role, os.path.join(self.roles_dir, instance.role)))
+                    if not instance.resolved_role_arguments.get("attacker"):
+                        errors.append("{}.arguments.role: missing key 'attacker' (or in infrastructure.global_"
+                                      "arguments.role), the network role allows SSH only from it".format(instance.path))
+                    errors.extend(self.__reference_errors(instance.role_arguments,
+                                                          "{}.arguments.role".format(instance.path), addresses))
+            span_args.update({"errors": len(errors)})
+        return errors
+
+    def validate(self) -> None:
+        """
+        Validates the infrastructure description.
+
+        :raises SchemaError: when the description is not valid, listing all its problems
+        """
+        errors = self.errors()
+        if errors:
+            raise SchemaError("\n".join(errors))